@@ -0,0 +1,172 @@
+# Batch entrypoint, packaging and deploying many mods in one run
+import os
+import sys
+import glob
+import logging
+from argparse import ArgumentParser
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+from ksp_deploy.config import KSPConfiguration
+from ksp_deploy.context import BuildContext
+from ksp_deploy.credentials import get_credential_store
+from ksp_deploy.logging import set_logging
+from ksp_deploy.sessions import log_connection_stats
+
+from package import package
+from deploy import deploy, deploy_failed
+
+logger = logging.getLogger("batch")
+
+
+def find_mod_data_files(patterns):
+    """
+    Expands mod data file paths and globs
+
+    Inputs:
+        patterns (list[str]): paths or glob patterns of mod data files
+    Returns:
+        mod_data_files (list[str]): absolute paths of the files, in order and without duplicates
+    """
+    found = []
+    for pattern in patterns:
+        for path in sorted(glob.glob(pattern, recursive=True)) or [pattern]:
+            path = os.path.abspath(path)
+            if path not in found:
+                found.append(path)
+    return found
+
+def job_config(mod_data_file, index, config):
+    """
+    Creates the configuration of one mod of a batch. Its paths are resolved against
+    the mod's folder, while the cache is shared by the batch and each job gets its
+    own temp path
+
+    Inputs:
+        mod_data_file (str): absolute path of the mod data file
+        index (int): position of the mod in the batch
+        config (KSPConfiguration): configuration of the batch
+    Returns:
+        config (KSPConfiguration): the job's configuration
+    """
+    return KSPConfiguration.for_job(os.path.dirname(mod_data_file), {
+        "CACHE_PATH": os.path.abspath(config.CACHE_PATH),
+        "TEMP_PATH": os.path.join(os.path.abspath(config.TEMP_PATH), f"job{index}")
+    })
+
+def package_job(mod_data_file, index, core_release, extras_release, complete_release, incremental):
+    """
+    Packages one mod of a batch, in a worker process
+
+    Inputs:
+        mod_data_file (str): absolute path of the mod data file
+        index (int): position of the mod in the batch
+        core_release (bool): whether to build a no-dependency release zip
+        extras_release (bool): whether to build a release zip for each extra file
+        complete_release (bool): whether to build a yes dependency release zip
+        incremental (bool): whether to reuse unchanged entries from the previous release zips
+    Returns:
+        artifacts (dict): the zips written, as returned by package()
+    """
+    context = BuildContext(mod_data_file, job_config(mod_data_file, index, KSPConfiguration()))
+    return package(core_release, extras_release, complete_release, mod_data_file,
+                   incremental=incremental, context=context)
+
+def batch(mod_data_files, core_release, extras_release, complete_release, incremental=False, deploy_release=True):
+    """
+    Packages and deploys many mods. Mods are packaged in a pool of processes, and
+    each is deployed from this process as soon as it is packaged, so all deploys
+    share one credentials lookup, one HTTP session and its per host limits.
+    Downloaded dependencies are shared through the cache of the batch's configuration
+
+    Inputs:
+        mod_data_files (list[str]): absolute paths of the mod data files
+        core_release (bool): whether to build a no-dependency release zip
+        extras_release (bool): whether to build a release zip for each extra file
+        complete_release (bool): whether to build a yes dependency release zip
+        incremental (bool): whether to reuse unchanged entries from the previous release zips
+        deploy_release (bool): whether to deploy the zips to the providers
+    Returns:
+        results (dict): mod data file -> dictionary of the "artifacts" written, the provider
+            "deploy" results and the "error" that stopped the mod, if any
+    """
+    config = KSPConfiguration()
+    results = {path: {"artifacts": None, "deploy": {}, "error": None} for path in mod_data_files}
+
+    def deploy_job(mod_data_file, index, artifacts):
+        context = BuildContext(mod_data_file, job_config(mod_data_file, index, config))
+        results[mod_data_file]["deploy"] = deploy(mod_data_file, context=context, artifacts=artifacts)
+
+    with ProcessPoolExecutor(max_workers=max(1, config.BATCH_WORKERS)) as packagers, \
+            ThreadPoolExecutor(max_workers=max(1, config.BATCH_WORKERS)) as deployers:
+        packaging = [(path, index, packagers.submit(package_job, path, index,
+                      core_release, extras_release, complete_release, incremental))
+                     for index, path in enumerate(mod_data_files)]
+        deploying = []
+        for path, index, future in packaging:
+            try:
+                results[path]["artifacts"] = future.result()
+            except Exception as err:
+                logger.exception(f"Packaging {path} failed")
+                results[path]["error"] = f"packaging failed ({err})"
+                continue
+            if deploy_release:
+                deploying.append((path, deployers.submit(deploy_job, path, index, results[path]["artifacts"])))
+        for path, future in deploying:
+            try:
+                future.result()
+            except Exception as err:
+                logger.exception(f"Deploying {path} failed")
+                results[path]["error"] = f"deploy failed ({err})"
+
+    get_credential_store(config).wipe()
+    log_batch_summary(results)
+    log_connection_stats(logger)
+    return results
+
+def log_batch_summary(results):
+    """
+    Logs the outcome of each mod of a batch
+
+    Inputs:
+        results (dict): mod data file -> dictionary of artifacts, deploy results and error
+    """
+    logger.info("Batch summary\n=================")
+    for path, result in results.items():
+        if result["error"] is not None:
+            logger.info(f"{path}: {result['error']}")
+        else:
+            deployed = ", ".join(f"{name} {r['result']}" for name, r in result["deploy"].items())
+            logger.info(f"{path}: packaged{', ' + deployed if deployed else ''}")
+
+def batch_failed(results):
+    """Returns whether any mod of a batch failed to package or deploy"""
+    return any(r["error"] is not None or deploy_failed(r["deploy"]) for r in results.values())
+
+if __name__ == "__main__":
+    parser = ArgumentParser()
+    parser.add_argument("files", nargs="+",
+                        help="mod data file paths or glob patterns, eg 'mods/*/.mod_data.yml'")
+    parser.add_argument("-c", "--complete",
+                        action="store_true",  default=True,
+                        help="write complete package")
+    parser.add_argument("-e", "--extras",
+                        action="store_true", default=False,
+                        help="write extras package")
+    parser.add_argument("-b", "--basic",
+                        action="store_true", default=False,
+                        help="write basic no dependency package")
+    parser.add_argument("-i", "--incremental",
+                        action="store_true", default=False,
+                        help="reuse unchanged files from the previous release zips")
+    parser.add_argument("--no-deploy",
+                        action="store_true", default=False,
+                        help="package without deploying")
+
+    args = parser.parse_args()
+
+    for log_name in ("batch", "packager", "deployment"):
+        set_logging(log_name)
+    results = batch(find_mod_data_files(args.files), args.basic, args.extras, args.complete,
+                    incremental=args.incremental, deploy_release=not args.no_deploy)
+    if batch_failed(results):
+        sys.exit(1)
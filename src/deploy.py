@@ -1,47 +1,66 @@
 # Deploy script entrypoint
 import os
+import sys
+import time
 import shutil
+import threading
 import zipfile
 import zlib
-import requests
+import logging
 from argparse import ArgumentParser
 
 from ksp_deploy.config import KSPConfiguration
-from ksp_deploy.credentials import find_credentials
+from ksp_deploy.context import BuildContext
+from ksp_deploy.credentials import find_credentials, get_credential_store
 
 from ksp_deploy.logging import set_logging
-from ksp_deploy.helpers import get_build_data, get_version_file_info, get_changelog, get_version, get_ksp_version
-from ksp_deploy.spacedock import SpaceDockAPI
-from ksp_deploy.curseforge import CurseForgeAPI
-from ksp_deploy.github import GitHubReleasesAPI
+from ksp_deploy.helpers import get_changelog, get_version, get_ksp_version
+from ksp_deploy.retry import RetryPolicy, retry_counters
+from ksp_deploy.sessions import get_session, log_connection_stats
+from ksp_deploy.apicache import APICache
+from ksp_deploy.manifest import MANIFEST_NAME, ManifestMismatch, file_sha256, load_manifest, verify_artifact
 
+logger = logging.getLogger("deployment")
 
-def deploy(mod_data_file):
+
+def deploy(mod_data_file, context=None, artifacts=None):
     """
-    Deploys packages to providers
+    Deploys packages to providers. The enabled providers are deployed to at the
+    same time, and a provider that fails or times out does not stop the others.
+    Resolved credentials are kept for later deploys in the process; callers wipe
+    them once they are done
 
     Inputs:
         mod_data_file (str): path to mod data yaml (defaults to the one in ksp_deploy.config.py)
+        context (BuildContext): already parsed build inputs, read from mod_data_file if not given
+        artifacts (dict): the zips written by package(), found in the deploy path if not given
+    Returns:
+        results (dict): provider name -> dictionary of result, duration and bytes/s
     """
-    # Create/load the config
-    config = KSPConfiguration()
-
-    # Collect build information
-    if mod_data_file == "":
-        mod_data_file = config.BUILD_DATA_NAME
-    build_data = get_build_data(mod_data_file)
-    version_data = get_version_file_info(os.path.join(os.path.dirname(mod_data_file), "GameData", build_data['mod-name']), build_data['mod-name'])
+    # Create/load the config and collect build information
+    context = context or BuildContext(mod_data_file)
+    config = context.config
+    mod_data_file = context.mod_data_file
+    build_data = context.build_data
+    version_data = context.version_data
 
     changelog = get_changelog(os.path.join(os.path.dirname(mod_data_file), config.CHANGELOG_PATH))
 
     logger.info(f"Deploying {build_data['mod-name']} version {get_version(version_data)}\n=================")
     logger.info(f"Changes:\n{changelog}")
 
-    zipfile = os.path.join("deploy", build_data['mod-name'], f"{build_data['mod-name']}_" + "{MAJOR}_{MINOR}_{PATCH}.zip".format(**version_data["VERSION"]))
-    logger.info(f"Deploying {zipfile}")
+    if artifacts is not None:
+        zipfile = artifacts["full"]
+        zips = [path for path in [artifacts["core"], artifacts["full"]] + artifacts["extras"] if path is not None]
+    else:
+        zipfile = os.path.join(config.DEPLOY_PATH, build_data['mod-name'], f"{build_data['mod-name']}_" + "{MAJOR}_{MINOR}_{PATCH}.zip".format(**version_data["VERSION"]))
+        zips = [os.path.join(os.path.dirname(zipfile), name) for name in sorted(os.listdir(os.path.dirname(zipfile))) if name.endswith(".zip")]
+    checksums = artifact_checksums(zips,
+        artifacts["manifest"] if artifacts is not None else os.path.join(os.path.dirname(zipfile), MANIFEST_NAME))
 
+    providers = {}
     if "SpaceDock" in build_data["deploy"] and build_data["deploy"]["SpaceDock"]["enabled"]:
-        deploy_spacedock(
+        providers["SpaceDock"] = (deploy_spacedock,
             get_version(version_data),
             get_ksp_version(version_data),
             build_data["deploy"]["SpaceDock"]['mod-id'],
@@ -49,7 +68,7 @@ def deploy(mod_data_file):
             zipfile,
             config)
     if "CurseForge" in build_data["deploy"] and build_data["deploy"]["CurseForge"]["enabled"]:
-        deploy_curseforge(
+        providers["CurseForge"] = (deploy_curseforge,
             get_ksp_version(version_data),
             build_data["deploy"]["CurseForge"]['mod-id'],
             changelog,
@@ -57,12 +76,132 @@ def deploy(mod_data_file):
             config)
 
     if "GitHub" in build_data["deploy"] and build_data["deploy"]["GitHub"]["enabled"]:
-        deploy_github(
+        providers["GitHub"] = (deploy_github,
+            build_data["deploy"]["GitHub"].get("repository", os.environ.get("TRAVIS_REPO_SLUG")),
             get_version(version_data),
             changelog,
             zipfile,
+            checksums.get(zipfile),
+            config)
+
+    if "S3" in build_data["deploy"] and build_data["deploy"]["S3"]["enabled"]:
+        providers["S3"] = (deploy_s3,
+            build_data["deploy"]["S3"]["bucket"],
+            build_data["deploy"]["S3"].get("prefix", build_data['mod-name']),
+            zips,
+            checksums,
             config)
 
+    # SpaceDock, CurseForge and GitHub are sent the complete zip, S3 every zip
+    single_zip = [name for name in providers if name != "S3"]
+    if single_zip and zipfile is None:
+        raise ValueError(f"No complete release zip was packaged, but deploying to {', '.join(single_zip)} needs one")
+    if zipfile is not None:
+        logger.info(f"Deploying {zipfile}")
+    upload_sizes = {name: os.path.getsize(zipfile) for name in single_zip}
+    if "S3" in providers:
+        upload_sizes["S3"] = sum(os.path.getsize(path) for path in zips)
+
+    results = deploy_providers(providers, upload_sizes, config.DEPLOY_TIMEOUT)
+    log_deploy_summary(results)
+    log_connection_stats(logger)
+    return results
+
+def artifact_checksums(zips, manifest_path):
+    """
+    Checks the release zips against the manifest written when they were packaged,
+    and takes their checksums from it so they don't need to be hashed again. Zips
+    that don't match the manifest are left out, and checksummed as needed instead
+
+    Inputs:
+        zips (list[str]): paths of the release zips
+        manifest_path (str): path of the manifest, or None
+    Returns:
+        checksums (dict): zip path -> SHA-256, empty if there is no manifest
+    """
+    manifest = load_manifest(manifest_path) if manifest_path is not None else None
+    if manifest is None:
+        logger.info("No checksum manifest was found, checksums will be computed as needed")
+        return {}
+    checksums = {}
+    for path in zips:
+        try:
+            checksums[path] = verify_artifact(manifest, path)["sha256"]
+        except ManifestMismatch as err:
+            logger.warning(f"{err}, its checksum will be computed as needed")
+    logger.info(f"Verified {len(checksums)} of {len(zips)} zips against {manifest_path}")
+    return checksums
+
+def deploy_providers(providers, upload_sizes, timeout=None):
+    """
+    Runs provider deployments concurrently, each in its own thread
+
+    Inputs:
+        providers (dict): provider name -> (deploy function, *arguments). Deploy functions
+            return whether they uploaded anything
+        upload_sizes (dict): provider name -> bytes uploaded if the provider isn't skipped
+        timeout (float): seconds to wait for all providers, or None to wait indefinitely
+    Returns:
+        results (dict): provider name -> dictionary of result, duration and bytes/s
+    """
+    results = {}
+    start = time.perf_counter()
+    threads = {}
+    for name, target in providers.items():
+        # Daemon threads, so a provider that hangs past the timeout doesn't keep the script alive
+        thread = threading.Thread(target=run_provider,
+            args=(name, target[0], target[1:], upload_sizes.get(name, 0), results),
+            name=f"deploy-{name}", daemon=True)
+        thread.start()
+        threads[name] = thread
+    for name, thread in threads.items():
+        thread.join(None if timeout is None else max(0, start + timeout - time.perf_counter()))
+        if thread.is_alive():
+            logger.error(f"Deploy to {name} timed out after {timeout}s")
+            results[name] = {"result": "timed out", "duration": time.perf_counter() - start, "rate": 0.0}
+    return {name: results[name] for name in providers}
+
+def run_provider(name, deploy_function, args, upload_size, results):
+    """
+    Runs a single provider deployment, catching anything it raises
+
+    Inputs:
+        name (str): name of the provider
+        deploy_function (callable): the provider's deploy function
+        args (tuple): arguments to the deploy function
+        upload_size (int): bytes uploaded if the provider isn't skipped
+        results (dict): where to store the result, duration and bytes/s of the deployment
+    """
+    start = time.perf_counter()
+    try:
+        uploaded = deploy_function(*args)
+        result = "uploaded" if uploaded else "skipped"
+    except Exception as err:
+        logger.exception(f"Deploy to {name} failed")
+        uploaded = False
+        result = f"failed ({err})"
+    duration = time.perf_counter() - start
+    rate = upload_size / duration if uploaded and duration > 0 else 0.0
+    results[name] = {"result": result, "duration": duration, "rate": rate}
+
+def log_deploy_summary(results):
+    """
+    Logs the outcome of each provider deployment
+
+    Inputs:
+        results (dict): provider name -> dictionary of result, duration and bytes/s
+    """
+    counters = retry_counters()
+    logger.info("Deploy summary\n=================")
+    for name, result in results.items():
+        retries = counters.get(name, {"requests": 0, "retries": 0, "wasted_bytes": 0})
+        logger.info(f"{name}: {result['result']} in {result['duration']:.1f}s ({result['rate'] / 1024 / 1024:.2f} MB/s), "
+                    f"{retries['requests']} requests, {retries['retries']} retries, {retries['wasted_bytes']} bytes wasted")
+
+def deploy_failed(results):
+    """Returns whether any provider deployment failed or timed out"""
+    return any(r["result"] not in ("uploaded", "skipped") for r in results.values())
+
 def deploy_curseforge(ksp_version, mod_id, changelog, zipfile, config):
     """
     Performs deployment to CurseForge
@@ -73,13 +212,23 @@ def deploy_curseforge(ksp_version, mod_id, changelog, zipfile, config):
         changelog (str): Markdown formatted changelog
         zipfile (str): path to file to upload
         config (KSPConfiguration): configuration instance
+    Returns:
+        uploaded (bool): whether the zip was uploaded
     """
+    # The provider clients are imported when used, as requests is slow to import
+    from ksp_deploy.curseforge import CurseForgeAPI
+
     logger.info("Deploying to CurseForge")
 
     curse_token = find_credentials("CURSEFORGE_TOKEN", config)
 
-    with CurseForgeAPI(curse_token) as api:
+    with CurseForgeAPI(curse_token,
+            session=get_session(config),
+            retry=RetryPolicy.from_config("CurseForge", config),
+            cache=APICache.from_config(config),
+            versions_ttl=config.CURSEFORGE_VERSIONS_TTL) as api:
         api.update_mod(mod_id, changelog, ksp_version, "release", zipfile)
+    return True
 
 def deploy_spacedock(version, ksp_version, mod_id, changelog, zipfile, config):
     """
@@ -92,67 +241,83 @@ def deploy_spacedock(version, ksp_version, mod_id, changelog, zipfile, config):
         changelog (str): Markdown formatted changelog
         zipfile (str): path to file to upload
         config (KSPConfiguration): configuration instance
+    Returns:
+        uploaded (bool): whether the zip was uploaded
     """
+    import requests
+    from ksp_deploy.spacedock import SpaceDockAPI
 
     spacedock_user = find_credentials("SPACEDOCK_LOGIN", config)
     spacedock_pw = find_credentials("SPACEDOCK_PASSWORD", config)
 
     logger.info(f"Deploying {zipfile} to SpaceDock project {mod_id}")
+    uploading = False
     try:
-        with SpaceDockAPI(spacedock_user, spacedock_pw) as api:
+        with SpaceDockAPI(spacedock_user, spacedock_pw,
+                session=get_session(config),
+                retry=RetryPolicy.from_config("SpaceDock", config),
+                cache=APICache.from_config(config),
+                max_age=config.SPACEDOCK_CACHE_MAX_AGE) as api:
             if api.check_version_exists(mod_id, version):
                 logger.warning("Skipping Spacedock deploy as version already exists")
-            else:
-                api.update_mod(mod_id, version, changelog, ksp_version, True, zipfile)
+                return False
+            uploading = True
+            api.update_mod(mod_id, version, changelog, ksp_version, True, zipfile)
+            return True
     except requests.exceptions.ConnectionError as err:
+        # SpaceDock being down is only a reason to skip until the upload starts
+        if uploading:
+            raise
         logger.warning(f"Skipping Spacedock deploy as Spacedock is down ({err})")
+        return False
 
-def deploy_github(version, changelog, zipfile, config):
+def deploy_github(repo_slug, version, changelog, zipfile, checksum, config):
     """
     Performs deployment to GitHub releases
 
     Inputs:
+        repo_slug (str): Github repo slug of the form org/repo
         version (str): mod version
         changelog (str): Markdown formatted changelog
         zipfile (str): path to file to upload
+        checksum (str): SHA-256 of the zip from the manifest, computed when needed if not known
         config (KSPConfiguration): configuration instance
+    Returns:
+        uploaded (bool): whether the zip was uploaded
     """
+    from ksp_deploy.github import GitHubReleasesAPI
+
     logger.info("Deploying to GitHub Releases")
 
     github_user = find_credentials("GITHUB_USER", config)
     github_token = find_credentials("GITHUB_OAUTH_TOKEN", config)
-    repo_slug = os.environ["TRAVIS_REPO_SLUG"]
     branch = os.environ["TRAVIS_BRANCH"]
 
-    with GitHubReleasesAPI(github_user, github_token, repo_slug) as api:
-
-        latest = api.get_latest_release()
+    with GitHubReleasesAPI(github_user, github_token, repo_slug,
+            session=get_session(config),
+            retry=RetryPolicy.from_config("GitHub", config),
+            cache=APICache.from_config(config)) as api:
 
-        try:
-            latest_name = latest.get("name", "")
-            logger.info(f"Latest release was {latest_name}")
-        except AttributeError:
-            logger.info(f"No previous releases")
-            latest_name = ""
-
-        slug = os.environ["TRAVIS_REPO_SLUG"]
-        owner, repo = slug.split('/')
-        if latest_name == f"{repo} {version}":
-            latest_id = latest["id"]
-            assets = api.get_release_assets(latest_id)
-            if len(assets) == 0:
-                logger.warning("Release already exists but has no assets, zip will be uploaded")
+        # A single request tells whether the release exists and which assets it has
+        release = api.get_release_by_tag(version)
+        if release is not None:
+            release_id = release["id"]
+            asset = api.find_asset(release, os.path.basename(zipfile))
+            if asset is None:
+                logger.warning(f"Release already exists but has a missing asset, {zipfile} will be uploaded")
                 do_upload = True
-                release_id = latest["id"]
-            else:
+            elif asset.get("state", "uploaded") != "uploaded":
+                logger.warning(f"Release has an incomplete {asset['name']} from a failed upload, it will be replaced")
+                api.delete_asset(asset["id"])
+                do_upload = True
+            elif asset.get("digest") is not None and asset["digest"] != f"sha256:{checksum or file_sha256(zipfile)}":
+                # GitHub reports the digest of assets, which tells whether the release holds this build
+                logger.warning(f"The {asset['name']} already released differs from {zipfile}, it will be replaced")
+                api.delete_asset(asset["id"])
                 do_upload = True
-                release_id = latest["id"]
-                for asset in assets:
-                    if asset["name"] == os.path.basename(zipfile):
-                        logger.warning(f"Skipping GitHub deploy as version and file {asset['name']} ({os.path.basename(zipfile)}) already exist")
-                        do_upload = False
-                if do_upload:
-                    logger.warning(f"Release already exists but has a missing asset, {zipfile} will be uploaded")
+            else:
+                logger.warning(f"Skipping GitHub deploy as version and file {asset['name']} already exist")
+                do_upload = False
         else:
             logger.info(f"Creating new release for version {version} on branch {branch}")
             response = api.create_release(version, changelog, branch)
@@ -164,6 +329,32 @@ def deploy_github(version, changelog, zipfile, config):
             api.upload_release_file(release_id, zipfile)
         else:
             logger.warning("Skipping file upload as version already exists")
+        return do_upload
+
+def deploy_s3(bucket, prefix, zips, checksums, config):
+    """
+    Performs deployment to an S3 bucket. Every release zip, core, full and extras,
+    is uploaded, except those the bucket already has with the same checksum
+
+    Inputs:
+        bucket (str): name of the bucket
+        prefix (str): key prefix to upload under
+        zips (list[str]): paths of the release zips
+        checksums (dict): zip path -> SHA-256 of the zips whose checksum is known
+        config (KSPConfiguration): configuration instance
+    Returns:
+        uploaded (bool): whether any zip was uploaded
+    """
+    # Imported here, as boto3 is slow to import and only needed by this provider
+    import ksp_deploy.aws.s3 as s3
+
+    logger.info(f"Deploying to S3 bucket {bucket}")
+    prefix = f"{prefix.strip('/')}/" if prefix else ""
+    pairs = [(path, f"s3://{bucket}/{prefix}{os.path.basename(path)}") for path in zips]
+    uploaded = s3.upload_changed(pairs, config, extra_args={"ContentType": "application/zip"}, checksums=checksums)
+    if not uploaded:
+        logger.warning("Skipping S3 deploy as every zip is already up to date")
+    return len(uploaded) > 0
 
 if __name__ == "__main__":
     parser = ArgumentParser()
@@ -172,4 +363,7 @@ if __name__ == "__main__":
 
     args = parser.parse_args()
     logger = set_logging("deployment")
-    deploy(args.file)
+    results = deploy(args.file)
+    get_credential_store(KSPConfiguration()).wipe()
+    if deploy_failed(results):
+        sys.exit(1)
@@ -0,0 +1,101 @@
+# Persistent cache of provider API responses
+import os
+import json
+import time
+import hashlib
+import logging
+import threading
+
+from ksp_deploy.helpers import ensure_path
+
+logger = logging.getLogger('deploy.apicache')
+
+
+class APICache(object):
+    """
+    Stores JSON documents from provider APIs on disk, one file per key, so they
+    are shared between runs and between mods. Entries that were already read
+    in this process are served from memory while their file is unchanged.
+    """
+
+    def __init__(self, path):
+        """
+        Inputs:
+            path (str): folder to keep the cache in
+        """
+        self.path = path
+        self.memory = {}
+        self.lock = threading.Lock()
+
+    @classmethod
+    def from_config(cls, config):
+        """Creates the cache in the configured cache path"""
+        return cls(os.path.join(config.CACHE_PATH, "api"))
+
+    def entry_path(self, key):
+        """Returns the file holding a key"""
+        return os.path.join(self.path, hashlib.sha256(key.encode("utf-8")).hexdigest() + ".json")
+
+    def get(self, key, ttl=None):
+        """
+        Reads an entry
+
+        Inputs:
+            key (str): the key
+            ttl (float): maximum age of the entry in seconds, or None for any age
+        Returns:
+            entry (dict): the entry, with the stored document under "data" and the
+                time it was stored under "stored", or None if missing or too old
+        """
+        path = self.entry_path(key)
+        try:
+            mtime = os.stat(path).st_mtime
+        except OSError:
+            return None
+        with self.lock:
+            cached = self.memory.get(key)
+        if cached is not None and cached[0] == mtime:
+            entry = cached[1]
+        else:
+            try:
+                with open(path, "r") as f:
+                    entry = json.load(f)
+            except (OSError, ValueError) as err:
+                logger.warning(f"Ignoring unreadable cache entry {path} ({err})")
+                return None
+            with self.lock:
+                self.memory[key] = (mtime, entry)
+        if ttl is not None and time.time() - entry["stored"] > ttl:
+            return None
+        return entry
+
+    def delete(self, key):
+        """Removes an entry, if present"""
+        with self.lock:
+            self.memory.pop(key, None)
+        try:
+            os.remove(self.entry_path(key))
+        except FileNotFoundError:
+            pass
+
+    def put(self, key, data, **fields):
+        """
+        Writes an entry
+
+        Inputs:
+            key (str): the key
+            data (object): JSON serializable document to store
+            fields (dict): extra values to keep with the document
+        Returns:
+            entry (dict): the stored entry
+        """
+        entry = dict(fields, data=data, stored=time.time())
+        ensure_path(self.path)
+        path = self.entry_path(key)
+        partial = f"{path}.{os.getpid()}.{threading.get_ident()}.partial"
+        with open(partial, "w") as f:
+            json.dump(entry, f)
+        os.replace(partial, path)
+        with self.lock:
+            self.memory[key] = (os.stat(path).st_mtime, entry)
+        return entry
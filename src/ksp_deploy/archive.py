@@ -0,0 +1,688 @@
+# Zip writing for release packages
+import os
+import io
+import bz2
+import time
+import shutil
+import stat
+import zlib
+import struct
+import hashlib
+import logging
+import tempfile
+import zipfile
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+from ksp_deploy.compression import CompressionPolicy, CompressionReport
+
+logger = logging.getLogger('packager.archive')
+
+ZIP64_LIMIT = 0xFFFFFFFF
+ZIP_FILECOUNT_LIMIT = 0xFFFF
+BLOCK_SIZE = 1024 * 1024
+SPOOL_SIZE = 16 * 1024 * 1024
+DEFAULT_LEVEL = 6
+
+FLAG_UTF8 = 0x800
+MADE_BY_UNIX = 3
+
+LOCAL_HEADER = struct.Struct("<4sHHHHHIIIHH")
+CENTRAL_HEADER = struct.Struct("<4sHHHHHHIIIHHHHHII")
+END_RECORD = struct.Struct("<4sHHHHIIH")
+ZIP64_END_RECORD = struct.Struct("<4sQHHIIQQQQ")
+ZIP64_END_LOCATOR = struct.Struct("<4sIQI")
+
+# Private extra field of the central directory recording the compression level of
+# an entry, so an incremental build only reuses data compressed at the level it needs
+LEVEL_EXTRA_ID = 0x4b4c
+LEVEL_EXTRA = struct.Struct("<HHB")
+
+
+class CompressedEntry(object):
+    """
+    A zip entry whose data has already been compressed. The same entry can be
+    written into any number of archives without compressing it again.
+    """
+
+    def __init__(self, method, crc, compress_size, file_size, date_time, external_attr,
+                 data=None, data_offset=0, is_dir=False, shared=False, spool_path=None, flags=0, level=None):
+        """
+        Inputs:
+            method (int): zipfile compression constant
+            crc (int): CRC-32 of the uncompressed data
+            compress_size (int): size of the compressed data
+            file_size (int): size of the uncompressed data
+            date_time (tuple): modification time as (year, month, day, hour, min, sec)
+            external_attr (int): zip external attributes
+            data (file): file object holding the compressed data
+            data_offset (int): where the compressed data starts in data
+            is_dir (bool): whether the entry is a directory
+            shared (bool): whether data belongs to someone else and must be left open
+            spool_path (str): temporary file holding data, removed when the entry is closed
+            flags (int): general purpose flags the compression method requires
+            level (int): the compression level, or None where the method has none
+        """
+        self.method = method
+        self.crc = crc
+        self.compress_size = compress_size
+        self.file_size = file_size
+        self.date_time = date_time
+        self.external_attr = external_attr
+        self.data = data
+        self.data_offset = data_offset
+        self.is_dir = is_dir
+        self.shared = shared
+        self.spool_path = spool_path
+        self.flags = flags
+        self.level = level
+        self.seconds = 0.0  # time spent compressing the data
+        self.digests = {}  # algorithm -> hex digest of the uncompressed data
+
+    def copy_to(self, write):
+        """
+        Passes the compressed data, block by block, to a write function
+
+        Inputs:
+            write (callable): called with each block of compressed data
+        """
+        if self.data is None:
+            return
+        self.data.seek(self.data_offset)
+        remaining = self.compress_size
+        while remaining > 0:
+            block = self.data.read(min(BLOCK_SIZE, remaining))
+            if not block:
+                raise zipfile.BadZipFile("Compressed data ended early")
+            write(block)
+            remaining -= len(block)
+
+    def close(self):
+        """Releases the compressed data"""
+        if self.data is not None and not self.shared:
+            self.data.close()
+        self.data = None
+        if self.spool_path is not None:
+            os.remove(self.spool_path)
+            self.spool_path = None
+
+
+def zip_date_time(path_stat):
+    """Returns the zip timestamp for a stat result, clamped to the range zip can hold"""
+    date_time = time.localtime(path_stat.st_mtime)[:6]
+    if date_time[0] < 1980:
+        return (1980, 1, 1, 0, 0, 0)
+    return date_time
+
+def directory_entry(path=None):
+    """
+    Creates the entry for a directory
+
+    Inputs:
+        path (str): the directory on disk, used for its timestamp and mode if given.
+            Directories that only exist in the archive get a fixed timestamp so
+            archives stay reproducible
+    Returns:
+        entry (CompressedEntry): the directory entry
+    """
+    if path is not None:
+        path_stat = os.stat(path)
+        date_time = zip_date_time(path_stat)
+        mode = stat.S_IMODE(path_stat.st_mode) | stat.S_IFDIR
+    else:
+        date_time = (1980, 1, 1, 0, 0, 0)
+        mode = 0o40775
+    return CompressedEntry(zipfile.ZIP_STORED, 0, 0, 0, date_time, (mode << 16) | 0x10, is_dir=True)
+
+def archive_comment(policy):
+    """
+    Returns the comment identifying archives written with a compression setup.
+    Compressed data can only be reused between archives with the same comment
+
+    Inputs:
+        policy (CompressionPolicy): the compression policy
+    """
+    return f"ksp_deploy policy-{policy.signature()} zlib-{zlib.ZLIB_RUNTIME_VERSION}".encode("ascii")
+
+def crc_file(path, algorithms=()):
+    """
+    Reads a file once to find its CRC-32, size and digests
+
+    Inputs:
+        path (str): the file
+        algorithms (list[str]): hashlib algorithms to digest the file with
+    Returns:
+        crc (int): the CRC-32
+        file_size (int): the size
+        digests (dict): algorithm -> hex digest
+    """
+    crc = 0
+    file_size = 0
+    hashes = [hashlib.new(algorithm) for algorithm in algorithms]
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(BLOCK_SIZE), b""):
+            crc = zlib.crc32(block, crc)
+            file_size += len(block)
+            for h in hashes:
+                h.update(block)
+    return crc, file_size, {h.name: h.hexdigest() for h in hashes}
+
+def store_file(path, algorithms=()):
+    """
+    Creates a stored entry that reads its data straight from the file
+
+    Inputs:
+        path (str): the file to store
+        algorithms (list[str]): hashlib algorithms to digest the file with
+    Returns:
+        entry (CompressedEntry): the stored entry
+    """
+    path_stat = os.stat(path)
+    start = time.perf_counter()
+    crc, file_size, digests = crc_file(path, algorithms)
+    entry = CompressedEntry(zipfile.ZIP_STORED, crc, file_size, file_size,
+                            zip_date_time(path_stat), (path_stat.st_mode & 0xFFFF) << 16, data=open(path, "rb"))
+    entry.seconds = time.perf_counter() - start
+    entry.digests = digests
+    return entry
+
+def compression_flags(method, level):
+    """
+    Returns the general purpose flags of an entry compressed with a method and level
+
+    Inputs:
+        method (int): zipfile compression constant
+        level (int): the compression level, or None where the method has none
+    """
+    if method == zipfile.ZIP_DEFLATED:
+        # Maximum, fast and super fast deflate are declared, other levels are normal
+        if level >= 8:
+            return 0x02
+        return {1: 0x06, 2: 0x04}.get(level, 0)
+    if method == zipfile.ZIP_LZMA:
+        # The stream is terminated by an end marker, which entries must declare
+        return 0x02
+    return 0
+
+def make_compressor(method, level):
+    """
+    Returns a compressor producing the data of a zip entry
+
+    Inputs:
+        method (int): zipfile.ZIP_DEFLATED, ZIP_BZIP2 or ZIP_LZMA
+        level (int): the compression level, ignored for lzma
+    Returns:
+        compressor (object): has compress(data) and flush() methods
+        flags (int): general purpose flags the entry needs
+    """
+    if method == zipfile.ZIP_DEFLATED:
+        compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+    elif method == zipfile.ZIP_BZIP2:
+        compressor = bz2.BZ2Compressor(level)
+    elif method == zipfile.ZIP_LZMA:
+        compressor = zipfile.LZMACompressor()
+    else:
+        raise ValueError(f"Unsupported compression method {method}")
+    return compressor, compression_flags(method, level)
+
+def compress_file(path, method=zipfile.ZIP_DEFLATED, level=DEFAULT_LEVEL, spool_dir=None, algorithms=()):
+    """
+    Compresses a file into a spool, reading it once. The digests of the file are
+    computed in the same pass
+
+    Inputs:
+        path (str): the file to compress
+        method (int): zipfile.ZIP_DEFLATED, ZIP_BZIP2 or ZIP_LZMA
+        level (int): the compression level
+        spool_dir (str): folder for compressed data too large to keep in memory
+        algorithms (list[str]): hashlib algorithms to digest the file with
+    Returns:
+        entry (CompressedEntry): the compressed entry
+    """
+    path_stat = os.stat(path)
+    start = time.perf_counter()
+    spool = tempfile.SpooledTemporaryFile(max_size=SPOOL_SIZE, dir=spool_dir)
+    compressor, flags = make_compressor(method, level)
+    crc = 0
+    file_size = 0
+    hashes = [hashlib.new(algorithm) for algorithm in algorithms]
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(BLOCK_SIZE), b""):
+            crc = zlib.crc32(block, crc)
+            file_size += len(block)
+            for h in hashes:
+                h.update(block)
+            spool.write(compressor.compress(block))
+    spool.write(compressor.flush())
+    entry = CompressedEntry(method, crc, spool.tell(), file_size,
+                            zip_date_time(path_stat), (path_stat.st_mode & 0xFFFF) << 16, data=spool, flags=flags,
+                            level=level if method != zipfile.ZIP_LZMA else None)
+    entry.seconds = time.perf_counter() - start
+    entry.digests = {h.name: h.hexdigest() for h in hashes}
+    return entry
+
+def compress_file_detached(path, method=zipfile.ZIP_DEFLATED, level=DEFAULT_LEVEL, spool_dir=None, algorithms=()):
+    """
+    Compresses a file in a worker process. Small results are sent back as bytes,
+    larger ones are left in a temporary file so they don't pass through the pipe
+
+    Inputs:
+        path (str): the file to compress
+        method (int): zipfile.ZIP_DEFLATED, ZIP_BZIP2 or ZIP_LZMA
+        level (int): the compression level
+        spool_dir (str): folder for compressed data too large to send back
+        algorithms (list[str]): hashlib algorithms to digest the file with
+    Returns:
+        result (tuple): the entry without its data, the data bytes or None, and
+            the temporary file holding the data or None
+    """
+    entry = compress_file(path, method, level, spool_dir, algorithms)
+    spool = entry.data
+    entry.data = None
+    spool.seek(0)
+    if entry.compress_size <= SPOOL_SIZE:
+        payload = spool.read()
+        spool.close()
+        return entry, payload, None
+    with tempfile.NamedTemporaryFile(dir=spool_dir, suffix=".zipdata", delete=False) as f:
+        try:
+            shutil.copyfileobj(spool, f, BLOCK_SIZE)
+        except BaseException:
+            f.close()
+            os.remove(f.name)
+            raise
+        finally:
+            spool.close()
+    return entry, None, f.name
+
+def attach_compressed(entry, payload, spool_path):
+    """Gives an entry returned by compress_file_detached its data back"""
+    if spool_path is not None:
+        entry.data = open(spool_path, "rb")
+        entry.spool_path = spool_path
+    else:
+        entry.data = io.BytesIO(payload)
+    return entry
+
+
+class ZipWriter(object):
+    """
+    Writes a standard zip archive from already compressed entries. Entries are
+    written sequentially and the file is never seeked, so the same input always
+    produces the same bytes. Zip64 records are only used where sizes, offsets
+    or the entry count require them. The archive's digests are computed from the
+    bytes as they are written.
+    """
+
+    def __init__(self, path, comment=b"", algorithms=()):
+        """
+        Inputs:
+            path (str): path of the zip to create
+            comment (bytes): the archive comment
+            algorithms (list[str]): hashlib algorithms to digest the archive with
+        """
+        self.path = path
+        self.comment = comment
+        self.fp = open(path, "wb")
+        self.offset = 0
+        self.central_directory = []
+        self.names = set()
+        self.hashes = [hashlib.new(algorithm) for algorithm in algorithms]
+
+    def write(self, arcname, entry):
+        """
+        Appends an entry
+
+        Inputs:
+            arcname (str): name of the entry in the archive
+            entry (CompressedEntry): the entry to write
+        """
+        if entry.is_dir and not arcname.endswith("/"):
+            arcname += "/"
+        if arcname in self.names:
+            raise ValueError(f"Duplicate entry {arcname} in {self.path}")
+        self.names.add(arcname)
+
+        try:
+            name = arcname.encode("ascii")
+            flags = entry.flags
+        except UnicodeEncodeError:
+            name = arcname.encode("utf-8")
+            flags = entry.flags | FLAG_UTF8
+
+        zip64 = entry.file_size >= ZIP64_LIMIT or entry.compress_size >= ZIP64_LIMIT
+        extra = b""
+        if zip64:
+            extra = struct.pack("<HHQQ", 0x0001, 16, entry.file_size, entry.compress_size)
+        version = self._version_needed(entry, zip64)
+        dos_time, dos_date = self._dos_date_time(entry.date_time)
+
+        header = LOCAL_HEADER.pack(
+            b"PK\x03\x04", version, flags, entry.method, dos_time, dos_date, entry.crc,
+            ZIP64_LIMIT if zip64 else entry.compress_size,
+            ZIP64_LIMIT if zip64 else entry.file_size,
+            len(name), len(extra))
+        header_offset = self.offset
+        self._write(header + name + extra)
+        entry.copy_to(self._write)
+        self.central_directory.append((name, flags, version, dos_time, dos_date, entry, header_offset))
+
+    def close(self):
+        """Writes the central directory and closes the archive"""
+        if self.fp is None:
+            return
+        start = self.offset
+        for name, flags, version, dos_time, dos_date, entry, header_offset in self.central_directory:
+            sizes = []
+            if entry.file_size >= ZIP64_LIMIT:
+                sizes.append(entry.file_size)
+            if entry.compress_size >= ZIP64_LIMIT:
+                sizes.append(entry.compress_size)
+            if header_offset >= ZIP64_LIMIT:
+                sizes.append(header_offset)
+            extra = b""
+            if sizes:
+                extra = struct.pack(f"<HH{len(sizes)}Q", 0x0001, 8 * len(sizes), *sizes)
+                version = max(version, 45)
+            if entry.level is not None:
+                extra += LEVEL_EXTRA.pack(LEVEL_EXTRA_ID, 1, entry.level)
+            self._write(CENTRAL_HEADER.pack(
+                b"PK\x01\x02", (MADE_BY_UNIX << 8) | version, version, flags, entry.method,
+                dos_time, dos_date, entry.crc,
+                min(entry.compress_size, ZIP64_LIMIT),
+                min(entry.file_size, ZIP64_LIMIT),
+                len(name), len(extra), 0, 0, 0, entry.external_attr,
+                min(header_offset, ZIP64_LIMIT)) + name + extra)
+
+        count = len(self.central_directory)
+        size = self.offset - start
+        if count > ZIP_FILECOUNT_LIMIT or size >= ZIP64_LIMIT or start >= ZIP64_LIMIT:
+            zip64_end = self.offset
+            self._write(ZIP64_END_RECORD.pack(
+                b"PK\x06\x06", ZIP64_END_RECORD.size - 12, 45, 45, 0, 0, count, count, size, start))
+            self._write(ZIP64_END_LOCATOR.pack(b"PK\x06\x07", 0, zip64_end, 1))
+        self._write(END_RECORD.pack(
+            b"PK\x05\x06", 0, 0,
+            min(count, ZIP_FILECOUNT_LIMIT), min(count, ZIP_FILECOUNT_LIMIT),
+            min(size, ZIP64_LIMIT), min(start, ZIP64_LIMIT), len(self.comment)) + self.comment)
+        self.fp.close()
+        self.fp = None
+
+    def digests(self):
+        """Returns the digests of the archive, algorithm -> hex digest, once it is closed"""
+        return {h.name: h.hexdigest() for h in self.hashes}
+
+    def entry_records(self):
+        """Returns the size, CRC-32 and digests of each file in the archive, by name"""
+        records = {}
+        for name, flags, version, dos_time, dos_date, entry, header_offset in self.central_directory:
+            if not entry.is_dir:
+                records[name.decode("utf-8")] = dict(entry.digests, size=entry.file_size, crc32=entry.crc)
+        return records
+
+    def _write(self, data):
+        self.fp.write(data)
+        self.offset += len(data)
+        for h in self.hashes:
+            h.update(data)
+
+    def _version_needed(self, entry, zip64):
+        versions = {zipfile.ZIP_DEFLATED: 20, zipfile.ZIP_BZIP2: 46, zipfile.ZIP_LZMA: 63}
+        version = 20 if entry.is_dir else versions.get(entry.method, 10)
+        if zip64:
+            version = max(version, 45)
+        return version
+
+    def _dos_date_time(self, date_time):
+        year, month, day, hour, minute, second = date_time
+        return (hour << 11) | (minute << 5) | (second // 2), ((year - 1980) << 9) | (month << 5) | day
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class ReferenceArchives(object):
+    """
+    The entries of previously written archives, indexed by content so their
+    compressed data can be copied into new archives instead of compressing the
+    same content again. Only archives whose comment matches the current
+    compression setup are used, and only entries compressed with the method and
+    level the policy chose for the new file, so a copied entry is identical to a
+    freshly compressed one.
+    """
+
+    def __init__(self, paths, comment):
+        """
+        Inputs:
+            paths (list[str]): the previous archives
+            comment (bytes): the archive comment of the current compression setup
+        """
+        self.files = []
+        self.index = {}
+        self.reused = 0
+        self.reused_bytes = 0
+        for path in paths:
+            try:
+                with zipfile.ZipFile(path, "r") as z:
+                    if z.comment != comment:
+                        logger.info(f"Not reusing entries from {path}, it was written with different settings")
+                        continue
+                    infos = z.infolist()
+            except (OSError, zipfile.BadZipFile) as err:
+                logger.warning(f"Not reusing entries from {path} ({err})")
+                continue
+            fp = open(path, "rb")
+            self.files.append(fp)
+            for info in infos:
+                if not info.is_dir():
+                    self.index.setdefault((info.CRC, info.file_size), []).append((fp, info))
+            logger.info(f"Indexed {len(infos)} entries of {path} for reuse")
+
+    def find(self, path, method, level, algorithms=()):
+        """
+        Finds a previously compressed copy of a file's content
+
+        Inputs:
+            path (str): the file to look for
+            method (int): zipfile compression constant the file is to be compressed with
+            level (int): the compression level, or None where the method has none
+            algorithms (list[str]): hashlib algorithms to digest the file with
+        Returns:
+            entry (CompressedEntry): the reusable entry, or None if the content is new
+                or was compressed differently
+        """
+        crc, file_size, digests = crc_file(path, algorithms)
+        if method == zipfile.ZIP_LZMA:
+            level = None
+        flags = compression_flags(method, level)
+        match = None
+        for fp, info in self.index.get((crc, file_size), []):
+            if info.compress_type == method and info.flag_bits & ~FLAG_UTF8 == flags and entry_level(info) == level:
+                match = (fp, info)
+                break
+        if match is None:
+            return None
+        fp, info = match
+        fp.seek(info.header_offset)
+        header = fp.read(LOCAL_HEADER.size)
+        name_length, extra_length = LOCAL_HEADER.unpack(header)[-2:]
+        path_stat = os.stat(path)
+        self.reused += 1
+        self.reused_bytes += file_size
+        entry = CompressedEntry(info.compress_type, crc, info.compress_size, file_size,
+                                zip_date_time(path_stat), (path_stat.st_mode & 0xFFFF) << 16,
+                                data=fp, data_offset=info.header_offset + LOCAL_HEADER.size + name_length + extra_length,
+                                shared=True, flags=flags, level=entry_level(info))
+        entry.digests = digests
+        return entry
+
+    def close(self):
+        """Closes the previous archives"""
+        for fp in self.files:
+            fp.close()
+        self.files = []
+
+def entry_level(info):
+    """Returns the compression level recorded for an entry of a previous archive, or None"""
+    extra = info.extra
+    offset = 0
+    while offset + 4 <= len(extra):
+        field_id, size = struct.unpack_from("<HH", extra, offset)
+        if field_id == LEVEL_EXTRA_ID and size == 1:
+            return extra[offset + 4]
+        offset += 4 + size
+    return None
+
+def write_archives(archives, spool_dir=None, policy=None, references=[], workers=1, parallel_threshold=0, algorithms=()):
+    """
+    Writes several zip archives that share files in a single pass. Each source file
+    is read and compressed once, and its compressed data is copied into every
+    archive that contains it. Parent directory entries are added automatically.
+
+    When previous archives are given, files whose content is unchanged are copied
+    from them as raw compressed data and only new or modified files are compressed.
+    The result is identical to writing the archives from scratch.
+
+    Each file is compressed as the compression policy decides. Without a policy,
+    everything is deflated at the default level.
+
+    Compression can be spread over a pool of worker processes. Entries are still
+    written in the same order, so the archives don't depend on the worker count.
+
+    With digest algorithms, every file is digested while it is read for compression
+    and every archive while it is written, so no file is read again to hash it.
+
+    Inputs:
+        archives (dict): maps the path of each zip to write to a dictionary of
+            archive name -> source path
+        spool_dir (str): folder for compressed data too large to keep in memory
+        policy (CompressionPolicy): decides how each file is compressed
+        references (list[str]): previously written archives to reuse entries from
+        workers (int): number of processes to compress with
+        parallel_threshold (int): total size in bytes below which compression stays
+            in this process regardless of workers
+        algorithms (list[str]): hashlib algorithms to digest files and archives with
+    Returns:
+        stats (dict): number of files compressed and reused, bytes read and written,
+            the CompressionReport of the policy's decisions, and under "archives"
+            the size, digests and entry records of each archive
+    """
+    users = {}
+    for zip_path, entries in archives.items():
+        for arcname, source in entries.items():
+            users.setdefault(source, []).append((zip_path, arcname.replace(os.sep, "/")))
+
+    # Files are processed in the name order of the largest archive, which keeps the
+    # entries of every archive sorted when the others are subsets of it
+    primary = max(archives, key=lambda zip_path: len(archives[zip_path]), default=None)
+    def order(source):
+        names = dict(users[source])
+        if primary in names:
+            return (0, names[primary])
+        return (1, min(names.values()))
+    sources = sorted(users, key=order)
+
+    if policy is None:
+        policy = CompressionPolicy(default=f"deflate-{DEFAULT_LEVEL}", rules={})
+    comment = archive_comment(policy)
+    previous = ReferenceArchives(references, comment)
+    report = CompressionReport()
+    stats = {"files": 0, "bytes_in": 0, "bytes_out": 0, "decisions": report}
+    writers = {zip_path: ZipWriter(zip_path, comment, algorithms) for zip_path in archives}
+    pool = None
+    if workers > 1:
+        total_size = sum(os.path.getsize(source) for source in sources if not os.path.isdir(source))
+        if total_size >= parallel_threshold:
+            pool = ProcessPoolExecutor(max_workers=workers)
+            logger.info(f"Compressing {total_size} bytes with {workers} processes")
+    prepared = _prepare_entries(sources, previous, policy, spool_dir, pool, workers, algorithms)
+    try:
+        for source, entry, decision, reused in prepared:
+            if decision is not None:
+                report.add(decision, entry.file_size, entry.compress_size, entry.seconds, reused=reused)
+            if decision is not None and not reused:
+                stats["files"] += 1
+                stats["bytes_in"] += entry.file_size
+                stats["bytes_out"] += entry.compress_size
+            try:
+                for zip_path, arcname in users[source]:
+                    _write_parents(writers[zip_path], arcname)
+                    if not (entry.is_dir and arcname.rstrip("/") + "/" in writers[zip_path].names):
+                        writers[zip_path].write(arcname, entry)
+            finally:
+                entry.close()
+    finally:
+        # Releases the entries prepared ahead of the writer if writing failed
+        prepared.close()
+        if pool is not None:
+            pool.shutdown(cancel_futures=True)
+        for writer in writers.values():
+            writer.close()
+        previous.close()
+    stats["reused"] = previous.reused
+    stats["reused_bytes"] = previous.reused_bytes
+    stats["archives"] = {zip_path: dict(writer.digests(), size=writer.offset, entries=writer.entry_records())
+                         for zip_path, writer in writers.items()}
+    return stats
+
+def _prepare_entries(sources, previous, policy, spool_dir, pool, workers, algorithms=()):
+    # Yields (source, entry, decision, reused) in source order, the decision being
+    # None for directories. With a pool, compression of the next few files runs
+    # ahead of the writer in the worker processes
+    pending = deque()
+    window = workers * 4 if pool is not None else 1
+    try:
+        for source in sources:
+            if os.path.isdir(source):
+                pending.append((source, directory_entry(source), None, False))
+                continue
+            decision, method, level = policy.decide(source)
+            entry = previous.find(source, method, level, algorithms) if previous.index else None
+            if entry is not None:
+                pending.append((source, entry, decision, True))
+            elif method == zipfile.ZIP_STORED:
+                pending.append((source, store_file(source, algorithms), decision, False))
+            elif pool is not None:
+                pending.append((source, pool.submit(compress_file_detached, source, method, level, spool_dir, algorithms), decision, False))
+            else:
+                pending.append((source, compress_file(source, method, level, spool_dir, algorithms), decision, False))
+            while len(pending) >= window:
+                yield _resolve(pending.popleft())
+        while pending:
+            yield _resolve(pending.popleft())
+    finally:
+        # Only left over when writing stopped early. Compression that hasn't started
+        # is cancelled, and the spools of files already compressed are removed
+        for _, entry, _, _ in pending:
+            if not isinstance(entry, CompressedEntry):
+                entry.cancel()
+        for _, entry, _, _ in pending:
+            _discard(entry)
+
+def _discard(entry):
+    # Releases an entry that won't be written, or the result of its compression
+    if isinstance(entry, CompressedEntry):
+        entry.close()
+    elif not entry.cancelled():
+        try:
+            attach_compressed(*entry.result()).close()
+        except Exception:
+            # Compression failed, and left no spool behind
+            pass
+
+def _resolve(item):
+    source, entry, decision, reused = item
+    if not isinstance(entry, CompressedEntry):
+        entry = attach_compressed(*entry.result())
+    return source, entry, decision, reused
+
+def _write_parents(writer, arcname):
+    # Adds any missing directory entries above an archive name, outermost first
+    parts = arcname.rstrip("/").split("/")[:-1]
+    for i in range(1, len(parts) + 1):
+        parent = "/".join(parts[:i]) + "/"
+        if parent not in writer.names:
+            writer.write(parent, directory_entry())
@@ -1,24 +1,196 @@
 # Useful functions for working with Amazon S3
-import boto3
-import botocore
+import os
+import time
+import hashlib
+import logging
+import threading
 from urllib.parse import urlparse
+from concurrent.futures import ThreadPoolExecutor
+
 from  ksp_deploy.config import KSPConfiguration
 
+logger = logging.getLogger('packager.s3')
+
+CHECKSUM_METADATA = "sha256"  # object metadata holding the SHA-256 of uploaded files
+
+_clients = {}
+_clients_lock = threading.Lock()
+
+
+class ChecksumMismatch(Exception):
+    """Raised when a transferred file doesn't match the checksum recorded with it"""
+    pass
+
+
+def get_client(config=None, region=None):
+    """
+    Returns the S3 client for a region, creating it on first use. Clients are
+    shared by all transfers and threads. boto3 is imported here rather than with
+    the module, as it is slow to import and most runs never touch S3
+
+    Inputs:
+        config (KSPConfiguration): config, the global configuration by default
+        region (str): AWS region, the configured region by default
+    Returns:
+        client (botocore.client.S3): the client
+    """
+    import boto3
+    import botocore.config
+
+    config = config or KSPConfiguration()
+    region = region or config.AWS_REGION
+    key = (region, config.S3_ENDPOINT_URL, config.ENABLE_SSL)
+    with _clients_lock:
+        if key not in _clients:
+            _clients[key] = boto3.client('s3',
+                region_name=region,
+                endpoint_url=config.S3_ENDPOINT_URL,
+                verify=config.ENABLE_SSL,
+                config=botocore.config.Config(max_pool_connections=max(10, config.S3_MAX_CONCURRENCY * 2)))
+        return _clients[key]
+
+def transfer_config(config=None):
+    """Returns the multipart settings for transfers"""
+    from boto3.s3.transfer import TransferConfig
+
+    config = config or KSPConfiguration()
+    return TransferConfig(
+        multipart_threshold=config.S3_MULTIPART_THRESHOLD_MB * 1024 * 1024,
+        multipart_chunksize=config.S3_MULTIPART_CHUNK_MB * 1024 * 1024,
+        max_concurrency=config.S3_MAX_CONCURRENCY)
+
+def parse_url(url):
+    """Returns the bucket and key of an s3:// url"""
+    url_parsed = urlparse(url)
+    return url_parsed.netloc, url_parsed.path[1:]
+
+def file_checksum(path):
+    """Returns the SHA-256 hex digest of a local file"""
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+def object_checksum(url, config=None):
+    """
+    Returns the SHA-256 recorded with an object when it was uploaded
+
+    Inputs:
+        url (str): s3:// url of the object
+        config (KSPConfiguration): config
+    Returns:
+        checksum (str): the hex digest, or None if the object doesn't exist or has no checksum
+    """
+    from botocore.exceptions import ClientError
+
+    bucket, key = parse_url(url)
+    try:
+        head = get_client(config).head_object(Bucket=bucket, Key=key)
+    except ClientError as err:
+        if err.response["Error"]["Code"] in ("404", "NoSuchKey", "NotFound"):
+            return None
+        raise
+    return head.get("Metadata", {}).get(CHECKSUM_METADATA)
 
-def copy(src, dest):
+def copy(src, dest, config=None, extra_args=None, checksum=None):
     """
     Copies a file to or from s3. If a link starts with s3: it will be treated
-    as an S3 path. Uses local AWS keys to do this
+    as an S3 path. Uses local AWS keys to do this.
+
+    Uploads record the SHA-256 of the file with the object, and downloads are
+    checked against it if S3_VERIFY_DOWNLOADS is set
 
     Inputs:
         src (str): url of source file
         dest (str): url of destination file
+        config (KSPConfiguration): config, the global configuration by default
+        extra_args (dict): extra arguments for the upload, like ContentType
+        checksum (str): SHA-256 of the file being uploaded, if already known. It is
+            recorded with the object even if checksums aren't verified
     """
-    config = KSPConfiguration()
-    s3 = boto3.client('s3', verify=config.ENABLE_SSL)
+    config = config or KSPConfiguration()
+    s3 = get_client(config)
+    start = time.perf_counter()
     if src.startswith("s3"):
-        url_parsed = urlparse(src)
-        s3.download_file(url_parsed.netloc, url_parsed.path[1:], dest)
+        bucket, key = parse_url(src)
+        s3.download_file(bucket, key, dest, Config=transfer_config(config))
+        size = os.path.getsize(dest)
+        if config.S3_VERIFY_DOWNLOADS:
+            expected = object_checksum(src, config)
+            if expected is not None and expected != file_checksum(dest):
+                raise ChecksumMismatch(f"{dest} doesn't match the checksum of {src}")
     if dest.startswith("s3"):
-        url_parsed = urlparse(dest)
-        s3.upload_file(src, url_parsed.netloc, url_parsed.path)
+        bucket, key = parse_url(dest)
+        size = os.path.getsize(src)
+        args = dict(extra_args or {})
+        if config.S3_VERIFY_CHECKSUMS or checksum is not None:
+            args["ChecksumAlgorithm"] = "SHA256"
+            args["Metadata"] = dict(args.get("Metadata", {}), **{CHECKSUM_METADATA: checksum or file_checksum(src)})
+        s3.upload_file(src, bucket, key, ExtraArgs=args, Config=transfer_config(config))
+    elapsed = time.perf_counter() - start
+    logger.info(f"Copied {src} to {dest}: {size} bytes in {elapsed:.2f}s "
+                f"({size / elapsed / 1024 / 1024 if elapsed > 0 else 0:.2f} MB/s)")
+
+def copy_many(pairs, config=None):
+    """
+    Copies many files to or from s3 at once
+
+    Inputs:
+        pairs (list[tuple]): (src, dest) urls of each copy
+        config (KSPConfiguration): config, the global configuration by default
+    """
+    config = config or KSPConfiguration()
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=max(1, config.S3_BATCH_WORKERS)) as pool:
+        for future in [pool.submit(copy, src, dest, config) for src, dest in pairs]:
+            future.result()
+    logger.info(f"Copied {len(pairs)} files in {time.perf_counter() - start:.2f}s")
+
+def upload_changed(pairs, config=None, extra_args=None, checksums=None):
+    """
+    Uploads files to s3, skipping those whose object already records the same
+    checksum. An unchanged file costs a HEAD request instead of an upload
+
+    Inputs:
+        pairs (list[tuple]): (local path, s3:// url) of each upload
+        config (KSPConfiguration): config, the global configuration by default
+        extra_args (dict): extra arguments for the uploads, like ContentType
+        checksums (dict): local path -> SHA-256 of files whose checksum is already known
+    Returns:
+        uploaded (list[str]): urls of the objects that were uploaded
+    """
+    config = config or KSPConfiguration()
+
+    def upload(src, dest):
+        checksum = (checksums or {}).get(src) or file_checksum(src)
+        if object_checksum(dest, config) == checksum:
+            logger.info(f"Skipping {src} as {dest} is up to date")
+            return False
+        copy(src, dest, config, extra_args, checksum)
+        return True
+
+    with ThreadPoolExecutor(max_workers=max(1, config.S3_BATCH_WORKERS)) as pool:
+        futures = [(dest, pool.submit(upload, src, dest)) for src, dest in pairs]
+        uploaded = [dest for dest, future in futures if future.result()]
+    logger.info(f"Uploaded {len(uploaded)} of {len(pairs)} files, {len(pairs) - len(uploaded)} were up to date")
+    return uploaded
+
+def iter_chunks(src, chunk_size=1024 * 1024, config=None):
+    """
+    Streams the contents of an S3 object
+
+    Inputs:
+        src (str): s3:// url of the object
+        chunk_size (int): size of the blocks to yield
+        config (KSPConfiguration): config, the global configuration by default
+    Returns:
+        chunks (generator[bytes]): the object's contents, in order
+    """
+    bucket, key = parse_url(src)
+    body = get_client(config).get_object(Bucket=bucket, Key=key)["Body"]
+    try:
+        for chunk in body.iter_chunks(chunk_size):
+            yield chunk
+    finally:
+        body.close()
@@ -1,9 +1,48 @@
-import boto3
+import threading
+
+GET_PARAMETERS_LIMIT = 10  # names accepted by a single GetParameters request
+
+_clients = {}
+_clients_lock = threading.Lock()
+
+
+def get_client(ssl=True, region="us-east-2"):
+    """Returns the SSM client for a region, creating it on first use"""
+    import boto3
+
+    with _clients_lock:
+        key = (ssl, region)
+        if key not in _clients:
+            _clients[key] = boto3.client('ssm', verify=ssl, region_name=region)
+        return _clients[key]
 
 def get_ssm_value(param_name, ssl=True, region="us-east-2"):
     """Gets the value of an encrypted parameter from the AWS SSM"""
-    client = boto3.client('ssm', verify=ssl, region_name=region)
+    client = get_client(ssl, region)
     try:
         return client.get_parameter(Name=param_name, WithDecryption=True)["Parameter"]["Value"]
     except KeyError:
         print("Couldn't find parameter")
+
+def get_ssm_values(param_names, ssl=True, region="us-east-2"):
+    """
+    Gets the values of several encrypted parameters from the AWS SSM, in as few
+    requests as possible
+
+    Inputs:
+        param_names (list[str]): names of the parameters
+        ssl (bool): whether to verify SSL certificates
+        region (str): AWS region
+    Returns:
+        values (dict): parameter name -> value, for the parameters that exist
+    """
+    client = get_client(ssl, region)
+    names = list(param_names)
+    values = {}
+    for i in range(0, len(names), GET_PARAMETERS_LIMIT):
+        response = client.get_parameters(Names=names[i:i + GET_PARAMETERS_LIMIT], WithDecryption=True)
+        for parameter in response["Parameters"]:
+            values[parameter["Name"]] = parameter["Value"]
+        for name in response.get("InvalidParameters", []):
+            print(f"Couldn't find parameter {name}")
+    return values
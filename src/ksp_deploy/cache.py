@@ -0,0 +1,219 @@
+# Persistent, two-tier cache for downloaded dependencies
+import os
+import json
+import hashlib
+import logging
+import threading
+import zipfile
+import zlib
+
+import ksp_deploy.aws.s3 as s3
+from ksp_deploy.helpers import ensure_path, file_lock
+
+logger = logging.getLogger('packager.cache')
+
+
+def dependency_cache_key(name, info):
+    """
+    Builds the cache key for a dependency record. The key is derived from the
+    source of the dependency and the pinned version, url or tag, so any change
+    to the record results in a new key
+
+    Inputs:
+        name (str): name of the dependency
+        info (dict): dictionary describing the dependency
+    Returns:
+        key (str): hex digest identifying the dependency
+    """
+    location = info["location"]
+    if location == "s3":
+        ident = info["version"]
+    elif location == "github":
+        ident = f"{info['repository']}@{info['tag']}"
+    elif location == "url":
+        ident = f"{info['url']}|zip={bool(info.get('zip', False))}"
+    else:
+        ident = json.dumps(info, sort_keys=True)
+    return hashlib.sha256(f"{location}:{name}:{ident}".encode("utf-8")).hexdigest()
+
+
+class DependencyCache(object):
+    """
+    Caches staged dependencies as zip archives. Each archive extracts into the
+    build path exactly as the original download would have.
+
+    The local tier lives on disk and is bounded in size, evicting the least
+    recently used entries first. It can be shared by several processes, like the
+    jobs of a batch: entries are opened and evicted under a file lock, and an
+    entry removed by another process is a miss, as is a damaged entry, which is
+    discarded. The optional shared tier lives in
+    the S3 dependency bucket and is consulted when the local tier misses.
+    """
+
+    def __init__(self, path, max_size, shared_url=None, config=None):
+        """
+        Inputs:
+            path (str): local cache directory
+            max_size (int): maximum size in bytes of the local tier
+            shared_url (str): s3:// prefix of the shared tier, or None to disable it
+            config (KSPConfiguration): config used to reach the shared tier, the global configuration by default
+        """
+        self.path = path
+        self.max_size = max_size
+        self.shared_url = shared_url
+        self.config = config
+        self.lock_path = os.path.join(path, ".lock")
+        self.hits = 0
+        self.shared_hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        ensure_path(self.path)
+
+    @classmethod
+    def from_config(cls, config):
+        """Creates the cache described by a KSPConfiguration, or None if caching is disabled"""
+        if not config.USE_DEPENDENCY_CACHE:
+            return None
+        shared_url = None
+        if config.USE_SHARED_CACHE:
+            shared_url = f"s3://{config.DEPENDENCY_BUCKET}/cache"
+        return cls(os.path.join(config.CACHE_PATH, "dependencies"),
+                   config.CACHE_MAX_SIZE_MB * 1024 * 1024,
+                   shared_url,
+                   config)
+
+    def entry_path(self, key):
+        """Returns the local path of the archive for a key"""
+        return os.path.join(self.path, f"{key}.zip")
+
+    def fetch(self, key, build_path):
+        """
+        Stages a cached dependency into the build path
+
+        Inputs:
+            key (str): cache key of the dependency
+            build_path (str): path to stage to
+        Returns:
+            hit (bool): whether the dependency was found in the cache
+        """
+        entry = self.entry_path(key)
+        archive = self._open_entry(entry)
+        shared = False
+        if archive is None and self.shared_url and self._fetch_shared(key, entry):
+            self.evict()
+            archive = self._open_entry(entry)
+            shared = True
+        if archive is not None:
+            try:
+                with archive:
+                    archive.extractall(build_path)
+            except (zipfile.BadZipFile, zlib.error, EOFError) as err:
+                # The dependency is downloaded again, over whatever was extracted
+                logger.warning(f"Discarding the damaged cache entry {key} ({err})")
+                self._discard(entry)
+                archive = None
+
+        with self.lock:
+            if archive is None:
+                self.misses += 1
+            elif shared:
+                self.shared_hits += 1
+            else:
+                self.hits += 1
+        return archive is not None
+
+    def _open_entry(self, entry):
+        # Opens an entry, touching it to mark it as recently used for eviction. This
+        # is done under the eviction lock, and an open entry stays readable if
+        # another process evicts it afterwards
+        with file_lock(self.lock_path):
+            try:
+                os.utime(entry)
+                return zipfile.ZipFile(entry, "r")
+            except FileNotFoundError:
+                return None
+            except zipfile.BadZipFile as err:
+                logger.warning(f"Discarding the damaged cache entry {entry} ({err})")
+                self._remove(entry)
+                return None
+
+    def _discard(self, entry):
+        # Removes a damaged entry, so later builds don't use it either
+        with file_lock(self.lock_path):
+            self._remove(entry)
+
+    def _remove(self, entry):
+        try:
+            os.remove(entry)
+        except FileNotFoundError:
+            pass
+
+    def store(self, key, archive):
+        """
+        Adds an archive to the cache under a key
+
+        Inputs:
+            key (str): cache key of the dependency
+            archive (str or file): zip that stages the dependency when extracted, either a
+                path or a file object positioned at the start of the archive
+        """
+        entry = self.entry_path(key)
+        partial = f"{entry}.{os.getpid()}.{threading.get_ident()}.partial"
+        src = archive if hasattr(archive, "read") else open(archive, "rb")
+        try:
+            with open(partial, "wb") as dest:
+                for chunk in iter(lambda: src.read(1024 * 1024), b""):
+                    dest.write(chunk)
+        finally:
+            if src is not archive:
+                src.close()
+        # Rename into place so concurrent builds never see a half written entry
+        os.replace(partial, entry)
+        logger.info(f"Cached dependency archive as {key}")
+
+        if self.shared_url:
+            from botocore.exceptions import ClientError
+            try:
+                s3.copy(entry, f"{self.shared_url}/{key}.zip", self.config)
+            except ClientError as err:
+                logger.warning(f"Couldn't push {key} to the shared cache ({err})")
+        self.evict()
+
+    def evict(self):
+        """Removes least recently used entries until the local tier fits within its size limit"""
+        with self.lock, file_lock(self.lock_path):
+            self._evict()
+
+    def _evict(self):
+        # Other processes can remove entries too, those already gone are skipped
+        entries = []
+        for name in os.listdir(self.path):
+            if name.endswith(".zip"):
+                try:
+                    stat = os.stat(os.path.join(self.path, name))
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, name))
+        total = sum(size for _, size, _ in entries)
+        for _, size, name in sorted(entries):
+            if total <= self.max_size:
+                break
+            logger.info(f"Evicting {name} from the dependency cache")
+            self._remove(os.path.join(self.path, name))
+            total -= size
+
+    def report(self):
+        """Logs the cache statistics for this run"""
+        logger.info(f"Dependency cache: {self.hits} local hits, {self.shared_hits} shared hits, {self.misses} misses")
+
+    def _fetch_shared(self, key, entry):
+        from botocore.exceptions import ClientError
+        partial = f"{entry}.{os.getpid()}.{threading.get_ident()}.partial"
+        try:
+            s3.copy(f"{self.shared_url}/{key}.zip", partial, self.config)
+        except ClientError:
+            if os.path.exists(partial):
+                os.remove(partial)
+            return False
+        os.replace(partial, entry)
+        return True
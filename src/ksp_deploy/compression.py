@@ -0,0 +1,167 @@
+# Choice of compression method for each file in a release
+import os
+import zlib
+import hashlib
+import zipfile
+import logging
+
+logger = logging.getLogger('packager.compression')
+
+AUTO = "auto"
+STORE = "store"
+SAMPLE_SIZE = 64 * 1024
+
+# Formats that are already compressed and gain next to nothing from deflate
+DEFAULT_RULES = {
+    ".png": STORE,
+    ".jpg": STORE,
+    ".jpeg": STORE,
+    ".ogg": STORE,
+    ".mp3": STORE,
+    ".zip": STORE,
+    ".7z": STORE,
+    ".gz": STORE,
+}
+
+
+def parse_method(spec):
+    """
+    Parses a compression method name
+
+    Inputs:
+        spec (str): store, deflate, deflate-1 to deflate-9, bzip2, bzip2-1 to bzip2-9 or lzma
+    Returns:
+        method (int): zipfile compression constant
+        level (int): compression level, or None where the method has none
+    """
+    name, _, level = spec.lower().partition("-")
+    if name == STORE and not level:
+        return zipfile.ZIP_STORED, None
+    if name == "lzma" and not level:
+        return zipfile.ZIP_LZMA, None
+    methods = {"deflate": (zipfile.ZIP_DEFLATED, 6), "bzip2": (zipfile.ZIP_BZIP2, 9)}
+    if name in methods:
+        method, default_level = methods[name]
+        if not level:
+            return method, default_level
+        if level.isdigit() and 1 <= int(level) <= 9:
+            return method, int(level)
+    raise ValueError(f"Unknown compression method {spec}")
+
+
+class CompressionPolicy(object):
+    """
+    Decides how each file of a release is compressed, from its extension or, in
+    automatic mode, from how well the start of the file deflates. Files that don't
+    compress are stored, which saves the time spent compressing them.
+    """
+
+    def __init__(self, default=AUTO, rules={}, auto_method="deflate-6", store_ratio=0.9):
+        """
+        Inputs:
+            default (str): method for files no rule matches, or auto
+            rules (dict): maps a file extension to a method or auto
+            auto_method (str): method used in automatic mode for files that compress
+            store_ratio (float): in automatic mode, files whose sample compresses to
+                more than this fraction of its size are stored
+        """
+        self.default = default
+        self.rules = {ext.lower(): spec for ext, spec in rules.items()}
+        self.auto_method = auto_method
+        self.store_ratio = store_ratio
+        # Check every method up front rather than on the first file that uses it
+        for spec in [default, auto_method] + list(self.rules.values()):
+            if spec != AUTO:
+                parse_method(spec)
+
+    @classmethod
+    def from_config(cls, config):
+        """Creates the policy described by the configuration"""
+        rules = dict(DEFAULT_RULES)
+        rules.update(config.COMPRESSION_RULES or {})
+        return cls(default=config.COMPRESSION_DEFAULT, rules=rules,
+                   auto_method=config.COMPRESSION_AUTO_METHOD,
+                   store_ratio=config.COMPRESSION_STORE_RATIO)
+
+    def signature(self):
+        """
+        Returns a short identifier of the policy. Two policies with the same
+        signature compress any file the same way
+        """
+        description = repr((self.default, sorted(self.rules.items()), self.auto_method, self.store_ratio))
+        return hashlib.sha1(description.encode("utf-8")).hexdigest()[:12]
+
+    def decide(self, path):
+        """
+        Chooses how to compress a file
+
+        Inputs:
+            path (str): the file
+        Returns:
+            decision (str): name of the choice, used to report on it
+            method (int): zipfile compression constant
+            level (int): compression level, or None where the method has none
+        """
+        ext = os.path.splitext(path)[1].lower()
+        spec = self.rules.get(ext, self.default)
+        if spec != AUTO:
+            label = f"{spec} ({ext})" if ext in self.rules else spec
+            return (label,) + parse_method(spec)
+        if self._sample_ratio(path) > self.store_ratio:
+            return (f"{STORE} (auto)",) + parse_method(STORE)
+        return (f"{self.auto_method} (auto)",) + parse_method(self.auto_method)
+
+    def _sample_ratio(self, path):
+        # Fast deflate of the first block of the file, compared to its size
+        with open(path, "rb") as f:
+            sample = f.read(SAMPLE_SIZE)
+        if not sample:
+            return 1.0
+        return len(zlib.compress(sample, 1)) / len(sample)
+
+
+class CompressionReport(object):
+    """Totals of the files, bytes and time behind each compression decision"""
+
+    def __init__(self):
+        self.decisions = {}
+
+    def add(self, decision, file_size, compress_size, seconds, reused=False):
+        """
+        Records one compressed file
+
+        Inputs:
+            decision (str): the decision returned by CompressionPolicy.decide
+            file_size (int): size of the file
+            compress_size (int): size of its data in the zip
+            seconds (float): time spent compressing it, or reading it for a reused file
+            reused (bool): whether the data was reused from a previous release
+        """
+        totals = self.decisions.setdefault(decision, {"files": 0, "bytes_in": 0, "bytes_out": 0, "seconds": 0.0,
+                                                      "reused": 0, "reused_bytes": 0})
+        totals["files"] += 1
+        totals["bytes_in"] += file_size
+        totals["bytes_out"] += compress_size
+        if reused:
+            totals["reused"] += 1
+            totals["reused_bytes"] += file_size
+        else:
+            totals["seconds"] += seconds
+
+    def log(self):
+        """
+        Logs the bytes saved by each decision. Time saved by storing files is
+        estimated from the speed deflate achieved on the rest of the release
+        """
+        deflated = [t for d, t in self.decisions.items() if d.startswith("deflate")]
+        deflate_seconds = sum(t["seconds"] for t in deflated)
+        speed = sum(t["bytes_in"] - t["reused_bytes"] for t in deflated) / deflate_seconds if deflate_seconds > 0 else None
+        for decision, totals in sorted(self.decisions.items()):
+            message = (f"{decision}: {totals['files']} files, {totals['bytes_in']} to {totals['bytes_out']} bytes "
+                       f"(saved {totals['bytes_in'] - totals['bytes_out']} bytes) in {totals['seconds']:.2f}s")
+            if totals["reused"]:
+                message += f", {totals['reused']} reused from the previous release"
+            if decision.startswith(STORE) and speed:
+                stored_bytes = totals["bytes_in"] - totals["reused_bytes"]
+                message += f", saved ~{max(0.0, stored_bytes / speed - totals['seconds']):.2f}s of deflate"
+            logger.info(message)
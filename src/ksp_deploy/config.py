@@ -1,5 +1,6 @@
 import os
-import yaml
+
+from ksp_deploy.helpers import load_yaml
 
 
 class KSPConfiguration:
@@ -11,12 +12,62 @@ class KSPConfiguration:
         DEPLOY_PATH = "deploy"
         BUILD_DATA_NAME = ".mod_data.yml"  # default path of the build data file
         CHANGELOG_PATH = "changelog.txt"  # name of the changelog file
+        CACHE_PATH = ".ksp_deploy_cache"  # persistent cache shared between runs
+
+        # Dependency cache
+        USE_DEPENDENCY_CACHE = True
+        CACHE_MAX_SIZE_MB = 2048  # size limit of the local cache tier
+        USE_SHARED_CACHE = False  # also use the cache/ prefix of the dependency bucket
+        DEPENDENCY_WORKERS = 4  # number of dependencies to download at once
+        STREAM_DEPENDENCIES = True  # extract zipped dependencies while they download
+        STREAM_SPOOL_THRESHOLD_MB = 64  # archives larger than this are spooled to disk instead of memory
+        RESOLVE_TRANSITIVE_DEPENDENCIES = True  # also collect the dependencies declared by GitHub dependencies
+
+        # Packaging
+        INCREMENTAL_PACKAGING = False  # reuse unchanged entries from the previous release zips
+        COMPRESSION_WORKERS = 0  # processes used to compress release zips, 0 for one per core
+        PARALLEL_COMPRESSION_MIN_MB = 32  # mods smaller than this are compressed in a single process
+        MATERIALIZE_BUILD_PATH = True  # link the staged release into BUILD_PATH after packaging
+        WRITE_MANIFEST = True  # write the checksums of the release zips and their files to a manifest
+        MANIFEST_BLAKE2 = False  # also record BLAKE2b digests in the manifest
+        COMPRESSION_DEFAULT = "auto"  # method for files without a compression rule
+        COMPRESSION_RULES = {}  # file extension -> method, added to the built in rules
+        COMPRESSION_AUTO_METHOD = "deflate-6"  # method for files that compress in auto mode
+        COMPRESSION_STORE_RATIO = 0.9  # in auto mode, files compressing worse than this are stored
+
+        # HTTP
+        HTTP_POOL_CONNECTIONS = 10  # number of hosts to keep connection pools for
+        HTTP_POOL_MAXSIZE = 10  # connections kept open per host
+        HTTP_CONNECT_TIMEOUT = 10  # seconds
+        HTTP_READ_TIMEOUT = 300  # seconds to wait for data from the server
+        HTTP_HOST_CONCURRENCY = {"spacedock.info": 2, "kerbal.curseforge.com": 2}  # host -> requests in flight at once
+
+        # Batches
+        BATCH_WORKERS = 4  # mods packaged at the same time, each in its own process
+
+        # Deploy
+        DEPLOY_TIMEOUT = 3600  # seconds to wait for all providers to finish deploying
+        RETRY_ATTEMPTS = 5  # attempts of each provider API request
+        RETRY_BACKOFF = 1.0  # base delay between attempts in seconds, doubled after each one
+        RETRY_MAX_DELAY = 300  # give up rather than wait longer than this for a rate limit
+        CURSEFORGE_VERSIONS_TTL = 2592000  # seconds to cache the CurseForge game version list
+        SPACEDOCK_CACHE_MAX_AGE = 0  # seconds a cached SpaceDock mod is used without revalidating it
 
         # AWS stuff
         DEPENDENCY_BUCKET = "nertea-ksp-modding-dependencies"  # where to look for dependencies
         AWS_REGION = "us-east-2"
         ENABLE_SSL = True
+        S3_ENDPOINT_URL = None  # alternative S3 endpoint, eg a local MinIO
+        S3_MULTIPART_THRESHOLD_MB = 64  # files larger than this are transferred in parts
+        S3_MULTIPART_CHUNK_MB = 16  # size of each part
+        S3_MAX_CONCURRENCY = 10  # parts transferred at once for each file
+        S3_BATCH_WORKERS = 4  # files transferred at once by batch copies
+        S3_VERIFY_CHECKSUMS = True  # record SHA-256 checksums on upload
+        S3_VERIFY_DOWNLOADS = False  # check downloads against the recorded checksum
         USE_SSM_CREDENTIALS = True
+        CREDENTIALS_BACKEND = None  # ssm, env or file. Defaults to ssm or env following USE_SSM_CREDENTIALS
+        CREDENTIALS_FILE = None  # YAML file of credentials for the file backend
+        CREDENTIALS_TTL = 900  # seconds to keep resolved credentials in memory
 
         # Mapping of credential names to SSM keys
         CRED_NAME_TO_KEYS = {
@@ -36,8 +87,8 @@ class KSPConfiguration:
         def _load_yaml_config(self, config_path):
             config_data = {}
             try:
-                with open(config_path, "r") as f:
-                  config_data = yaml.load(f)
+                # Parsed copies are kept in the default cache path, as the configured one isn't known yet
+                config_data = load_yaml(config_path, os.path.join(self.CACHE_PATH, "yaml")) or {}
             except IOError:
                 print ("No .deploy_config.yml file was found, defaults will be used")
 
@@ -46,10 +97,50 @@ class KSPConfiguration:
             self.DEPLOY_PATH = config_data.get("DEPLOY_PATH", "deploy")
             self.BUILD_DATA_NAME = config_data.get("BUILD_DATA_NAME", ".mod_data.yml")
             self.CHANGELOG_PATH = config_data.get("CHANGELOG_PATH", "changelog.txt")
+            self.CACHE_PATH = config_data.get("CACHE_PATH", ".ksp_deploy_cache")
+            self.USE_DEPENDENCY_CACHE = config_data.get("USE_DEPENDENCY_CACHE", True)
+            self.CACHE_MAX_SIZE_MB = config_data.get("CACHE_MAX_SIZE_MB", 2048)
+            self.USE_SHARED_CACHE = config_data.get("USE_SHARED_CACHE", False)
+            self.DEPENDENCY_WORKERS = config_data.get("DEPENDENCY_WORKERS", 4)
+            self.STREAM_DEPENDENCIES = config_data.get("STREAM_DEPENDENCIES", True)
+            self.STREAM_SPOOL_THRESHOLD_MB = config_data.get("STREAM_SPOOL_THRESHOLD_MB", 64)
+            self.RESOLVE_TRANSITIVE_DEPENDENCIES = config_data.get("RESOLVE_TRANSITIVE_DEPENDENCIES", True)
+            self.INCREMENTAL_PACKAGING = config_data.get("INCREMENTAL_PACKAGING", False)
+            self.COMPRESSION_WORKERS = config_data.get("COMPRESSION_WORKERS", 0)
+            self.PARALLEL_COMPRESSION_MIN_MB = config_data.get("PARALLEL_COMPRESSION_MIN_MB", 32)
+            self.MATERIALIZE_BUILD_PATH = config_data.get("MATERIALIZE_BUILD_PATH", True)
+            self.WRITE_MANIFEST = config_data.get("WRITE_MANIFEST", True)
+            self.MANIFEST_BLAKE2 = config_data.get("MANIFEST_BLAKE2", False)
+            self.COMPRESSION_DEFAULT = config_data.get("COMPRESSION_DEFAULT", "auto")
+            self.COMPRESSION_RULES = config_data.get("COMPRESSION_RULES", {})
+            self.COMPRESSION_AUTO_METHOD = config_data.get("COMPRESSION_AUTO_METHOD", "deflate-6")
+            self.COMPRESSION_STORE_RATIO = config_data.get("COMPRESSION_STORE_RATIO", 0.9)
+            self.HTTP_POOL_CONNECTIONS = config_data.get("HTTP_POOL_CONNECTIONS", 10)
+            self.HTTP_POOL_MAXSIZE = config_data.get("HTTP_POOL_MAXSIZE", 10)
+            self.HTTP_CONNECT_TIMEOUT = config_data.get("HTTP_CONNECT_TIMEOUT", 10)
+            self.HTTP_READ_TIMEOUT = config_data.get("HTTP_READ_TIMEOUT", 300)
+            self.HTTP_HOST_CONCURRENCY = config_data.get("HTTP_HOST_CONCURRENCY", {"spacedock.info": 2, "kerbal.curseforge.com": 2})
+            self.BATCH_WORKERS = config_data.get("BATCH_WORKERS", 4)
+            self.DEPLOY_TIMEOUT = config_data.get("DEPLOY_TIMEOUT", 3600)
+            self.RETRY_ATTEMPTS = config_data.get("RETRY_ATTEMPTS", 5)
+            self.RETRY_BACKOFF = config_data.get("RETRY_BACKOFF", 1.0)
+            self.RETRY_MAX_DELAY = config_data.get("RETRY_MAX_DELAY", 300)
+            self.CURSEFORGE_VERSIONS_TTL = config_data.get("CURSEFORGE_VERSIONS_TTL", 2592000)
+            self.SPACEDOCK_CACHE_MAX_AGE = config_data.get("SPACEDOCK_CACHE_MAX_AGE", 0)
             self.DEPENDENCY_BUCKET = config_data.get("DEPENDENCY_BUCKET", "nertea-ksp-modding-dependencies")
             self.AWS_REGION = config_data.get("AWS_REGION", "us-east-2")
             self.ENABLE_SSL = config_data.get("ENABLE_SSL", True)
+            self.S3_ENDPOINT_URL = config_data.get("S3_ENDPOINT_URL", None)
+            self.S3_MULTIPART_THRESHOLD_MB = config_data.get("S3_MULTIPART_THRESHOLD_MB", 64)
+            self.S3_MULTIPART_CHUNK_MB = config_data.get("S3_MULTIPART_CHUNK_MB", 16)
+            self.S3_MAX_CONCURRENCY = config_data.get("S3_MAX_CONCURRENCY", 10)
+            self.S3_BATCH_WORKERS = config_data.get("S3_BATCH_WORKERS", 4)
+            self.S3_VERIFY_CHECKSUMS = config_data.get("S3_VERIFY_CHECKSUMS", True)
+            self.S3_VERIFY_DOWNLOADS = config_data.get("S3_VERIFY_DOWNLOADS", False)
             self.USE_SSM_CREDENTIALS = config_data.get("USE_SSM_CREDENTIALS", True)
+            self.CREDENTIALS_BACKEND = config_data.get("CREDENTIALS_BACKEND", None)
+            self.CREDENTIALS_FILE = config_data.get("CREDENTIALS_FILE", None)
+            self.CREDENTIALS_TTL = config_data.get("CREDENTIALS_TTL", 900)
 
     instance = None
 
@@ -57,5 +148,27 @@ class KSPConfiguration:
         if not KSPConfiguration.instance:
             KSPConfiguration.instance = KSPConfiguration.__KSPConfiguration(config_path)
 
+    @classmethod
+    def for_job(cls, root, overrides=None):
+        """
+        Creates a configuration for one mod of a batch, separate from the global one.
+        Settings are read from the .ksp_deploy_config.yml in the mod's folder, and the
+        relative paths are resolved against that folder rather than the working directory
+
+        Inputs:
+            root (str): folder of the mod
+            overrides (dict): settings that replace the mod's own, like a shared CACHE_PATH
+        Returns:
+            config (KSPConfiguration): the configuration
+        """
+        config = object.__new__(cls)
+        # Set on the object, so it shadows the global instance
+        config.instance = cls.__KSPConfiguration(os.path.join(root, ".ksp_deploy_config.yml"))
+        for name in ("TEMP_PATH", "BUILD_PATH", "DEPLOY_PATH", "CACHE_PATH"):
+            setattr(config.instance, name, os.path.join(root, getattr(config.instance, name)))
+        for name, value in (overrides or {}).items():
+            setattr(config.instance, name, value)
+        return config
+
     def __getattr__(self, name):
         return getattr(self.instance, name)
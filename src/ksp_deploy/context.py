@@ -0,0 +1,41 @@
+# Inputs of a build, shared by the stage, package and deploy steps
+import os
+
+from ksp_deploy.config import KSPConfiguration
+from ksp_deploy.helpers import get_build_data, get_version_file_info, get_version
+
+
+class BuildContext(object):
+    """
+    Holds the configuration, build data and version data of a mod, each parsed
+    once. The entry points create one for themselves; the pipeline creates one
+    and passes it to every step, along with the zips written by packaging
+    """
+
+    def __init__(self, mod_data_file="", config=None):
+        """
+        Inputs:
+            mod_data_file (str): path to mod data yaml (defaults to the one in ksp_deploy.config.py)
+            config (KSPConfiguration): config, the global configuration by default
+        """
+        self.config = config or KSPConfiguration()
+        if mod_data_file == "":
+            mod_data_file = self.config.BUILD_DATA_NAME
+        self.mod_data_file = mod_data_file
+        self.build_data = get_build_data(mod_data_file, os.path.join(self.config.CACHE_PATH, "yaml"))
+        self.version_data = get_version_file_info(os.path.join(self.mod_path, "GameData", self.mod_name), self.mod_name)
+
+    @property
+    def mod_path(self):
+        """Returns the folder holding the mod data file"""
+        return os.path.dirname(self.mod_data_file)
+
+    @property
+    def mod_name(self):
+        """Returns the name of the mod"""
+        return self.build_data['mod-name']
+
+    @property
+    def version(self):
+        """Returns the formatted version of the mod"""
+        return get_version(self.version_data)
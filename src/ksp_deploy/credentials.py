@@ -1,10 +1,116 @@
 import os
-from ksp_deploy.aws.ssm import get_ssm_value
+import time
+import threading
 
+import yaml
+
+from ksp_deploy.aws.ssm import get_ssm_values
+
+_stores = {}
+_stores_lock = threading.Lock()
+
+
+class CredentialStore(object):
+    """
+    Resolves credentials by name from AWS SSM, environment variables or a local
+    file. All the configured credentials are resolved together on first use, in
+    a single batched request for SSM, and kept in memory until the TTL runs out
+    or the store is wiped.
+    """
+
+    def __init__(self, backend, names_to_keys, ttl=900, ssl=True, region="us-east-2", path=None):
+        """
+        Inputs:
+            backend (str): ssm, env or file
+            names_to_keys (dict): credential name -> SSM parameter name
+            ttl (float): seconds to keep resolved credentials
+            ssl (bool): whether to verify SSL certificates when calling SSM
+            region (str): AWS region of SSM
+            path (str): YAML file of credential name -> value, for the file backend
+        """
+        if backend not in ("ssm", "env", "file"):
+            raise ValueError(f"Unknown credentials backend {backend}")
+        self.backend = backend
+        self.names_to_keys = dict(names_to_keys)
+        self.ttl = ttl
+        self.ssl = ssl
+        self.region = region
+        self.path = path
+        self.values = {}
+        self.resolved_names = set()
+        self.resolved_at = None
+        self.lock = threading.Lock()
+
+    @classmethod
+    def from_config(cls, config):
+        """Creates the store described by the configuration"""
+        backend = config.CREDENTIALS_BACKEND or ("ssm" if config.USE_SSM_CREDENTIALS else "env")
+        return cls(backend, config.CRED_NAME_TO_KEYS, ttl=config.CREDENTIALS_TTL,
+                   ssl=config.ENABLE_SSL, region=config.AWS_REGION, path=config.CREDENTIALS_FILE)
+
+    def get(self, name):
+        """
+        Returns a credential
+
+        Inputs:
+            name (str): the name of the credential, eg GITHUB_USER
+        Returns:
+            value (str): the credential
+        """
+        with self.lock:
+            expired = self.resolved_at is None or time.monotonic() - self.resolved_at > self.ttl
+            if expired or name not in self.resolved_names:
+                self._resolve(name)
+            if name not in self.values:
+                raise KeyError(name)
+            return self.values[name]
+
+    def wipe(self):
+        """Forgets all resolved credentials"""
+        with self.lock:
+            for name in list(self.values):
+                self.values[name] = None
+            self.values.clear()
+            self.resolved_names = set()
+            self.resolved_at = None
+
+    def _resolve(self, name):
+        # Resolves every configured credential at once, plus the one asked for
+        names = set(self.names_to_keys) | {name}
+        if self.backend == "ssm":
+            keys = {n: self.names_to_keys[n] for n in names if n in self.names_to_keys}
+            values = get_ssm_values(sorted(set(keys.values())), self.ssl, self.region)
+            resolved = {n: values[key] for n, key in keys.items() if key in values}
+        elif self.backend == "file":
+            with open(self.path, "r") as f:
+                data = yaml.safe_load(f) or {}
+            resolved = {n: str(data[n]) for n in names if data.get(n) is not None}
+        else:
+            resolved = {n: os.environ[n] for n in names if n in os.environ}
+        self.values = resolved
+        self.resolved_names = names
+        self.resolved_at = time.monotonic()
+
+
+def get_credential_store(config):
+    """
+    Returns the credential store for a configuration, shared by all callers in
+    the process that use the same settings
+
+    Inputs:
+        config (KSPConfiguration): instance of config class
+    Returns:
+        store (CredentialStore): the store
+    """
+    store = CredentialStore.from_config(config)
+    key = (store.backend, store.region, store.ssl, store.path, store.ttl,
+           tuple(sorted(store.names_to_keys.items())))
+    with _stores_lock:
+        return _stores.setdefault(key, store)
 
 def find_credentials(credential_name, config):
     """
-    Finds a credential item, either from AWS SSM or from environment variables
+    Finds a credential item, either from AWS SSM, environment variables or a credentials file
 
     Inputs:
         credential_name (string): the name of the credential to fetch
@@ -13,9 +119,6 @@ def find_credentials(credential_name, config):
         credential_value (string): the value of the credential
     """
     try:
-        if config.USE_SSM_CREDENTIALS:
-            return get_ssm_value(config.CRED_NAME_TO_KEYS[credential_name], config.ENABLE_SSL, config.AWS_REGION)
-        else:
-            return os.environ[credential_name]
-    except:
+        return get_credential_store(config).get(credential_name)
+    except Exception:
         print(f"Error fetching {credential_name}")
@@ -1,29 +1,37 @@
 # Class for accessing the CurseForge API
+import os
 import requests
 import logging
 from contextlib import closing
 import json
 
+from ksp_deploy.uploads import MultipartBody, UploadProgress
+from ksp_deploy.retry import RetryPolicy
+from ksp_deploy.sessions import get_session, is_shared
+
 class CurseForgeAPI(object):
 
     base_url = "https://kerbal.curseforge.com"
     versions_url = "api/game/versions"
     upload_file_url = "api/projects/{mod_id}/upload-file"
 
-    def __init__(self, token, session=None):
+    def __init__(self, token, session=None, retry=None, cache=None, versions_ttl=30 * 24 * 3600):
         """
         Initializes the API session
 
         Inputs:
             token (str): Curse authentication token
+            retry (RetryPolicy): how to retry failed requests
+            cache (APICache): where to keep the game version list between runs, if anywhere
+            versions_ttl (float): seconds before the cached game version list is refreshed
         """
         self.auth_token = token
         self.logger = logging.getLogger('deploy.curseforge')
+        self.retry = retry or RetryPolicy("CurseForge")
+        self.cache = cache
+        self.versions_ttl = versions_ttl
 
-        if isinstance(session, requests.Session):
-            self.session = session
-        else:
-            self.session = requests.Session()
+        self.session = session if isinstance(session, requests.Session) else get_session()
 
     def query_version(self):
         """
@@ -31,7 +39,7 @@ class CurseForgeAPI(object):
         """
         url = f'{self.base_url}/{self.versions_url}'
         headers = {'X-Api-Token': self.auth_token}
-        with closing(self.session.get(url, headers=headers)) as resp:
+        with closing(self.retry.call(lambda: self.session.get(url, headers=headers))) as resp:
             try:
                 return resp.json()
             except requests.exceptions.HTTPError as err:
@@ -41,30 +49,55 @@ class CurseForgeAPI(object):
 
     def get_curse_game_version_id(self, game_version):
         """
-        Gets the curse version id by querying the API and comparing to the provided
-        ID
+        Gets the curse version id from an index of the game versions. The index is
+        cached, and only refreshed from the API when it is older than the TTL or
+        doesn't know the version
 
         Inputs:
             game_version (str): the string game version to match
         Returns:
             curse_version (int): the integer curse version
         """
-        versions = self.query_version()
-        curse_version = None
-        for version in versions:
-            if version["name"] == game_version:
-                curse_version = version["id"]
-                self.logger.info(f"Found curse version {curse_version} from string version {game_version}")
-
-        if curse_version is None:
-            curse_version = versions[-1]["id"]
+        index, fresh = self.get_version_index()
+        if game_version not in index["ids"] and not fresh:
+            self.logger.info(f"Game version {game_version} isn't in the cached version list, refreshing it")
+            index, fresh = self.get_version_index(refresh=True)
+
+        curse_version = index["ids"].get(game_version)
+        if curse_version is not None:
+            self.logger.info(f"Found curse version {curse_version} from string version {game_version}")
+        else:
+            curse_version = index["latest"]
             print(f"Couldn't determine curse version from game version {game_version}, using latest version {curse_version}")
 
         return curse_version
 
+    def get_version_index(self, refresh=False):
+        """
+        Returns the game versions indexed by name
+
+        Inputs:
+            refresh (bool): whether to query the API even if the cache is fresh
+        Returns:
+            index (dict): version name -> id under "ids", and the latest id under "latest"
+            fresh (bool): whether the index was just fetched from the API
+        """
+        key = f"{self.base_url}/{self.versions_url}"
+        if self.cache is not None and not refresh:
+            entry = self.cache.get(key, self.versions_ttl)
+            if entry is not None:
+                return entry["data"], False
+
+        versions = self.query_version()
+        # Later entries win, as when the list was scanned to the end
+        index = {"ids": {version["name"]: version["id"] for version in versions}, "latest": versions[-1]["id"]}
+        if self.cache is not None:
+            self.cache.put(key, index)
+        return index, True
+
     def update_mod(self, mod_id, changelog, game_version, releaseType, zip):
         """
-        Updates a mod by hitting the project upload files API
+        Updates a mod by hitting the project upload files API. The zip is streamed from disk
 
         Inputs:
             mod_id (str): the curseforge project ID
@@ -72,6 +105,8 @@ class CurseForgeAPI(object):
             game_version (str): the string game version to use
             releaseType (str): One of alpha, beta, release
             zip (str): the path of the zip to upload
+        Returns:
+            response (str): the text of the response, raises HTTPError if the upload failed
         """
         curse_version = int(self.get_curse_game_version_id(game_version))
         url = f'{self.base_url}/{self.upload_file_url}'.format(mod_id=mod_id)
@@ -84,18 +119,21 @@ class CurseForgeAPI(object):
         self.logger.info(f"File metadata {metadata}, zip {zip}")
         headers = {'X-Api-Token': self.auth_token}
         self.logger.info(f"Posting {metadata} to {url}")
+        def send():
+            with MultipartBody({'metadata': json.dumps(metadata)}, {'file': zip}) as body:
+                body.progress = UploadProgress(os.path.basename(zip), len(body), log=self.logger)
+                return self.session.post(url, data=body, headers=dict(headers, **{'Content-Type': body.content_type}))
         try:
-            resp = self.session.post(url,
-                files={'file': open(zip, 'rb')},
-                data={'metadata': json.dumps(metadata)},
-                headers=headers)
+            # CurseForge can't be asked whether an upload landed, so the upload is only
+            # retried when the server rejected it outright
+            resp = self.retry.call(send, idempotent=False, size=os.path.getsize(zip))
             resp.raise_for_status()
             self.logger.info(f"{resp.url} returned {resp.text}")
             return resp.text
         except requests.exceptions.HTTPError as err:
             self.logger.error(f"HTTP ERROR: {err}")
             self.logger.error(f"{resp.url} returned {resp.text}")
-            return resp.text
+            raise
 
     def login(self):
         """Unneeded"""
@@ -106,7 +144,8 @@ class CurseForgeAPI(object):
         pass
 
     def close(self):
-        self.session.close()
+        if not is_shared(self.session):
+            self.session.close()
 
     def __enter__(self):
         self.login()
@@ -5,14 +5,17 @@ import zlib
 import logging
 from urllib.parse import urlparse
 import shutil
-import requests
 
 import ksp_deploy.aws.s3 as s3
+from ksp_deploy.sessions import get_session
+from ksp_deploy.cache import dependency_cache_key
+from ksp_deploy.streaming import stream_extract
+from ksp_deploy.mirror import GitMirror
 
 logger = logging.getLogger('packager.dependencies')
 
 
-def download_dependency(name, info, temp_path, build_path, config):
+def download_dependency(name, info, temp_path, build_path, config, cache=None):
     """
     Downloads a dependency record from either S3 (external dependency) or github (internal dependency)
 
@@ -22,18 +25,31 @@ def download_dependency(name, info, temp_path, build_path, config):
         temp_path (str): path to store dependency zips to
         build_path (str): path to stage to
         config (KSPConfiguration): config
+        cache (DependencyCache): cache to consult before downloading, if any
     """
+    if cache is not None:
+        key = dependency_cache_key(name, info)
+        if cache.fetch(key, build_path):
+            logger.info(f"Collected {name} from the dependency cache")
+            return
+
+    archive = None
     if info["location"] == "s3":
         logger.info(f"Collecting {name} {info['version']} from S3")
-        download_dependency_s3(name, info["version"], temp_path, build_path, config)
+        archive = download_dependency_s3(name, info["version"], temp_path, build_path, config)
 
     if info["location"] == "github":
         logger.info(f"Collecting {name} at tag {info['tag']} from repository {info['repository']}")
-        download_dependency_github(name, info['repository'], info["tag"], temp_path, build_path, config)
+        archive = download_dependency_github(name, info['repository'], info["tag"], temp_path, build_path, config)
 
     if info["location"] == "url":
         logger.info(f"Collecting {name} at from {info['url']}")
-        download_dependency_url(name, info['url'], temp_path, build_path, config, zip=info.get("zip", False))
+        archive = download_dependency_url(name, info['url'], temp_path, build_path, config, zip=info.get("zip", False))
+
+    if cache is not None and archive is not None:
+        cache.store(key, archive)
+    if hasattr(archive, "close"):
+        archive.close()
 
 def download_dependency_s3(name, version, temp_path, build_path, config):
     """
@@ -46,13 +62,22 @@ def download_dependency_s3(name, version, temp_path, build_path, config):
         temp_path (str): path to store dependency zips to
         build_path (str): path to stage to
         config (KSPConfiguration): config
+    Returns:
+        archive (str or file): zip that reproduces the staged dependency
     """
     target_name = os.path.join(temp_path, f"{name}_{version}.zip")
     logger.info(f"Pulling s3://{config.DEPENDENCY_BUCKET}/external/{name}_{version}.zip")
-    s3.copy(f"s3://{config.DEPENDENCY_BUCKET}/external/{name}_{version}.zip", target_name)
+    if config.STREAM_DEPENDENCIES:
+        return stream_extract(
+            s3.iter_chunks(f"s3://{config.DEPENDENCY_BUCKET}/external/{name}_{version}.zip", config=config),
+            build_path,
+            config.STREAM_SPOOL_THRESHOLD_MB * 1024 * 1024,
+            temp_path)
+    s3.copy(f"s3://{config.DEPENDENCY_BUCKET}/external/{name}_{version}.zip", target_name, config)
 
     with zipfile.ZipFile(target_name, "r") as z:
         z.extractall(build_path)
+    return target_name
 
 def download_dependency_url(name, url, temp_path, build_path, config, zip=True):
     """
@@ -65,23 +90,35 @@ def download_dependency_url(name, url, temp_path, build_path, config, zip=True):
         build_path (str): path to stage to
         zip (bool): is the target file a zip of standard format?
         config (KSPConfiguration): config
+    Returns:
+        archive (str or file): zip that reproduces the staged dependency
     """
     parsed = urlparse(url)
     fn = os.path.basename(parsed.path)
     target_name = os.path.join(temp_path, fn)
+    if zip and config.STREAM_DEPENDENCIES:
+        logger.info(f"Streaming {url} into {build_path}")
+        with get_session(config).get(url, stream=True, verify=False) as r:
+            r.raise_for_status()
+            return stream_extract(r.iter_content(chunk_size=1024 * 1024), build_path,
+                                  config.STREAM_SPOOL_THRESHOLD_MB * 1024 * 1024, temp_path)
+
     logger.info(f"Downloading {url} to {target_name}")
 
-    download_file(url, target_name)
+    download_file(url, target_name, get_session(config))
 
     if zip:
         with zipfile.ZipFile(target_name, "r") as z:
             z.extractall(build_path)
+        return target_name
     else:
         shutil.copy(target_name, os.path.join(build_path, "GameData"))
+        return archive_staged(build_path, [os.path.join("GameData", fn)], f"{target_name}.staged.zip")
 
 def download_dependency_github(name, repo, tag, temp_path, build_path, config):
     """
-    Downloads a github repo with a specific tag
+    Downloads the GameData folder of a github repo at a specific tag. Only the tag is
+    fetched, at depth 1, into a local bare mirror that is reused between runs
 
     Inputs:
         name (str): name of the dependency
@@ -90,25 +127,53 @@ def download_dependency_github(name, repo, tag, temp_path, build_path, config):
         temp_path (str): path to store dependency zips to
         build_path (str): path to stage to
         config (KSPConfiguration): config
+    Returns:
+        archive (str): path of a zip that reproduces the staged dependency
+    """
+    mirror = GitMirror.from_config(repo, config)
+    mirror.ensure_tag(tag)
+    # Export only GameData/<name> from the tagged tree into the build directory
+    mirror.export(tag, f"GameData/{name}", build_path)
+    return archive_staged(build_path, [os.path.join("GameData", name)], os.path.join(temp_path, f"{name}_{tag}.staged.zip"))
+
+def archive_staged(build_path, staged_items, archive):
+    """
+    Packs staged files and folders into an uncompressed zip rooted at the build path, so
+    the dependency can be staged again later by extracting it
+
+    Inputs:
+        build_path (str): path the items were staged to
+        staged_items (list[str]): paths of the staged items, relative to the build path
+        archive (str): path of the zip to write
+    Returns:
+        archive (str): path of the written zip
+    """
+    with zipfile.ZipFile(archive, "w", zipfile.ZIP_STORED) as z:
+        for item in staged_items:
+            item_path = os.path.join(build_path, item)
+            if os.path.isfile(item_path):
+                z.write(item_path, item)
+            for root, dirs, files in os.walk(item_path):
+                for fn in files:
+                    path = os.path.join(root, fn)
+                    z.write(path, os.path.relpath(path, build_path))
+    return archive
+
+
+def download_file(url, local_filename, session=None):
+    """
+    Downloads a url to a file
+
+    Inputs:
+        url (str): the url
+        local_filename (str): path to write to
+        session (requests.Session): session to download with, the shared one by default
     """
-    wp = os.getcwd()
-    os.chdir(temp_path)
-    # Clone into the repo, pull the specified tag
-    clone_cmd = f"git clone https://github.com/{repo}.git"
-    tag_cmd = f"git checkout master && git fetch && git fetch --tags && git checkout {tag}"
-    os.system(clone_cmd)
-    os.chdir(name)
-    os.system(tag_cmd)
-    os.chdir(wp)
-    # Move the contents of GameData into the build directory
-    shutil.copytree(os.path.join(temp_path, name, "GameData", name), os.path.join(build_path, "GameData", name))
-
-
-def download_file(url, local_filename):
-    with requests.get(url, stream=True, verify=False) as r:
+    session = session or get_session()
+    with session.get(url, stream=True, verify=False) as r:
         r.raise_for_status()
         with open(local_filename, 'wb') as f:
-            for chunk in r.iter_content(chunk_size=8192):
+            for chunk in r.iter_content(chunk_size=1024 * 1024):
                 if chunk: # filter out keep-alive new chunks
                     f.write(chunk)
     return local_filename
@@ -7,6 +7,10 @@ from contextlib import closing
 import requests
 from requests.auth import HTTPBasicAuth
 
+from ksp_deploy.uploads import StreamingBody, UploadProgress
+from ksp_deploy.retry import RetryPolicy
+from ksp_deploy.sessions import get_session, is_shared
+
 
 class GitHubReleasesAPI(object):
 
@@ -14,10 +18,12 @@ class GitHubReleasesAPI(object):
     login_url = "api/login"
     create_release_url = "repos/{owner}/{repo}/releases"
     latest_release_url = "repos/{owner}/{repo}/releases/latest"
+    release_by_tag_url = "repos/{owner}/{repo}/releases/tags/{tag}"
     list_release_assets_url = "repos/{owner}/{repo}/releases/{release_id}/assets"
+    asset_url = "repos/{owner}/{repo}/releases/assets/{asset_id}"
     release_base_url = "https://uploads.github.com/repos/{owner}/{repo}/releases/{release_id}/assets"
 
-    def __init__(self, username, token, repo_slug, session=None, verify=True):
+    def __init__(self, username, token, repo_slug, session=None, verify=True, retry=None, cache=None):
         """
         Initializes the API session
 
@@ -25,16 +31,19 @@ class GitHubReleasesAPI(object):
             username (str): Github user name
             token (str): Oauth token
             repo_slug (str): Github repo slug of the form org/repo
+            retry (RetryPolicy): how to retry failed requests
+            cache (APICache): where to keep responses for revalidation between runs. Without
+                one, responses are only revalidated within the session
         """
         self.verify = verify
         self.credentials = {"username":username, "token":token}
         self.logger = logging.getLogger('deploy.github')
         self.owner, self.repo = repo_slug.split('/')
+        self.retry = retry or RetryPolicy("GitHub")
+        self.cache = cache
+        self.responses = {}
 
-        if isinstance(session, requests.Session):
-            self.session = session
-        else:
-            self.session =requests.Session()
+        self.session = session if isinstance(session, requests.Session) else get_session()
 
     def get_latest_release(self):
         """
@@ -52,12 +61,12 @@ class GitHubReleasesAPI(object):
         }
 
         try:
-            resp = self.session.get(url,
+            resp = self.retry.call(lambda: self.session.get(url,
                 verify=self.verify,
                 headers=headers,
                 auth=HTTPBasicAuth(
                     self.credentials["username"],
-                    self.credentials["token"]))
+                    self.credentials["token"])))
             resp.raise_for_status()
             return resp.json()
         except requests.exceptions.HTTPError as err:
@@ -65,37 +74,99 @@ class GitHubReleasesAPI(object):
             self.logger.error(f"{resp.url} returned {resp.text}")
             return resp.text
 
+    def get_release_by_tag(self, tag):
+        """
+        Gets the release of a tag
+
+        Inputs:
+            tag (str): the tag
+        Returns:
+            response (dict): json describing the release, or None if there is no release for the tag
+        """
+        url = f'{self.base_url}/{self.release_by_tag_url}'.format(
+            owner=self.owner, repo=self.repo, tag=tag)
+        try:
+            release, _ = self._conditional_get(url)
+            return release
+        except requests.exceptions.HTTPError as err:
+            if err.response is not None and err.response.status_code == 404:
+                return None
+            raise
+
+    def iter_release_assets(self, id, per_page=100):
+        """
+        Lists a release's assets, fetching further pages only as they are needed
+
+        Inputs:
+            id (int): the github release's ID
+            per_page (int): number of assets to fetch per request
+        Returns:
+            assets (generator): the assets of the release
+        """
+        url = f'{self.base_url}/{self.list_release_assets_url}'.format(
+            owner=self.owner, repo=self.repo, release_id=id) + f"?per_page={per_page}"
+        while url is not None:
+            assets, url = self._conditional_get(url)
+            yield from assets
+
     def get_release_assets(self, id):
         """
         Lists a release assets
 
         Inputs:
             id (int): the github release's ID
-            changelog (str): a Markdown-formatted changelog
         Returns:
             reponse (list): list of assets in a release
         """
-        url = f'{self.base_url}/{self.list_release_assets_url}'.format(
-            owner=self.owner, repo=self.repo, release_id=id)
-        self.logger.info(f"GET {url}")
+        try:
+            return list(self.iter_release_assets(id))
+        except requests.exceptions.HTTPError as err:
+            self.logger.error(f"HTTP ERROR: {err}")
+            self.logger.error(f"{err.response.url} returned {err.response.text}")
+            return err.response.text
+
+    def find_asset(self, release, name):
+        """
+        Finds an asset of a release by name
+
+        Inputs:
+            release (dict): the release, as returned by get_release_by_tag
+            name (str): the asset's file name
+        Returns:
+            asset (dict): the asset, or None if the release has no such asset
+        """
+        # Releases come with their assets, which saves listing them separately
+        assets = release["assets"] if "assets" in release else self.iter_release_assets(release["id"])
+        return next((asset for asset in assets if asset["name"] == name), None)
+
+    def _conditional_get(self, url):
+        # GETs a url, revalidating the copy from an earlier request with its ETag.
+        # GitHub doesn't count 304 responses against the rate limit. Returns the json
+        # and the url of the next page, if any
+        entry = self.cache.get(url) if self.cache is not None else self.responses.get(url)
         headers={
             'User-Agent': self.credentials["username"],
             'Authorization': f"token {self.credentials['token']}"
         }
-        try:
-            resp = self.session.get(
-                url,
-                verify=self.verify,
-                headers=headers,
-                auth=HTTPBasicAuth(
-                    self.credentials["username"],
-                    self.credentials["token"]))
-            resp.raise_for_status()
-            return resp.json()
-        except requests.exceptions.HTTPError as err:
-            self.logger.error(f"HTTP ERROR: {err}")
-            self.logger.error(f"{resp.url} returned {resp.text}")
-            return resp.text
+        if entry is not None and entry.get("etag"):
+            headers["If-None-Match"] = entry["etag"]
+        self.logger.info(f"GET {url}")
+        resp = self.retry.call(lambda: self.session.get(url,
+            verify=self.verify,
+            headers=headers,
+            auth=HTTPBasicAuth(
+                self.credentials["username"],
+                self.credentials["token"])))
+        if resp.status_code == 304:
+            return entry["data"], entry.get("next")
+        resp.raise_for_status()
+        data = resp.json()
+        next_url = resp.links.get("next", {}).get("url")
+        if self.cache is not None:
+            self.cache.put(url, data, etag=resp.headers.get("ETag"), next=next_url)
+        else:
+            self.responses[url] = {"data": data, "etag": resp.headers.get("ETag"), "next": next_url}
+        return data, next_url
 
     def create_release(self, version, changelog, branch):
         """
@@ -123,7 +194,7 @@ class GitHubReleasesAPI(object):
         }
         self.logger.info(f"Posting {payload} to {url}")
         try:
-            resp = self.session.post(
+            resp = self.retry.call(lambda: self.session.post(
                 url,
                 data=json.dumps(payload),
                 headers=headers,
@@ -131,22 +202,27 @@ class GitHubReleasesAPI(object):
                 auth=HTTPBasicAuth(
                     self.credentials["username"],
                     self.credentials["token"])
-                )
-
+                ),
+                idempotent=False,
+                recheck=lambda: self._find_release(version))
+            if not isinstance(resp, requests.Response):
+                return resp
             resp.raise_for_status()
             return resp.json()
         except requests.exceptions.HTTPError as err:
             self.logger.error(f"HTTP ERROR: {err}")
             self.logger.error(f"{resp.url} returned {resp.text}")
-            return resp.text
+            raise
 
     def upload_release_file(self, release_id, zip):
         """
-        Upload a file to a release
+        Upload a file to a release. The file is streamed from disk
 
         Inputs:
             release_id (int): the github release ID
             zip (str): path to the zip to upload
+        Returns:
+            response (dict): json describing the asset, raises HTTPError if the upload failed
         """
         file_name = os.path.basename(zip)
 
@@ -158,22 +234,59 @@ class GitHubReleasesAPI(object):
             #'Authorization': f"token {self.credentials['token']}",
             #'User-Agent': self.credentials["username"]
         }
-        with open(zip, "rb") as f:
-            content = f.read()
+        def send():
+            with StreamingBody([zip]) as body:
+                body.progress = UploadProgress(file_name, len(body), log=self.logger)
+                return self.session.post(release_url,
+                    verify=self.verify,
+                    headers=headers,
+                    data=body,
+                    auth=(self.credentials['token'], 'x-oauth-basic')
+                    )
         try:
-            resp = self.session.post(release_url,
-                verify=self.verify,
-                headers=headers,
-                data=content,
-                auth=(self.credentials['token'], 'x-oauth-basic')
-                )
+            resp = self.retry.call(send,
+                idempotent=False,
+                recheck=lambda: self._find_uploaded_asset(release_id, file_name),
+                size=os.path.getsize(zip))
+            if not isinstance(resp, requests.Response):
+                return resp
             resp.raise_for_status()
             self.logger.info(f"{resp.url} returned {resp.text}")
             return resp.json()
         except requests.exceptions.HTTPError as err:
             self.logger.error(f"HTTP ERROR: {err}")
             self.logger.error(f"{resp.url} returned {resp.text}")
-            return resp.text
+            raise
+
+    def delete_asset(self, asset_id):
+        """
+        Deletes a release asset
+
+        Inputs:
+            asset_id (int): the github asset ID
+        """
+        url = f'{self.base_url}/{self.asset_url}'.format(
+            owner=self.owner, repo=self.repo, asset_id=asset_id)
+        self.logger.info(f"DELETE {url}")
+        resp = self.retry.call(lambda: self.session.delete(url,
+            verify=self.verify,
+            auth=(self.credentials['token'], 'x-oauth-basic')))
+        resp.raise_for_status()
+
+    def _find_release(self, version):
+        # Returns the release created by an earlier attempt of create_release, if any
+        return self.get_release_by_tag(version)
+
+    def _find_uploaded_asset(self, release_id, file_name):
+        # Returns the asset uploaded by an earlier attempt of upload_release_file, if any.
+        # An asset left incomplete by a failed upload blocks new uploads of the same name
+        # so it is deleted
+        asset = self.find_asset({"id": release_id}, file_name)
+        if asset is None or asset.get("state") == "uploaded":
+            return asset
+        self.logger.warning(f"Deleting incomplete asset {file_name} left by a failed upload")
+        self.delete_asset(asset["id"])
+        return None
 
     def login(self):
         pass
@@ -182,7 +295,8 @@ class GitHubReleasesAPI(object):
         pass
 
     def close(self):
-        self.session.close()
+        if not is_shared(self.session):
+            self.session.close()
 
     def __enter__(self):
         self.login()
@@ -3,6 +3,18 @@ import os
 import json
 import yaml
 import stat
+import marshal
+import hashlib
+import threading
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# The libyaml loader is many times faster than the pure Python one, where it is available
+YAML_LOADER = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
 
 
 def get_version(version_data):
@@ -20,18 +32,96 @@ def get_version_file_info(gamedata_path, mod_name):
     version_data = json.load(f)
   return version_data
 
-def get_build_data(build_data_path):
-    """Loads the information from the build data file at the specified path"""
-    with open(build_data_path, "r") as f:
-      build_data = yaml.load(f)
-    return build_data
+def get_build_data(build_data_path, cache_path=None):
+    """
+    Loads the information from the build data file at the specified path
+
+    Inputs:
+        build_data_path (str): path to the build data file
+        cache_path (str): folder to keep parsed copies of YAML files in, if any
+    Returns:
+        build_data (dict): the build data
+    """
+    return load_yaml(build_data_path, cache_path)
+
+def load_yaml(path, cache_path=None):
+    """
+    Parses a YAML file. With a cache path, the parsed data is kept there keyed by
+    the file's modification time and a hash of its contents, so unchanged files
+    are only parsed once across runs
+
+    Inputs:
+        path (str): path to the YAML file
+        cache_path (str): folder to keep parsed copies in, if any
+    Returns:
+        data (object): the parsed contents
+    """
+    with open(path, "rb") as f:
+        raw = f.read()
+    if cache_path is None:
+        return yaml.load(raw, Loader=YAML_LOADER)
+
+    mtime = os.stat(path).st_mtime_ns
+    digest = hashlib.sha256(raw).hexdigest()
+    entry = os.path.join(cache_path, hashlib.sha256(os.path.abspath(path).encode("utf-8")).hexdigest() + ".marshal")
+    try:
+        with open(entry, "rb") as f:
+            cached_mtime, cached_digest, data = marshal.load(f)
+        if cached_mtime == mtime and cached_digest == digest:
+            return data
+    except (OSError, EOFError, ValueError, TypeError):
+        pass
+
+    data = yaml.load(raw, Loader=YAML_LOADER)
+    try:
+        # Data that marshal can't represent, like dates, is just parsed every time
+        compiled = marshal.dumps((mtime, digest, data))
+    except ValueError:
+        return data
+    try:
+        ensure_path(cache_path)
+        partial = f"{entry}.{os.getpid()}.partial"
+        with open(partial, "wb") as f:
+            f.write(compiled)
+        os.replace(partial, entry)
+    except OSError:
+        # An unwritable cache only costs parsing the file again next time
+        pass
+    return data
 
 def ensure_path(path):
     """Ensure a path exists, make it if not"""
     if os.path.exists(path):
         return
     else:
-        os.makedirs(path)
+        # Another process may be making it at the same time
+        os.makedirs(path, exist_ok=True)
+
+_file_locks = {}
+_file_locks_guard = threading.Lock()
+
+@contextmanager
+def file_lock(path):
+    """
+    Holds an exclusive lock on a lock file, serializing work on something shared
+    between the threads of this process and other processes, like the cache used
+    by every job of a batch. Where fcntl isn't available, only threads are serialized
+
+    Inputs:
+        path (str): the lock file, created if needed
+    """
+    with _file_locks_guard:
+        thread_lock = _file_locks.setdefault(os.path.abspath(path), threading.Lock())
+    with thread_lock:
+        ensure_path(os.path.dirname(os.path.abspath(path)))
+        with open(path, "a") as f:
+            if fcntl is not None:
+                fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(f.fileno(), fcntl.LOCK_UN)
 
 def clean_path(path):
     """Creates a clean copy of a path if it exists"""
@@ -39,8 +129,13 @@ def clean_path(path):
         for root, dirs, files in os.walk(path, topdown=False):
             for name in files:
                 filename = os.path.join(root, name)
-                os.chmod(filename, stat.S_IWUSR)
-                os.remove(filename)
+                try:
+                    os.remove(filename)
+                except PermissionError:
+                    # Only make the file writable when it can't be removed as is, since
+                    # changing the mode of a hardlinked file changes the original too
+                    os.chmod(filename, stat.S_IWUSR)
+                    os.remove(filename)
             for name in dirs:
                 os.rmdir(os.path.join(root, name))
     else:
@@ -0,0 +1,269 @@
+# Checks of release contents, run against zips or folders
+import os
+import re
+import struct
+import zipfile
+import logging
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+from ksp_deploy.archive import CENTRAL_HEADER, END_RECORD, ZIP64_END_RECORD, ZIP64_END_LOCATOR, FLAG_UTF8, ZIP64_LIMIT
+
+# The fields of a central directory header needed to list the entries: signature,
+# flags, and the lengths of the name, extra field and comment that follow it
+CENTRAL_NAME_FIELDS = struct.Struct("<4s4xH18xHHH")
+
+logger = logging.getLogger('packager.lint')
+
+DEFAULT_MAX_PATH_LENGTH = 200  # leaves room for a deep KSP install folder under the Windows limit of 260
+
+LintIssue = namedtuple("LintIssue", ["target", "rule", "entry", "message"])
+
+
+class LintRule(object):
+    """
+    A check of release contents. A rule is given the names of all the entries of a
+    zip or folder at once, so it can compare them with each other
+    """
+    name = None
+
+    def check(self, entries):
+        """
+        Checks the entries of a zip or folder
+
+        Inputs:
+            entries (list[str]): the entries' paths, with / separators and a trailing / for folders
+        Returns:
+            issues (list[tuple]): (entry, message) of each issue found
+        """
+        return []
+
+
+class PatternRule(LintRule):
+    """
+    Reports files whose name matches a pattern. The pattern is compiled once and
+    searched for in all the names of a zip or folder at once
+    """
+
+    def __init__(self, name, pattern, message):
+        """
+        Inputs:
+            name (str): name of the rule
+            pattern (str): regular expression searched for in file names, which can't match a /
+            message (str): description of the issue
+        """
+        self.name = name
+        self.message = message
+        # Only matches in the last part of a path, so never in a folder name
+        self.expression = re.compile(f"(?:{pattern})[^/\\n]*$", re.MULTILINE)
+
+    def check(self, entries):
+        return self.scan("\n".join(entries))
+
+    def scan(self, text):
+        """
+        Searches for the pattern in the names of a zip or folder
+
+        Inputs:
+            text (str): the entries' paths, one per line
+        Returns:
+            issues (list[tuple]): (entry, message) of each issue found
+        """
+        issues = []
+        for match in self.expression.finditer(text):
+            line_start = text.rfind("\n", 0, match.start()) + 1
+            issues.append((text[line_start:match.end()], self.message))
+        return issues
+
+
+class PathLengthRule(LintRule):
+    """Reports entries whose path is too long to install on every platform"""
+    name = "path-length"
+
+    def __init__(self, max_length=DEFAULT_MAX_PATH_LENGTH):
+        """
+        Inputs:
+            max_length (int): longest path allowed, in characters
+        """
+        self.max_length = max_length
+
+    def check(self, entries):
+        message = f"path is longer than {self.max_length} characters"
+        return [(entry, message) for entry in entries if len(entry.rstrip("/")) > self.max_length]
+
+
+class CaseCollisionRule(LintRule):
+    """Reports entries whose paths only differ by case, which overwrite each other on Windows and macOS"""
+    name = "case-collision"
+
+    def check(self, entries):
+        seen = {}
+        issues = []
+        for entry in entries:
+            previous = seen.setdefault(entry.lower(), entry)
+            if previous != entry:
+                issues.append((entry, f"collides with {previous} on case insensitive file systems"))
+        return issues
+
+
+class DuplicateEntryRule(LintRule):
+    """Reports entries that appear more than once"""
+    name = "duplicate-entry"
+
+    def check(self, entries):
+        if len(set(entries)) == len(entries):
+            return []
+        seen = set()
+        issues = []
+        for entry in entries:
+            if entry in seen:
+                issues.append((entry, "appears more than once"))
+            seen.add(entry)
+        return issues
+
+
+def default_rules(max_path_length=None, case_collisions=False, duplicates=False):
+    """
+    Returns the rules releases are checked with. The path, case and duplicate
+    checks can fail releases that always passed, so they are only made when asked
+
+    Inputs:
+        max_path_length (int): longest path allowed, or None not to check path lengths
+        case_collisions (bool): whether to check for paths that only differ by case
+        duplicates (bool): whether to check for entries that appear more than once
+    Returns:
+        rules (list[LintRule]): the rules
+    """
+    rules = [
+        PatternRule("tga", r"\.tga", "uncompressed .tga texture, ship textures as .dds or .png"),
+        PatternRule("intermediate", r"-b\.dds", "intermediate bumpmap left over from the texture workflow"),
+    ]
+    if max_path_length:
+        rules.append(PathLengthRule(max_path_length))
+    if case_collisions:
+        rules.append(CaseCollisionRule())
+    if duplicates:
+        rules.append(DuplicateEntryRule())
+    return rules
+
+
+class Linter(object):
+    """
+    Checks zips and folders against a set of rules, listing each one once. Zips are
+    listed from their central directory, without extracting or decompressing anything
+    """
+
+    def __init__(self, rules=None):
+        """
+        Inputs:
+            rules (list[LintRule]): the rules to apply, the default rules if not given
+        """
+        self.rules = default_rules() if rules is None else list(rules)
+
+    def lint(self, target):
+        """
+        Checks a zip or a folder
+
+        Inputs:
+            target (str): path of the zip or folder
+        Returns:
+            issues (list[LintIssue]): the issues found
+        """
+        entries = list(walk_folder(target)) if os.path.isdir(target) else read_entry_names(target)
+        text = "\n".join(entries)
+        issues = []
+        for rule in self.rules:
+            found = rule.scan(text) if isinstance(rule, PatternRule) else rule.check(entries)
+            issues.extend(LintIssue(target, rule.name, entry, message) for entry, message in found)
+        return issues
+
+    def lint_many(self, targets, workers=4):
+        """
+        Checks several zips or folders at the same time
+
+        Inputs:
+            targets (list[str]): paths of the zips or folders
+            workers (int): number of targets to check at once
+        Returns:
+            issues (dict): target -> list of LintIssue
+        """
+        with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+            return dict(zip(targets, pool.map(self.lint, targets)))
+
+def lint(targets, rules=None, workers=4):
+    """
+    Checks zips or folders against the given or default rules
+
+    Inputs:
+        targets (list[str]): paths of the zips or folders
+        rules (list[LintRule]): the rules to apply, the default rules if not given
+        workers (int): number of targets to check at once
+    Returns:
+        issues (list[LintIssue]): the issues found, in target order
+    """
+    results = Linter(rules).lint_many(targets, workers)
+    issues = [issue for target in targets for issue in results[target]]
+    for issue in issues:
+        logger.warning(f"{issue.target}: {issue.entry}: {issue.message} ({issue.rule})")
+    return issues
+
+def walk_folder(path):
+    """
+    Lists the files and folders below a folder
+
+    Inputs:
+        path (str): the folder
+    Returns:
+        entries (generator[str]): paths relative to the folder, with / separators and a trailing / for folders
+    """
+    pending = [("", path)]
+    while pending:
+        prefix, folder = pending.pop()
+        with os.scandir(folder) as it:
+            for item in sorted(it, key=lambda item: item.name):
+                if item.is_dir(follow_symlinks=False):
+                    yield f"{prefix}{item.name}/"
+                    pending.append((f"{prefix}{item.name}/", item.path))
+                else:
+                    yield f"{prefix}{item.name}"
+
+def read_entry_names(path):
+    """
+    Lists the entries of a zip from its central directory, reading nothing else
+
+    Inputs:
+        path (str): the zip
+    Returns:
+        entries (list[str]): the entry names, in the order they are stored
+    """
+    with open(path, "rb") as f:
+        f.seek(0, os.SEEK_END)
+        size = f.tell()
+        # The end record is followed by a comment of at most 64KB
+        tail_start = max(0, size - END_RECORD.size - 0xFFFF)
+        f.seek(tail_start)
+        tail = f.read()
+        end = tail.rfind(b"PK\x05\x06")
+        if end < 0:
+            raise zipfile.BadZipFile(f"{path} is not a zip file")
+        count, directory_size, directory_offset = [END_RECORD.unpack_from(tail, end)[i] for i in (4, 5, 6)]
+        if count == 0xFFFF or directory_size == ZIP64_LIMIT or directory_offset == ZIP64_LIMIT:
+            f.seek(tail_start + end - ZIP64_END_LOCATOR.size)
+            zip64_end = ZIP64_END_LOCATOR.unpack(f.read(ZIP64_END_LOCATOR.size))[2]
+            f.seek(zip64_end)
+            count, directory_size, directory_offset = ZIP64_END_RECORD.unpack(f.read(ZIP64_END_RECORD.size))[7:10]
+        f.seek(directory_offset)
+        directory = f.read(directory_size)
+
+    names = []
+    offset = 0
+    unpack = CENTRAL_NAME_FIELDS.unpack_from
+    header_size = CENTRAL_HEADER.size
+    for _ in range(count):
+        signature, flags, name_length, extra_length, comment_length = unpack(directory, offset)
+        if signature != b"PK\x01\x02":
+            raise zipfile.BadZipFile(f"Bad central directory in {path}")
+        start = offset + header_size
+        names.append(directory[start:start + name_length].decode("utf-8" if flags & FLAG_UTF8 else "cp437"))
+        offset = start + name_length + extra_length + comment_length
+    return names
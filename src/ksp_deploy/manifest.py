@@ -0,0 +1,95 @@
+# Checksum manifests of release zips
+import os
+import json
+import hashlib
+import logging
+
+logger = logging.getLogger('packager.manifest')
+
+MANIFEST_NAME = "manifest.json"  # written next to the zips in the mod's deploy path
+
+
+class ManifestMismatch(Exception):
+    """Raised when a release zip has changed since its manifest was written"""
+    pass
+
+
+def manifest_algorithms(config):
+    """Returns the hashlib algorithms the configuration asks manifests to record"""
+    if not config.WRITE_MANIFEST:
+        return ()
+    return ("sha256", "blake2b") if config.MANIFEST_BLAKE2 else ("sha256",)
+
+def file_sha256(path):
+    """Returns the SHA-256 of a file, as hex"""
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+def write_manifest(deploy_path, mod_name, version, archives):
+    """
+    Writes the manifest of the release zips. The digests were computed while the
+    zips were written; the manifest also records the size and modification time
+    of each zip, so later steps can tell whether it changed without hashing it
+
+    Inputs:
+        deploy_path (str): path of the release zips
+        mod_name (str): name of the mod
+        version (str): version of the release
+        archives (dict): zip path -> size, digests and entry records, as returned by write_archives
+    Returns:
+        path (str): path of the manifest
+    """
+    manifest = {"mod-name": mod_name, "version": version, "archives": {}}
+    for zip_path, record in archives.items():
+        manifest["archives"][os.path.basename(zip_path)] = dict(record, mtime_ns=os.stat(zip_path).st_mtime_ns)
+    path = os.path.join(deploy_path, MANIFEST_NAME)
+    with open(path, "w") as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    logger.info(f"Wrote the manifest of {len(archives)} zips to {path}")
+    return path
+
+def load_manifest(path):
+    """
+    Reads a manifest
+
+    Inputs:
+        path (str): path of the manifest
+    Returns:
+        manifest (dict): the manifest, or None if there is none or it can't be read
+    """
+    try:
+        with open(path, "r") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+    except ValueError as err:
+        logger.warning(f"Ignoring the unreadable manifest {path} ({err})")
+        return None
+
+def verify_artifact(manifest, zip_path):
+    """
+    Checks that a zip is the one its manifest describes. A zip with the recorded
+    size and modification time is taken as is; one whose time changed, because it
+    was copied or restored from a cache, is hashed and compared with the manifest
+
+    Inputs:
+        manifest (dict): the manifest
+        zip_path (str): path of the zip
+    Returns:
+        record (dict): the zip's record in the manifest
+    """
+    record = manifest["archives"].get(os.path.basename(zip_path))
+    if record is None:
+        raise ManifestMismatch(f"{zip_path} isn't in the manifest")
+    zip_stat = os.stat(zip_path)
+    if zip_stat.st_size != record["size"]:
+        raise ManifestMismatch(f"{zip_path} changed after its manifest was written")
+    if zip_stat.st_mtime_ns == record["mtime_ns"]:
+        return record
+    if file_sha256(zip_path) != record["sha256"]:
+        raise ManifestMismatch(f"{zip_path} changed after its manifest was written")
+    logger.info(f"{zip_path} was touched since its manifest was written, but its checksum matches")
+    return record
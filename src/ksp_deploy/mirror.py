@@ -0,0 +1,111 @@
+# Local bare mirrors of GitHub dependency repositories
+import os
+import shutil
+import logging
+import tarfile
+import subprocess
+
+from ksp_deploy.helpers import ensure_path, file_lock
+
+logger = logging.getLogger('packager.mirror')
+
+
+class GitMirror(object):
+    """
+    A bare mirror of a GitHub repository that only holds the tags that have been
+    asked for, each fetched at depth 1. Tags already in the mirror are used
+    without touching the network, so a warmed mirror works offline.
+    """
+
+    def __init__(self, mirror_root, repo):
+        """
+        Inputs:
+            mirror_root (str): folder holding all mirrors
+            repo (str): Account/RepoName
+        """
+        self.repo = repo
+        self.url = f"https://github.com/{repo}.git"
+        self.path = os.path.join(mirror_root, repo.replace("/", "__") + ".git")
+        # The mirrors are shared by the jobs of a batch, which run in separate processes
+        self.lock_path = f"{self.path}.lock"
+
+    @classmethod
+    def from_config(cls, repo, config):
+        """Creates the mirror of a repository in the configured cache path"""
+        return cls(os.path.join(config.CACHE_PATH, "git"), repo)
+
+    def ensure_tag(self, tag):
+        """
+        Makes sure a tag is present in the mirror, fetching only that tag if needed
+
+        Inputs:
+            tag (str): the tag to fetch
+        """
+        with file_lock(self.lock_path):
+            if not os.path.exists(self.path):
+                self._create()
+            if self.has_tag(tag):
+                logger.info(f"Mirror of {self.repo} already has {tag}")
+                return
+            logger.info(f"Fetching {tag} of {self.repo} into mirror")
+            self._git("fetch", "--depth", "1", "--no-tags", "origin", f"+refs/tags/{tag}:refs/tags/{tag}")
+
+    def has_tag(self, tag):
+        """Returns whether the mirror holds a tag"""
+        result = subprocess.run(
+            ["git", "--git-dir", self.path, "rev-parse", "--quiet", "--verify", f"refs/tags/{tag}^{{commit}}"],
+            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        return result.returncode == 0
+
+    def export(self, tag, subpath, dest):
+        """
+        Writes one folder of a tagged tree to disk, without checking out the rest
+        of the repository
+
+        Inputs:
+            tag (str): the tag to export
+            subpath (str): the repository folder to export, eg GameData/Name
+            dest (str): the folder to export into; subpath is recreated below it
+        """
+        proc = subprocess.Popen(
+            ["git", "--git-dir", self.path, "archive", "--format=tar", f"refs/tags/{tag}", "--", subpath],
+            stdout=subprocess.PIPE)
+        with tarfile.open(fileobj=proc.stdout, mode="r|") as tar:
+            if hasattr(tarfile, "data_filter"):
+                tar.extractall(dest, filter="data")
+            else:
+                tar.extractall(dest)
+        if proc.wait() != 0:
+            raise subprocess.CalledProcessError(proc.returncode, f"git archive {tag} {subpath}")
+
+    def read_file(self, tag, path):
+        """
+        Reads a file of a tagged tree, without checking anything out
+
+        Inputs:
+            tag (str): the tag to read from
+            path (str): path of the file in the repository, eg .mod_data.yml
+        Returns:
+            contents (bytes): the file's contents, or None if the tag doesn't have the file
+        """
+        result = subprocess.run(
+            ["git", "--git-dir", self.path, "show", f"refs/tags/{tag}:{path}"],
+            stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+        if result.returncode != 0:
+            return None
+        return result.stdout
+
+    def _create(self):
+        # Set up in a temporary folder and renamed into place, so a mirror left by
+        # an interrupted build is never half initialized
+        logger.info(f"Creating mirror of {self.repo} at {self.path}")
+        partial = f"{self.path}.{os.getpid()}.partial"
+        if os.path.exists(partial):
+            shutil.rmtree(partial)
+        ensure_path(partial)
+        self._git("init", "--bare", "--quiet", git_dir=partial)
+        self._git("remote", "add", "origin", self.url, git_dir=partial)
+        os.rename(partial, self.path)
+
+    def _git(self, *args, git_dir=None):
+        subprocess.run(["git", "--git-dir", git_dir or self.path] + list(args), check=True)
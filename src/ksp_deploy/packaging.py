@@ -1,105 +1,259 @@
 import os
-import shutil
+import time
+import filecmp
 import logging
+from concurrent.futures import ThreadPoolExecutor
 
 from ksp_deploy.helpers import ensure_path, clean_path
 from ksp_deploy.dependencies import download_dependency
+from ksp_deploy.cache import DependencyCache
+from ksp_deploy.resolver import DependencyResolver, bundled_package
+from ksp_deploy.archive import write_archives
+from ksp_deploy.compression import CompressionPolicy
+from ksp_deploy.manifest import manifest_algorithms
+from ksp_deploy.staging import link_file
+from ksp_deploy.sessions import log_connection_stats
 
 logger = logging.getLogger('packager.packaging')
 
 
-def build_nodep_release(version_data, mod_data, build_path, deploy_path):
+def core_release_path(version_data, mod_data, deploy_path):
     """
-    Builds the release zip with no included dependencies
+    Returns the path of the release zip with no included dependencies
 
     Inputs:
         version_data (dict): Contents of the .version file
-        mod_name (str): name of the mod
-        build_path (str): path into which to build
+        mod_data (dict): the mod data dictionary
         deploy_path (str): path into which to place zips for deploy
     """
-    deploy_zip_path = os.path.join(deploy_path,
-        f"{mod_data['mod-name']}_Core_" + "{MAJOR}_{MINOR}_{PATCH}".format(**version_data["VERSION"]))
-    shutil.make_archive(deploy_zip_path, 'zip', os.path.join(build_path))
-    logger.info(f"Packaged {build_path}")
+    return os.path.join(deploy_path,
+        f"{mod_data['mod-name']}_Core_" + "{MAJOR}_{MINOR}_{PATCH}.zip".format(**version_data["VERSION"]))
 
-def build_full_release(version_data, mod_data, build_path, deploy_path):
+def full_release_path(version_data, mod_data, deploy_path):
     """
-    Builds the release zip with a full set of required dependencies
+    Returns the path of the release zip with a full set of required dependencies
 
     Inputs:
         version_data (dict): Contents of the .version file
-        mod_name (str): name of the mod
-        build_path (str): path into which to build
+        mod_data (dict): the mod data dictionary
         deploy_path (str): path into which to place zips for deploy
     """
-    deploy_zip_path = os.path.join(deploy_path,
-        f"{mod_data['mod-name']}_" + "{MAJOR}_{MINOR}_{PATCH}".format(**version_data["VERSION"]))
-    shutil.make_archive(deploy_zip_path, 'zip', os.path.join(build_path))
-    logger.info(f"Packaged {build_path}")
+    return os.path.join(deploy_path,
+        f"{mod_data['mod-name']}_" + "{MAJOR}_{MINOR}_{PATCH}.zip".format(**version_data["VERSION"]))
 
-def build_extras(version_data, build_path, deploy_path, extras_path, extras_list=[], build_packages=False):
+def extra_release_path(name, version_data, deploy_path):
     """
-    Compiles and optionally builds packages for all Extras in the mod
+    Returns the path of the release zip of a single Extras package
 
     Inputs:
+        name (str): name of the extra
         version_data (dict): Contents of the .version file
-        build_path (str): path into which to build
         deploy_path (str): path into which to place zips for deploy
-        build_packages (bool): whether to create an individual zipfile for each package
+    """
+    return os.path.join(deploy_path, f"{name}" + "{MAJOR}_{MINOR}_{PATCH}.zip".format(**version_data["VERSION"]))
+
+def build_release_archives(archives, config, references=[]):
+    """
+    Writes all the release zips in one pass over the staged files. Files that appear
+    in several zips, like the core content in the core and full releases, are only
+    compressed once, using the configured compression policy
+
+    Inputs:
+        archives (dict): maps the path of each zip to a dictionary of archive name -> source path
+        config (KSPConfiguration): config
+        references (list[str]): previous release zips whose unchanged entries can be reused
+    Returns:
+        stats (dict): the statistics of write_archives, or None if there was nothing to write
+    """
+    if len(archives) == 0:
+        return None
+    start = time.perf_counter()
+    stats = write_archives(archives,
+        spool_dir=config.TEMP_PATH,
+        policy=CompressionPolicy.from_config(config),
+        references=references,
+        workers=config.COMPRESSION_WORKERS or os.cpu_count() or 1,
+        parallel_threshold=config.PARALLEL_COMPRESSION_MIN_MB * 1024 * 1024,
+        algorithms=manifest_algorithms(config))
+    for zip_path in archives:
+        logger.info(f"Packaged {zip_path}")
+    logger.info(f"Compressed {stats['files']} files ({stats['bytes_in']} to {stats['bytes_out']} bytes) "
+                f"into {len(archives)} zips in {time.perf_counter() - start:.2f}s")
+    stats["decisions"].log()
+    if references:
+        logger.info(f"Reused {stats['reused']} unchanged files ({stats['reused_bytes']} bytes) from the previous release")
+    return stats
+
+def stash_previous_release(deploy_path, stash_path):
+    """
+    Moves the zips of a previous build out of the deploy path so their entries can be
+    reused. If the deploy path holds no zips, the zips stashed by an earlier build are
+    kept instead
+
+    Inputs:
+        deploy_path (str): path holding the previous release zips
+        stash_path (str): path to keep previous release zips in
+    Returns:
+        references (list[str]): the stashed zips
+    """
+    ensure_path(stash_path)
+    previous = [f for f in os.listdir(deploy_path) if f.endswith(".zip")] if os.path.exists(deploy_path) else []
+    if previous:
+        clean_path(stash_path)
+        for name in previous:
+            os.replace(os.path.join(deploy_path, name), os.path.join(stash_path, name))
+    return sorted(os.path.join(stash_path, f) for f in os.listdir(stash_path) if f.endswith(".zip"))
+
+def update_release_stash(zip_paths, stash_path):
+    """
+    Replaces the stashed release zips with the ones just built, for the next
+    incremental build
+
+    Inputs:
+        zip_paths (list[str]): the zips that were built
+        stash_path (str): path to keep previous release zips in
+    """
+    clean_path(stash_path)
+    for zip_path in zip_paths:
+        link_file(zip_path, os.path.join(stash_path, os.path.basename(zip_path)))
+
+def build_extras(manifest, extras_path, extras_list=[]):
+    """
+    Stages all Extras in the mod
+
+    Inputs:
+        manifest (StagingManifest): the staged release
+        extras_path (str): path of the mod's Extras folder
+        extras_list (list[str]): names of the extras to include, or empty for all of them
+    Returns:
+        names (list[str]): the extras that were staged
     """
     dirs = next(os.walk(extras_path))[1]
+    names = []
     for name in dirs:
         if len(extras_list) > 0:
             if name in extras_list:
-                build_extra(name, version_data, build_packages, extras_path,build_path, deploy_path)
+                build_extra(name, extras_path, manifest)
+                names.append(name)
         else:
-            build_extra(name, version_data, build_packages, extras_path,build_path, deploy_path)
+            build_extra(name, extras_path, manifest)
+            names.append(name)
+    return names
 
-def build_extra(name, version_data, build_package, extras_path, build_path, deploy_path):
+def build_extra(name, extras_path, manifest):
     """
-    Compiles and optionally builds a single Extras package
+    Stages a single Extras package
 
     Inputs:
         name (str): name of the extra
-        version_data (dict): Contents of the .version file
-        build_package (bool): whether to create an individual zipfile for the package
-        build_path (str): path into which to build
-        deploy_path (str): path into which to place zips for deploy
+        extras_path (str): path of the mod's Extras folder
+        manifest (StagingManifest): the staged release
     """
-    extra_path = os.path.join(deploy_path, f"{name}" + "{MAJOR}_{MINOR}_{PATCH}".format(**version_data["VERSION"]))
     logger.info(f"Packaging Extra {name}")
-    ensure_path(os.path.join(build_path,"Extras"))
-    shutil.copytree(os.path.join(extras_path, name), os.path.join(build_path,"Extras", name))
+    manifest.add_tree(os.path.join(extras_path, name), os.path.join("Extras", name))
 
-    if build_package:
-        logger.info(f"Packaging {name}")
-        shutil.make_archive(extra_path, "zip", os.path.join(build_path, "Extras", name))
-        logger.info(f"Packaged {extra_path}")
-
-def collect_dependencies(mod_data, build_path, config):
+def collect_dependencies(mod_data, manifest, config):
     """
-    Finds and downloads all the mod's dependencies
+    Finds and downloads all the mod's dependencies, including those declared by its
+    dependencies. Each package is fetched once, concurrently into its own staging
+    folder, then merged into the release in dependency order so the result does not
+    depend on which download finished first
 
     Inputs:
         mod_data (dict): the mod data dictionary
-        build_path (str): path into which to build
+        manifest (StagingManifest): the staged release
+        config (KSPConfiguration): config
     """
-    dep_data = mod_data.get("dependencies", {})
     clean_path(config.TEMP_PATH)
-    for name, info in dep_data.items():
-        download_dependency(name, info, config.TEMP_PATH, build_path, config)
-    cleanup(mod_data["package"]["included-support"], build_path)
+    cache = DependencyCache.from_config(config)
+    nodes = DependencyResolver.from_config(mod_data["mod-name"], config).resolve(mod_data.get("dependencies", {}))
+
+    with ThreadPoolExecutor(max_workers=max(1, config.DEPENDENCY_WORKERS)) as pool:
+        # Submitted in dependency order, so a package's requirements start first
+        futures = [(node.name, pool.submit(stage_dependency, node.name, node.info, config, cache))
+                   for node in nodes]
+        staged = [(name, future.result()) for name, future in futures]
+
+    merge_dependencies(staged, manifest, packages=[node.name for node in nodes])
+    if cache is not None:
+        cache.report()
+    log_connection_stats(logger)
+    cleanup(mod_data["package"]["included-support"], manifest)
+
+def stage_dependency(name, info, config, cache=None):
+    """
+    Downloads a single dependency into its own staging folder
+
+    Inputs:
+        name (str): name of the dependency
+        info (dict): dictionary describing the dependency
+        config (KSPConfiguration): config
+        cache (DependencyCache): dependency cache to use, if any
+    Returns:
+        staging_path (str): the folder the dependency was staged to
+    """
+    temp_path = os.path.join(config.TEMP_PATH, "downloads", name)
+    staging_path = os.path.join(config.TEMP_PATH, "staging", name)
+    ensure_path(temp_path)
+    ensure_path(os.path.join(staging_path, "GameData"))
+
+    start = time.perf_counter()
+    download_dependency(name, info, temp_path, staging_path, config, cache=cache)
+    logger.info(f"Collected {name} in {time.perf_counter() - start:.2f}s")
+    return staging_path
+
+def merge_dependencies(staged, manifest, packages=()):
+    """
+    Adds staged dependencies to the release. Copies of a package bundled with another
+    package are left out in favour of the package's own. When two dependencies
+    provide the same file otherwise, the one merged last wins and the conflict is reported
+
+    Inputs:
+        staged (list[tuple]): (name, staging path) pairs in merge order
+        manifest (StagingManifest): the staged release
+        packages (list[str]): names of all the resolved packages
+    """
+    owners = {}
+    conflicts = []
+    for name, staging_path in staged:
+        for root, dirs, files in os.walk(staging_path):
+            for dn in sorted(dirs):
+                src = os.path.join(root, dn)
+                rel_path = os.path.relpath(src, staging_path)
+                bundled = bundled_package(rel_path, packages, name)
+                if bundled is not None:
+                    logger.info(f"Skipping the {rel_path} bundled with {name}, {bundled} is collected itself")
+                    dirs.remove(dn)
+                    continue
+                manifest.add_file(src, rel_path)
+            dirs.sort()
+            for fn in sorted(files):
+                src = os.path.join(root, fn)
+                rel_path = os.path.relpath(src, staging_path)
+                bundled = bundled_package(rel_path, packages, name)
+                if bundled is not None:
+                    logger.info(f"Skipping the {rel_path} bundled with {name}, {bundled} is collected itself")
+                    continue
+                if rel_path in owners:
+                    if filecmp.cmp(src, manifest.entries[rel_path], shallow=False):
+                        logger.info(f"{name} and {owners[rel_path]} both provide an identical {rel_path}")
+                    else:
+                        conflicts.append((rel_path, owners[rel_path], name))
+                owners[rel_path] = name
+                manifest.add_file(src, rel_path)
+
+    for rel_path, previous, name in conflicts:
+        logger.warning(f"Dependency conflict: {rel_path} from {previous} was replaced by the copy from {name}")
 
-def cleanup(kept_files, build_path):
+def cleanup(kept_files, manifest):
     """
     Cleans up the trailing files in the main directory for packaging by excluding all expect the
     specified items in the mod's .mod_data.yml
     Inputs:
         kept_files (list[str]): list of files to keep
-        build_path (str): path into which to build
+        manifest (StagingManifest): the staged release
     """
-    onlyfiles = [f for f in os.listdir(build_path) if os.path.isfile(os.path.join(build_path, f))]
+    onlyfiles = [f for f, source in manifest.entries.items() if os.sep not in f and os.path.isfile(source)]
     for f in onlyfiles:
         if f not in kept_files:
-            os.remove(os.path.join(build_path,f))
+            manifest.remove(f)
@@ -0,0 +1,171 @@
+# Resolution of the full dependency graph of a mod
+import os
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+import yaml
+
+from ksp_deploy.helpers import YAML_LOADER
+from ksp_deploy.mirror import GitMirror
+
+logger = logging.getLogger('packager.resolver')
+
+
+def dependency_version(info):
+    """Returns the version, tag or url a dependency record pins"""
+    return info.get("version", info.get("tag", info.get("url")))
+
+
+class DependencyNode(object):
+    """
+    A package of the dependency graph, with the record it is fetched from and the
+    names of the packages it requires
+    """
+
+    def __init__(self, name, info, parent=None, depth=0):
+        """
+        Inputs:
+            name (str): name of the package
+            info (dict): dictionary describing the dependency
+            parent (str): name of the package that declared it, None for the mod's own dependencies
+            depth (int): distance from the mod, 0 for the mod's own dependencies
+        """
+        self.name = name
+        self.info = info
+        self.parent = parent
+        self.depth = depth
+        self.requires = []
+
+
+class DependencyResolver(object):
+    """
+    Builds the dependency graph of a mod. GitHub dependencies can declare their own
+    dependencies in the .mod_data.yml of their tagged tree, which is read from the
+    local mirror. Each package is resolved to a single record: the one declared
+    nearest to the mod, the first declared on ties, so the mod's own records
+    always win.
+    """
+
+    def __init__(self, mod_name, config, transitive=True):
+        """
+        Inputs:
+            mod_name (str): name of the mod, which is never its own dependency
+            config (KSPConfiguration): config
+            transitive (bool): whether to follow the dependencies of dependencies
+        """
+        self.mod_name = mod_name
+        self.config = config
+        self.transitive = transitive
+
+    @classmethod
+    def from_config(cls, mod_name, config):
+        """Creates the resolver with the configured settings"""
+        return cls(mod_name, config, transitive=config.RESOLVE_TRANSITIVE_DEPENDENCIES)
+
+    def resolve(self, dependencies):
+        """
+        Resolves a mod's dependencies. Declarations are read one level of the graph
+        at a time, concurrently within a level
+
+        Inputs:
+            dependencies (dict): name -> record of the mod's own dependencies
+        Returns:
+            nodes (list[DependencyNode]): one node per package, each after the packages it requires
+        """
+        nodes = {}
+        level = [DependencyNode(name, info) for name, info in (dependencies or {}).items()]
+        with ThreadPoolExecutor(max_workers=max(1, self.config.DEPENDENCY_WORKERS)) as pool:
+            while level:
+                added = []
+                for node in level:
+                    if node.name == self.mod_name:
+                        continue
+                    if node.parent is not None and node.name not in nodes[node.parent].requires:
+                        nodes[node.parent].requires.append(node.name)
+                    existing = nodes.get(node.name)
+                    if existing is None:
+                        nodes[node.name] = node
+                        added.append(node)
+                    elif dependency_version(existing.info) != dependency_version(node.info):
+                        logger.warning(f"{node.parent} requires {node.name} {dependency_version(node.info)}, "
+                                       f"using {dependency_version(existing.info)} required by {existing.parent or self.mod_name}")
+                if not self.transitive:
+                    break
+                declared = list(pool.map(self.declared_dependencies, added))
+                level = [DependencyNode(name, info, node.name, node.depth + 1)
+                         for node, deps in zip(added, declared) for name, info in deps.items()]
+        ordered = topological_order(nodes)
+        logger.info(f"Resolved {len(ordered)} dependencies: {', '.join(n.name for n in ordered)}")
+        return ordered
+
+    def declared_dependencies(self, node):
+        """
+        Reads the dependencies a package declares itself
+
+        Inputs:
+            node (DependencyNode): the package
+        Returns:
+            dependencies (dict): name -> record, empty if the package doesn't declare any
+        """
+        if node.info["location"] != "github":
+            return {}
+        mirror = GitMirror.from_config(node.info["repository"], self.config)
+        mirror.ensure_tag(node.info["tag"])
+        contents = mirror.read_file(node.info["tag"], self.config.BUILD_DATA_NAME)
+        if contents is None:
+            return {}
+        try:
+            mod_data = yaml.load(contents, Loader=YAML_LOADER) or {}
+        except yaml.YAMLError as err:
+            logger.warning(f"Ignoring the unreadable {self.config.BUILD_DATA_NAME} of {node.name} ({err})")
+            return {}
+        return mod_data.get("dependencies") or {}
+
+def topological_order(nodes):
+    """
+    Orders packages so each comes after the packages it requires, otherwise keeping
+    the order they were found in
+
+    Inputs:
+        nodes (dict): name -> DependencyNode
+    Returns:
+        ordered (list[DependencyNode]): the packages
+    """
+    ordered = []
+    state = {}
+
+    def visit(name):
+        if state.get(name) == "done":
+            return
+        if state.get(name) == "visiting":
+            logger.warning(f"Dependency cycle through {name}")
+            return
+        state[name] = "visiting"
+        for required in nodes[name].requires:
+            visit(required)
+        state[name] = "done"
+        ordered.append(nodes[name])
+
+    for name in nodes:
+        visit(name)
+    return ordered
+
+def bundled_package(rel_path, packages, owner):
+    """
+    Finds whether a staged path is another package's bundled copy, like the
+    GameData/ModuleManager.4.2.1.dll shipped inside a dependency's zip
+
+    Inputs:
+        rel_path (str): path relative to the staging folder
+        packages (list[str]): names of the resolved packages
+        owner (str): the package the path was staged for
+    Returns:
+        package (str): the package bundled at the path, or None
+    """
+    parts = rel_path.split(os.sep)
+    if len(parts) < 2 or parts[0] != "GameData":
+        return None
+    for package in packages:
+        if package != owner and (parts[1] == package or parts[1].startswith(f"{package}.")):
+            return package
+    return None
@@ -0,0 +1,165 @@
+# Retrying of provider API requests
+import time
+import random
+import logging
+import threading
+from email.utils import parsedate_to_datetime
+
+logger = logging.getLogger('deploy.retry')
+
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+# Statuses that mean the server turned the request away without acting on it
+REJECTED_STATUSES = (429, 503)
+
+_counters = {}
+_counters_lock = threading.Lock()
+
+
+def retry_counters():
+    """
+    Returns the retry counters of every client that has made requests
+
+    Returns:
+        counters (dict): client name -> dictionary of requests, retries, wasted_bytes and failures
+    """
+    with _counters_lock:
+        return {name: dict(counts) for name, counts in _counters.items()}
+
+
+class RetryPolicy(object):
+    """
+    Retries API requests that fail with a transient error, with exponential
+    backoff and jitter. Rate limit headers are followed when the server sends them.
+
+    Requests that aren't idempotent, like uploads, are only retried when it's certain
+    the server didn't act on them, or after a recheck of the remote state shows the
+    earlier attempt didn't land, so a retry never creates a duplicate.
+    """
+
+    def __init__(self, name, attempts=5, backoff=1.0, max_delay=300.0):
+        """
+        Inputs:
+            name (str): name of the client, used for the counters and the log
+            attempts (int): maximum number of attempts of each request
+            backoff (float): base delay in seconds, doubled after each attempt
+            max_delay (float): longest wait in seconds. If the server asks for a
+                longer one, the request is not retried
+        """
+        self.name = name
+        self.attempts = attempts
+        self.backoff = backoff
+        self.max_delay = max_delay
+
+    @classmethod
+    def from_config(cls, name, config):
+        """Creates a policy using the configured attempts and delays"""
+        return cls(name, attempts=config.RETRY_ATTEMPTS, backoff=config.RETRY_BACKOFF,
+                   max_delay=config.RETRY_MAX_DELAY)
+
+    def call(self, send, idempotent=True, recheck=None, size=0):
+        """
+        Sends a request, retrying it as needed
+
+        Inputs:
+            send (callable): sends the request and returns the response. It is called
+                again for each attempt, so it must build a fresh request body each time
+            idempotent (bool): whether sending the request twice is harmless
+            recheck (callable): for requests that aren't idempotent, checks whether a
+                failed attempt landed anyway. Returns None if it didn't, or the value
+                to return instead of a response if it did
+            size (int): bytes sent with each attempt, counted as wasted when it fails
+        Returns:
+            response (requests.Response): the last response, or the result of recheck
+        """
+        # Imported here rather than with the module, as requests is slow to import
+        import requests
+
+        self._count("requests")
+        attempt = 1
+        while True:
+            response = None
+            error = None
+            try:
+                response = send()
+                if not self._should_retry(response):
+                    return response
+                reason = f"{response.status_code} {response.reason}"
+                rejected = response.status_code in REJECTED_STATUSES
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as err:
+                error = err
+                reason = str(err)
+                rejected = self._not_sent(err)
+
+            if not (error is not None and rejected):
+                self._count("wasted_bytes", size)
+            delay = self._delay(attempt, response)
+            retry = attempt < self.attempts and delay is not None
+            if retry and not idempotent and not rejected:
+                if recheck is None:
+                    # Nothing tells whether the server acted on the request
+                    retry = False
+                else:
+                    found = recheck()
+                    if found is not None:
+                        logger.info(f"{self.name}: the failed attempt was applied, not retrying")
+                        return found
+            if not retry:
+                logger.error(f"{self.name}: giving up after {attempt} attempts ({reason})")
+                self._count("failures")
+                if error is not None:
+                    raise error
+                return response
+
+            logger.warning(f"{self.name}: attempt {attempt} failed ({reason}), retrying in {delay:.1f}s")
+            self._count("retries")
+            time.sleep(delay)
+            attempt += 1
+
+    def _should_retry(self, response):
+        if response.status_code in RETRY_STATUSES:
+            return True
+        # GitHub answers 403 when a primary or secondary rate limit is hit
+        return response.status_code == 403 and (response.headers.get("X-RateLimit-Remaining") == "0"
+                                                or "Retry-After" in response.headers
+                                                or "rate limit" in response.text.lower())
+
+    def _not_sent(self, err):
+        # Connection failures before any data was sent
+        from requests.exceptions import ConnectTimeout
+
+        if isinstance(err, ConnectTimeout):
+            return True
+        reason = getattr(err.args[0], "reason", None) if err.args else None
+        return type(reason).__name__ == "NewConnectionError"
+
+    def _delay(self, attempt, response):
+        # Seconds to wait before the next attempt, or None if it is too long
+        delay = None
+        if response is not None:
+            delay = self._requested_delay(response.headers)
+        if delay is None:
+            delay = random.uniform(0, self.backoff * 2 ** (attempt - 1))
+        return delay if delay <= self.max_delay else None
+
+    def _requested_delay(self, headers):
+        retry_after = headers.get("Retry-After")
+        if retry_after is not None:
+            try:
+                return max(0.0, float(retry_after))
+            except ValueError:
+                try:
+                    return max(0.0, parsedate_to_datetime(retry_after).timestamp() - time.time())
+                except (TypeError, ValueError):
+                    pass
+        reset = headers.get("X-RateLimit-Reset")
+        if reset is not None and headers.get("X-RateLimit-Remaining") == "0":
+            try:
+                return max(0.0, float(reset) - time.time()) + random.uniform(0, 1)
+            except ValueError:
+                pass
+        return None
+
+    def _count(self, counter, amount=1):
+        with _counters_lock:
+            counts = _counters.setdefault(self.name, {"requests": 0, "retries": 0, "wasted_bytes": 0, "failures": 0})
+            counts[counter] += amount
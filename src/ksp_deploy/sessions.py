@@ -0,0 +1,162 @@
+# Shared HTTP session for dependency downloads and provider APIs
+import logging
+import threading
+from contextlib import contextmanager
+from urllib.parse import urlparse
+
+
+logger = logging.getLogger('packager.sessions')
+
+POOL_CONNECTIONS = 10  # number of hosts to keep connection pools for
+POOL_MAXSIZE = 10  # connections kept open per host
+CONNECT_TIMEOUT = 10.0
+READ_TIMEOUT = 300.0
+HOST_CONCURRENCY = {"spacedock.info": 2, "kerbal.curseforge.com": 2}  # host -> requests in flight at once
+
+_session = None
+_session_lock = threading.Lock()
+_adapter_class = None
+_host_slots = {}
+_host_slots_lock = threading.Lock()
+
+
+def timeout_adapter_class():
+    """
+    Returns the transport adapter that applies default connect and read timeouts
+    to requests that don't set their own. requests is slow to import and most
+    packaging runs make no HTTP requests, so it is only imported here, when the
+    first session is created
+    """
+    global _adapter_class
+    if _adapter_class is None:
+        from requests.adapters import HTTPAdapter
+
+        class TimeoutAdapter(HTTPAdapter):
+
+            def __init__(self, timeout, **kwargs):
+                """
+                Inputs:
+                    timeout (tuple): (connect, read) timeouts in seconds
+                """
+                self.timeout = timeout
+                super().__init__(**kwargs)
+
+            def send(self, request, **kwargs):
+                if kwargs.get("timeout") is None:
+                    kwargs["timeout"] = self.timeout
+                with host_slot(request.url):
+                    return super().send(request, **kwargs)
+
+        _adapter_class = TimeoutAdapter
+    return _adapter_class
+
+
+def set_host_concurrency(limits):
+    """
+    Limits the number of requests in flight to each host, across all the threads
+    sharing sessions, so concurrent deploys don't hammer the providers
+
+    Inputs:
+        limits (dict): host -> maximum number of requests at once. Other hosts are unlimited
+    """
+    with _host_slots_lock:
+        _host_slots.clear()
+        for host, limit in limits.items():
+            _host_slots[host] = threading.BoundedSemaphore(limit)
+
+@contextmanager
+def host_slot(url):
+    """Waits for the host of a url to have a free request slot, and holds it"""
+    slot = _host_slots.get(urlparse(url).hostname)
+    if slot is None:
+        yield
+        return
+    with slot:
+        yield
+
+def get_session(config=None):
+    """
+    Returns the session shared by everything that makes HTTP requests. Its
+    connections are kept alive and pooled per host, so requests to a host reuse
+    an open connection instead of a new TCP and TLS handshake. Responses are
+    gzip compressed where the server supports it and decoded transparently.
+
+    The settings are read from the configuration the first time the session is
+    created; later calls return the same session. The per host concurrency limits
+    are set at the same time
+
+    Inputs:
+        config (KSPConfiguration): config, or None to use the defaults
+    Returns:
+        session (requests.Session): the shared session
+    """
+    global _session
+    with _session_lock:
+        if _session is None:
+            set_host_concurrency(config.HTTP_HOST_CONCURRENCY if config is not None else HOST_CONCURRENCY)
+            _session = create_session(config)
+        return _session
+
+def create_session(config=None):
+    """
+    Creates a session with pooled connections and default timeouts
+
+    Inputs:
+        config (KSPConfiguration): config, or None to use the defaults
+    Returns:
+        session (requests.Session): the new session
+    """
+    pool_connections = config.HTTP_POOL_CONNECTIONS if config is not None else POOL_CONNECTIONS
+    pool_maxsize = config.HTTP_POOL_MAXSIZE if config is not None else POOL_MAXSIZE
+    timeout = (config.HTTP_CONNECT_TIMEOUT, config.HTTP_READ_TIMEOUT) if config is not None else (CONNECT_TIMEOUT, READ_TIMEOUT)
+
+    import requests
+
+    session = requests.Session()
+    session.headers["Accept-Encoding"] = "gzip, deflate"
+    adapter = timeout_adapter_class()(timeout, pool_connections=pool_connections, pool_maxsize=pool_maxsize)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+def is_shared(session):
+    """Returns whether a session is the shared one, which clients must not close"""
+    return session is not None and session is _session
+
+def connection_stats(session=None):
+    """
+    Counts the connections opened and requests made on each host by a session
+
+    Inputs:
+        session (requests.Session): the session, or None for the shared session
+    Returns:
+        stats (dict): host -> dictionary of requests and connections
+    """
+    session = session or _session
+    stats = {}
+    if session is None:
+        return stats
+    for adapter in set(session.adapters.values()):
+        pools = adapter.poolmanager.pools
+        for key in pools.keys():
+            pool = pools.get(key)
+            if pool is None:
+                continue
+            host = stats.setdefault(f"{key.key_scheme}://{key.key_host}", {"requests": 0, "connections": 0})
+            host["requests"] += pool.num_requests
+            host["connections"] += pool.num_connections
+    return stats
+
+def log_connection_stats(log=None, session=None):
+    """
+    Logs how often each host's connections were reused
+
+    Inputs:
+        log (logging.Logger): logger to report to
+        session (requests.Session): the session, or None for the shared session
+    """
+    log = log or logger
+    for host, counts in sorted(connection_stats(session).items()):
+        reused = counts["requests"] - counts["connections"]
+        log.info(f"{host}: {counts['requests']} requests over {counts['connections']} connections "
+                 f"({reused} reused)")
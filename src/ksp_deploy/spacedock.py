@@ -1,8 +1,14 @@
 # Class for accessing the SpaceDock API
+import os
+import time
 import requests
 import logging
 from contextlib import closing
 
+from ksp_deploy.uploads import MultipartBody, UploadProgress
+from ksp_deploy.retry import RetryPolicy
+from ksp_deploy.sessions import get_session, is_shared
+
 
 class SpaceDockAPI(object):
 
@@ -11,65 +17,110 @@ class SpaceDockAPI(object):
     query_mod_url = "api/mod/{mod_id}"
     update_mod_url = "api/mod/{mod_id}/update"
 
-    def __init__(self, login, password, session=None):
+    def __init__(self, login, password, session=None, retry=None, cache=None, max_age=0):
         """
         Initializes the API session
 
         Inputs:
             login (str): SpaceDock user
             password (str): Spacedock PW
+            retry (RetryPolicy): how to retry failed requests
+            cache (APICache): where to keep mod queries between runs, if anywhere
+            max_age (float): seconds a cached mod query is used without asking
+                SpaceDock whether it changed
         """
         self.credentials = {"username":login, "password":password}
 
         self.logger = logging.getLogger('deploy.spacedock')
+        self.retry = retry or RetryPolicy("SpaceDock")
+        self.cache = cache
+        self.max_age = max_age
 
-        if isinstance(session, requests.Session):
-            self.session = session
-        else:
-            self.session =requests.Session()
+        self.session = session if isinstance(session, requests.Session) else get_session()
 
-    def query_mod(self, mod_id):
+    def query_mod(self, mod_id, max_age=None):
         """
-        Queries the API for a mod
+        Queries the API for a mod. With a cache, the query is conditional on the
+        cached copy having changed, and a cached copy younger than max_age is used
+        without any request
 
         Inputs:
             mod_id (str): SpaceDock mod ID
+            max_age (float): seconds a cached copy is used as is, defaults to the client's
 
         Returns:
             response (dict): The query result
         """
+        return self._query_mod_entry(mod_id, max_age)["data"]
+
+    def _query_mod_entry(self, mod_id, max_age=None):
+        # Returns the cache entry of a mod query, with the mod under "data" and its
+        # versions indexed under "versions"
         url = f'{self.base_url}/{self.query_mod_url}'.format(mod_id=mod_id)
+        max_age = self.max_age if max_age is None else max_age
+        entry = self.cache.get(url) if self.cache is not None else None
+        if entry is not None and max_age > 0 and time.time() - entry["stored"] <= max_age:
+            self.logger.info(f"Using cached {url}")
+            return entry
+
+        headers = {}
+        if entry is not None:
+            if entry.get("etag"):
+                headers["If-None-Match"] = entry["etag"]
+            if entry.get("last_modified"):
+                headers["If-Modified-Since"] = entry["last_modified"]
         self.logger.info(f"Getting {url}")
-        with closing(self.session.get(url)) as resp:
+        try:
+            resp = self.retry.call(lambda: self.session.get(url, headers=headers))
+        except requests.exceptions.ConnectionError as err:
+            if entry is None:
+                raise
+            self.logger.warning(f"Using cached {url} as SpaceDock can't be reached ({err})")
+            return entry
+
+        with closing(resp):
+            if resp.status_code == 304:
+                self.logger.info(f"{url} is unchanged")
+                return self.cache.put(url, entry["data"], versions=entry["versions"],
+                                      etag=entry.get("etag"), last_modified=entry.get("last_modified"))
+            # An error must not pass for a mod without versions, nor be cached
+            if not resp.ok:
+                self.logger.error(f"{url} returned {resp.text}")
+                resp.raise_for_status()
             try:
                 m = getattr(resp, "json")
-                return m() if callable(m) else m
-            except requests.exceptions.HTTPError as err:
-                self.logger.error(err)
-                return resp.text
-
-    def check_version_exists(self, mod_id, version):
+                data = m() if callable(m) else m
+            except ValueError:
+                self.logger.error(f"{url} returned {resp.text}")
+                raise
+        if not isinstance(data, dict) or "versions" not in data:
+            raise ValueError(f"{url} didn't return a mod: {data}")
+        versions = {v["friendly_version"]: v.get("id") for v in data["versions"]}
+        if self.cache is not None:
+            return self.cache.put(url, data, versions=versions,
+                                  etag=resp.headers.get("ETag"), last_modified=resp.headers.get("Last-Modified"))
+        return {"data": data, "versions": versions}
+
+    def check_version_exists(self, mod_id, version, max_age=None):
         """
         Checks to see if this version of the mod exists
 
         Inputs:
             mod_id (str): SpaceDock mod ID
             version (str): The version to check for
+            max_age (float): seconds a cached mod query is used as is, defaults to the client's
 
         Returns:
             exists (bool): Whether the version exists or not
         """
-        data = self.query_mod(mod_id)
-        versions = data["versions"]
-        for v in versions:
-            if v["friendly_version"] == version:
-                self.logger.info(f"Spacedock already has {version}")
-                return True
+        if version in self._query_mod_entry(mod_id, max_age)["versions"]:
+            self.logger.info(f"Spacedock already has {version}")
+            return True
         return False
 
     def update_mod(self, mod_id, version, changelog, game_version, notify_followers, zipfile):
         """
-        Submits an update to a mod
+        Submits an update to a mod. The zip is streamed from disk
 
         Inputs:
             mod_id (str): the Spacedock mod ID
@@ -78,7 +129,8 @@ class SpaceDockAPI(object):
             game_version (str): the string game version to use
             notify_followers (bool): email followers
             zipfile (str): the path of the zip to upload
-
+        Returns:
+            response (str): the text of the response, raises HTTPError if the upload failed
         """
         url = f'{self.base_url}/{self.update_mod_url}'.format(mod_id=mod_id)
         payload = {
@@ -87,22 +139,36 @@ class SpaceDockAPI(object):
             "game-version": game_version,
             "notify-followers": "yes" if True else "no"
         }
-        self.logger.info(f"Posting {payload} to {url}")
-        print(f"Posting {payload} to {url} with zip file {zipfile}")
-
+        self.logger.info(f"Posting {payload} to {url} with zip file {zipfile}")
+
+        def send():
+            with MultipartBody(payload, {'zipball': zipfile}) as body:
+                body.progress = UploadProgress(os.path.basename(zipfile), len(body), log=self.logger)
+                return self.session.post(url, data=body, headers={'Content-Type': body.content_type})
+        def recheck():
+            if self.check_version_exists(mod_id, version, max_age=0):
+                return f"Version {version} was created by an earlier attempt"
+            return None
         try:
-            resp = self.session.post(url, data=payload, files={'zipball': open(zipfile, 'rb')})
-            resp.raise_for_status()
-            self.logger.info(f"{resp.url} returned {resp.text}")
-            return resp.text
+            resp = self.retry.call(send, idempotent=False, recheck=recheck, size=os.path.getsize(zipfile))
+            if isinstance(resp, requests.Response):
+                resp.raise_for_status()
+                self.logger.info(f"{resp.url} returned {resp.text}")
+                result = resp.text
+            else:
+                result = resp
+            # Only once the version exists, the cached mod entry is out of date
+            if self.cache is not None:
+                self.cache.delete(f'{self.base_url}/{self.query_mod_url}'.format(mod_id=mod_id))
+            return result
         except requests.exceptions.HTTPError as err:
             self.logger.error(f"HTTP ERROR: {err}")
             self.logger.error(f"{resp.url} returned {resp.text}")
-            return resp.text
+            raise
 
 
     def login(self):
-        with closing(self.session.post(f'{self.base_url}/{self.login_url}', data=self.credentials)) as resp:
+        with closing(self.retry.call(lambda: self.session.post(f'{self.base_url}/{self.login_url}', data=self.credentials))) as resp:
             if resp.reason == 'OK':
                 self.logger.info("Successfully logged in")
                 return self.session
@@ -113,7 +179,8 @@ class SpaceDockAPI(object):
         pass
 
     def close(self):
-        self.session.close()
+        if not is_shared(self.session):
+            self.session.close()
 
     def __enter__(self):
         self.login()
@@ -0,0 +1,139 @@
+# Staging of release content without copying it
+import os
+import shutil
+import logging
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+logger = logging.getLogger('packager.staging')
+
+FICLONE = 0x40049409  # Linux ioctl that shares the extents of one file with another
+
+
+class StagingManifest(object):
+    """
+    Records which source file or folder each path of a release maps to. Archives
+    are written straight from the sources, so nothing is copied while staging.
+    Paths added later replace earlier ones, like copying over a folder would.
+    """
+
+    def __init__(self):
+        self.entries = {}
+
+    def add_file(self, source, path):
+        """
+        Adds a single file
+
+        Inputs:
+            source (str): the file on disk
+            path (str): its path in the release
+        """
+        self.entries[os.path.normpath(path)] = source
+
+    def add_tree(self, source, path):
+        """
+        Adds a folder and everything below it
+
+        Inputs:
+            source (str): the folder on disk
+            path (str): its path in the release
+        """
+        path = os.path.normpath(path)
+        self.entries[path] = source
+        for root, dirs, files in os.walk(source):
+            for name in dirs + files:
+                item = os.path.join(root, name)
+                self.entries[os.path.join(path, os.path.relpath(item, source))] = item
+
+    def remove(self, path):
+        """Removes a path from the manifest"""
+        del self.entries[os.path.normpath(path)]
+
+    def select(self, exclude_top=()):
+        """
+        Returns the manifest as a dictionary of path -> source
+
+        Inputs:
+            exclude_top (tuple[str]): top level folders to leave out
+        """
+        return {path: source for path, source in self.entries.items()
+                if path.split(os.sep)[0] not in exclude_top}
+
+    def subtree(self, path):
+        """
+        Returns everything below a path as a dictionary of path relative to it -> source
+
+        Inputs:
+            path (str): the folder in the release
+        """
+        prefix = os.path.normpath(path) + os.sep
+        return {item[len(prefix):]: source for item, source in self.entries.items()
+                if item.startswith(prefix)}
+
+    def materialize(self, dest):
+        """
+        Builds the staged release as a real folder, linking files rather than copying
+        them wherever the file system allows
+
+        Inputs:
+            dest (str): the folder to build in
+        Returns:
+            methods (dict): number of files placed by each method
+        """
+        methods = {}
+        for path in sorted(self.entries):
+            source = self.entries[path]
+            target = os.path.join(dest, path)
+            if os.path.isdir(source):
+                os.makedirs(target, exist_ok=True)
+            else:
+                os.makedirs(os.path.dirname(target), exist_ok=True)
+                method = link_file(source, target)
+                methods[method] = methods.get(method, 0) + 1
+        return methods
+
+
+def link_file(source, dest):
+    """
+    Places a file at a new path with as little I/O as possible. A hardlink is tried
+    first, then a reflink, then an in-kernel copy, then a regular copy
+
+    Inputs:
+        source (str): the existing file
+        dest (str): the path to place it at
+    Returns:
+        method (str): hardlink, reflink, copy_file_range or copy
+    """
+    try:
+        os.link(source, dest)
+        return "hardlink"
+    except OSError:
+        pass
+
+    with open(source, "rb") as src, open(dest, "wb") as dst:
+        if fcntl is not None:
+            try:
+                fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+                return "reflink"
+            except OSError:
+                pass
+        if hasattr(os, "copy_file_range"):
+            try:
+                remaining = os.fstat(src.fileno()).st_size
+                while remaining > 0:
+                    copied = os.copy_file_range(src.fileno(), dst.fileno(), remaining)
+                    if copied == 0:
+                        break
+                    remaining -= copied
+                if remaining == 0:
+                    return "copy_file_range"
+            except OSError:
+                pass
+            src.seek(0)
+            dst.seek(0)
+            dst.truncate()
+        shutil.copyfileobj(src, dst)
+    return "copy"
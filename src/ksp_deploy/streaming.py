@@ -0,0 +1,270 @@
+# Extracts zip archives while they are still being downloaded
+import os
+import struct
+import zlib
+import zipfile
+import logging
+import tempfile
+
+logger = logging.getLogger('packager.streaming')
+
+LOCAL_HEADER = struct.Struct("<4sHHHHHIIIHH")
+LOCAL_HEADER_SIGNATURE = b"PK\x03\x04"
+CENTRAL_DIRECTORY_SIGNATURE = b"PK\x01\x02"
+END_OF_CENTRAL_DIRECTORY_SIGNATURE = b"PK\x05\x06"
+DATA_DESCRIPTOR_SIGNATURE = b"PK\x07\x08"
+
+FLAG_ENCRYPTED = 0x01
+FLAG_DATA_DESCRIPTOR = 0x08
+
+
+class StreamingUnsupported(Exception):
+    """Raised when an archive uses a feature that can't be extracted from a stream"""
+    pass
+
+
+class StreamingZipExtractor(object):
+    """
+    Extracts a zip archive from its local file headers as bytes are fed to it,
+    without waiting for the central directory at the end of the archive.
+    Stored and deflated entries are supported, including deflated entries
+    written with a trailing data descriptor.
+    """
+
+    def __init__(self, dest):
+        """
+        Inputs:
+            dest (str): path to extract into
+        """
+        self.dest = dest
+        self.extracted = {}
+        self.done = False
+        self._buffer = bytearray()
+        self._entry = None
+
+    def feed(self, data):
+        """
+        Consumes the next block of the archive
+
+        Inputs:
+            data (bytes): the next bytes of the archive
+        """
+        if self.done:
+            return
+        self._buffer += data
+        while not self.done and self._step():
+            pass
+
+    def close(self):
+        """Checks that the archive was complete"""
+        if not self.done:
+            raise zipfile.BadZipFile("Archive stream ended in the middle of an entry")
+
+    def abort(self):
+        """Stops extracting, closing and removing the entry being written if there is one"""
+        entry, self._entry = self._entry, None
+        self.done = True
+        if entry is not None and entry["handle"] is not None:
+            entry["handle"].close()
+            os.remove(entry["path"])
+
+    def _step(self):
+        # Returns True while there is enough buffered data to make progress
+        if self._entry is None:
+            return self._read_header()
+        if self._entry["state"] == "data":
+            return self._read_data()
+        return self._read_descriptor()
+
+    def _read_header(self):
+        if len(self._buffer) < 4:
+            return False
+        signature = bytes(self._buffer[:4])
+        if signature in (CENTRAL_DIRECTORY_SIGNATURE, END_OF_CENTRAL_DIRECTORY_SIGNATURE):
+            self.done = True
+            return False
+        if signature != LOCAL_HEADER_SIGNATURE:
+            raise StreamingUnsupported(f"Unexpected record signature {signature!r}")
+        if len(self._buffer) < LOCAL_HEADER.size:
+            return False
+        (_, _, flags, method, _, _, crc, compress_size, file_size,
+            name_length, extra_length) = LOCAL_HEADER.unpack_from(self._buffer)
+        header_size = LOCAL_HEADER.size + name_length + extra_length
+        if len(self._buffer) < header_size:
+            return False
+
+        name = bytes(self._buffer[LOCAL_HEADER.size:LOCAL_HEADER.size + name_length])
+        extra = bytes(self._buffer[LOCAL_HEADER.size + name_length:header_size])
+        del self._buffer[:header_size]
+
+        if flags & FLAG_ENCRYPTED:
+            raise StreamingUnsupported("Encrypted entries can't be streamed")
+        if method not in (zipfile.ZIP_STORED, zipfile.ZIP_DEFLATED):
+            raise StreamingUnsupported(f"Compression method {method} can't be streamed")
+        has_descriptor = bool(flags & FLAG_DATA_DESCRIPTOR)
+        if has_descriptor and method == zipfile.ZIP_STORED:
+            raise StreamingUnsupported("Stored entries with data descriptors can't be streamed")
+
+        zip64 = False
+        if compress_size == 0xFFFFFFFF or file_size == 0xFFFFFFFF:
+            file_size, compress_size = self._zip64_sizes(extra, file_size, compress_size)
+            zip64 = True
+
+        filename = name.decode("utf-8" if flags & 0x800 else "cp437")
+        target = self._target_path(filename)
+        handle = None
+        if filename.endswith("/"):
+            os.makedirs(target, exist_ok=True)
+        else:
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            handle = open(target, "wb")
+
+        self._entry = {
+            "state": "data",
+            "name": filename,
+            "path": target,
+            "method": method,
+            "crc": crc,
+            "has_descriptor": has_descriptor,
+            "zip64": zip64,
+            "remaining": None if has_descriptor else compress_size,
+            "running_crc": 0,
+            "handle": handle,
+            "decompressor": zlib.decompressobj(-15) if method == zipfile.ZIP_DEFLATED else None
+        }
+        return True
+
+    def _read_data(self):
+        entry = self._entry
+        if entry["remaining"] is not None:
+            block = bytes(self._buffer[:entry["remaining"]])
+        else:
+            block = bytes(self._buffer)
+        if not block and entry["remaining"] != 0:
+            return False
+        del self._buffer[:len(block)]
+
+        if entry["decompressor"] is not None:
+            output = entry["decompressor"].decompress(block)
+            unused = entry["decompressor"].unused_data
+            if unused:
+                # The deflate stream ended inside this block, hand the rest back
+                self._buffer[:0] = unused
+            finished = entry["decompressor"].eof
+        else:
+            output = block
+            finished = False
+
+        if entry["remaining"] is not None:
+            entry["remaining"] -= len(block) - len(entry["decompressor"].unused_data if entry["decompressor"] else b"")
+            finished = finished or entry["remaining"] == 0
+        if output:
+            entry["running_crc"] = zlib.crc32(output, entry["running_crc"])
+            if entry["handle"] is not None:
+                entry["handle"].write(output)
+
+        if not finished:
+            return len(self._buffer) > 0
+        if entry["has_descriptor"]:
+            entry["state"] = "descriptor"
+        else:
+            self._finish_entry(entry["crc"])
+        return True
+
+    def _read_descriptor(self):
+        size_format = "<IQQ" if self._entry["zip64"] else "<III"
+        size = struct.calcsize(size_format)
+        if len(self._buffer) < 4:
+            return False
+        if bytes(self._buffer[:4]) == DATA_DESCRIPTOR_SIGNATURE:
+            size += 4
+        if len(self._buffer) < size:
+            return False
+        crc = struct.unpack_from(size_format, self._buffer, size - struct.calcsize(size_format))[0]
+        del self._buffer[:size]
+        self._finish_entry(crc)
+        return True
+
+    def _finish_entry(self, crc):
+        entry = self._entry
+        if entry["handle"] is not None:
+            entry["handle"].close()
+        if entry["running_crc"] != crc:
+            raise zipfile.BadZipFile(f"Bad CRC-32 for streamed entry {entry['name']}")
+        self.extracted[entry["name"]] = crc
+        self._entry = None
+
+    def _zip64_sizes(self, extra, file_size, compress_size):
+        while len(extra) >= 4:
+            header_id, length = struct.unpack_from("<HH", extra)
+            if header_id == 0x0001:
+                values = list(struct.unpack_from(f"<{length // 8}Q", extra, 4))
+                if file_size == 0xFFFFFFFF:
+                    file_size = values.pop(0)
+                if compress_size == 0xFFFFFFFF:
+                    compress_size = values.pop(0)
+                return file_size, compress_size
+            extra = extra[4 + length:]
+        raise StreamingUnsupported("Zip64 entry without a zip64 extra field")
+
+    def _target_path(self, filename):
+        # Same sanitizing rules as zipfile.ZipFile.extract
+        parts = [p for p in filename.replace("\\", "/").split("/") if p not in ("", ".", "..")]
+        target = os.path.join(self.dest, *parts)
+        dest = os.path.abspath(self.dest)
+        if os.path.commonpath([dest, os.path.abspath(target)]) != dest:
+            raise zipfile.BadZipFile(f"Entry {filename} would extract outside {self.dest}")
+        return target
+
+
+def stream_extract(chunks, dest, spool_threshold, spool_dir=None):
+    """
+    Extracts a zip archive into a folder while it downloads. The archive is also
+    spooled, in memory when it is smaller than the threshold and on disk otherwise,
+    so it can be checked against its central directory and reused afterwards. If
+    the archive can't be extracted as a stream it is extracted from the spool once
+    the download completes.
+
+    Inputs:
+        chunks (iterable[bytes]): the archive contents, in order
+        dest (str): path to extract into
+        spool_threshold (int): size in bytes above which the spool moves to disk
+        spool_dir (str): folder to use for an on-disk spool
+    Returns:
+        spool (file): the rewound archive, which the caller must close
+    """
+    spool = tempfile.SpooledTemporaryFile(max_size=spool_threshold, dir=spool_dir)
+    extractor = StreamingZipExtractor(dest)
+    streaming = True
+    try:
+        for chunk in chunks:
+            if not chunk:
+                continue
+            spool.write(chunk)
+            if streaming:
+                try:
+                    extractor.feed(chunk)
+                except (StreamingUnsupported, zipfile.BadZipFile, zlib.error, struct.error) as err:
+                    # Corrupt data is left for the central directory to confirm or refute
+                    logger.info(f"Falling back to extracting after download ({err})")
+                    extractor.abort()
+                    streaming = False
+    except Exception:
+        # The download failed, don't leave the entry being written open
+        extractor.abort()
+        spool.close()
+        raise
+    if streaming and not extractor.done:
+        # An archive that ended early leaves its last entry open
+        extractor.abort()
+        streaming = False
+
+    spool.seek(0)
+    with zipfile.ZipFile(spool, "r") as z:
+        expected = {info.filename: info.CRC for info in z.infolist()}
+        if not streaming or not extractor.done or extractor.extracted != expected:
+            if streaming:
+                logger.info("Streamed entries don't match the central directory, extracting again")
+            z.extractall(dest)
+    spool.seek(0)
+    return spool
@@ -0,0 +1,178 @@
+# Request bodies that stream files from disk
+import os
+import time
+import uuid
+import logging
+
+logger = logging.getLogger('deploy.uploads')
+
+CHUNK_SIZE = 1024 * 1024
+PROGRESS_INTERVAL = 10.0  # seconds between progress reports
+
+
+class UploadProgress(object):
+    """
+    Progress callback for uploads. Logs the bytes sent and the throughput at a
+    fixed interval and once the upload is complete.
+    """
+
+    def __init__(self, name, total, interval=PROGRESS_INTERVAL, log=None):
+        """
+        Inputs:
+            name (str): what is being uploaded, for the log
+            total (int): size of the upload in bytes
+            interval (float): seconds between reports
+            log (logging.Logger): logger to report to
+        """
+        self.name = name
+        self.total = total
+        self.interval = interval
+        self.log = log or logger
+        self.sent = 0
+        self.start = None
+        self.last_report = None
+
+    def __call__(self, sent):
+        """
+        Records that more bytes were sent
+
+        Inputs:
+            sent (int): bytes sent since the last call
+        """
+        now = time.perf_counter()
+        if self.start is None:
+            self.start = self.last_report = now
+        self.sent += sent
+        if self.sent >= self.total or now - self.last_report >= self.interval:
+            self.last_report = now
+            self.log.info(f"Uploaded {self.sent}/{self.total} bytes of {self.name} ({self.rate() / 1024 / 1024:.2f} MB/s)")
+
+    def rate(self):
+        """Returns the average upload speed so far in bytes/s"""
+        if self.start is None:
+            return 0.0
+        elapsed = time.perf_counter() - self.start
+        return self.sent / elapsed if elapsed > 0 else 0.0
+
+
+class StreamingBody(object):
+    """
+    A request body made of byte strings and files, read from disk in fixed size
+    chunks as it is sent. The length is known up front, so requests sends a
+    Content-Length header rather than a chunked body, and memory use does not
+    depend on the size of the files.
+    """
+
+    def __init__(self, parts, chunk_size=CHUNK_SIZE, progress=None):
+        """
+        Inputs:
+            parts (list): the body in order, each part being bytes or the path of a file
+            chunk_size (int): size of the blocks read from files
+            progress (callable): called with the number of bytes in each block read
+        """
+        self.parts = [part if isinstance(part, bytes) else os.fspath(part) for part in parts]
+        self.chunk_size = chunk_size
+        self.progress = progress
+        self.length = sum(len(part) if isinstance(part, bytes) else os.path.getsize(part) for part in self.parts)
+        self.position = 0
+        self._index = 0
+        self._offset = 0
+        self._file = None
+
+    def __len__(self):
+        return self.length
+
+    def tell(self):
+        return self.position
+
+    def read(self, size=-1):
+        """
+        Returns the next bytes of the body
+
+        Inputs:
+            size (int): maximum number of bytes to return, or -1 for the next chunk
+        Returns:
+            data (bytes): the data, empty at the end of the body
+        """
+        if size is None or size < 0:
+            size = self.chunk_size
+        data = bytearray()
+        while len(data) < size and self._index < len(self.parts):
+            part = self.parts[self._index]
+            if isinstance(part, bytes):
+                block = part[self._offset:self._offset + size - len(data)]
+                self._offset += len(block)
+                done = self._offset >= len(part)
+            else:
+                if self._file is None:
+                    self._file = open(part, "rb")
+                block = self._file.read(min(self.chunk_size, size - len(data)))
+                done = not block
+                if done:
+                    self._file.close()
+                    self._file = None
+            data += block
+            if done:
+                self._index += 1
+                self._offset = 0
+        self.position += len(data)
+        if data and self.progress is not None:
+            self.progress(len(data))
+        return bytes(data)
+
+    def __iter__(self):
+        while True:
+            block = self.read(self.chunk_size)
+            if not block:
+                return
+            yield block
+
+    def close(self):
+        """Closes the file currently being read, if any"""
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class MultipartBody(StreamingBody):
+    """
+    A multipart/form-data request body whose files are streamed from disk
+    """
+
+    def __init__(self, fields, files, chunk_size=CHUNK_SIZE, progress=None):
+        """
+        Inputs:
+            fields (dict): form field name -> string value
+            files (dict): form field name -> path of the file to send
+            chunk_size (int): size of the blocks read from files
+            progress (callable): called with the number of bytes in each block read
+        """
+        self.boundary = uuid.uuid4().hex
+        parts = []
+        for name, value in fields.items():
+            parts.append(self._part_header(name) + b"\r\n" + str(value).encode("utf-8") + b"\r\n")
+        for name, path in files.items():
+            filename = os.path.basename(path).replace('"', "%22")
+            parts.append(self._part_header(name, filename) +
+                         b"Content-Type: application/octet-stream\r\n\r\n")
+            parts.append(path)
+            parts.append(b"\r\n")
+        parts.append(f"--{self.boundary}--\r\n".encode("ascii"))
+        super().__init__(parts, chunk_size, progress)
+
+    @property
+    def content_type(self):
+        """The Content-Type header for the body"""
+        return f"multipart/form-data; boundary={self.boundary}"
+
+    def _part_header(self, name, filename=None):
+        disposition = f'form-data; name="{name}"'
+        if filename is not None:
+            disposition += f'; filename="{filename}"'
+        return f"--{self.boundary}\r\nContent-Disposition: {disposition}\r\n".encode("utf-8")
@@ -8,12 +8,17 @@ from argparse import ArgumentParser
 import logging
 
 from ksp_deploy.logging import set_logging
-from ksp_deploy.helpers import clean_path, get_build_data, get_version_file_info, get_version
-from ksp_deploy.packaging import collect_dependencies, build_extras, build_nodep_release, build_full_release
-from ksp_deploy.config import KSPConfiguration
+from ksp_deploy.helpers import clean_path, get_version
+from ksp_deploy.context import BuildContext
+from ksp_deploy.staging import StagingManifest
+from ksp_deploy.manifest import write_manifest
+from ksp_deploy.packaging import (collect_dependencies, build_extras, build_release_archives,
+    core_release_path, full_release_path, extra_release_path, stash_previous_release, update_release_stash)
 
+logger = logging.getLogger("packager")
 
-def package(core_release, extras_release, complete_release, mod_data_file):
+
+def package(core_release, extras_release, complete_release, mod_data_file, incremental=False, context=None):
     """
     Compiles and packages the set of release packages according to information from
     the .version file and the .build_data.yml file
@@ -22,56 +27,89 @@ def package(core_release, extras_release, complete_release, mod_data_file):
         extras_release (bool): whether to build a release zip for each extra file
         complete_release (bool): whether to build a yes dependency release zip
         mod_data_file (str): path to mod data yaml (defaults to the one in ksp_deploy.config.py)
+        incremental (bool): whether to reuse unchanged entries from the previous release zips
+        context (BuildContext): already parsed build inputs, read from mod_data_file if not given
+    Returns:
+        artifacts (dict): paths of the zips written, the "core" and "full" zips (or None
+            if not built), a list of "extras" zips and the checksum "manifest" (or None)
     """
-    # Create/load the config
-    config = KSPConfiguration()
-
-    # Collect build information
-    if mod_data_file == "":
-        mod_data_file = config.BUILD_DATA_NAME
-    build_data = get_build_data(mod_data_file)
-    version_data = get_version_file_info(os.path.join(os.path.dirname(mod_data_file), "GameData", build_data['mod-name']), build_data['mod-name'])
+    # Create/load the config and collect build information
+    context = context or BuildContext(mod_data_file)
+    config = context.config
+    mod_data_file = context.mod_data_file
+    build_data = context.build_data
+    version_data = context.version_data
 
     logger.info(f"Building {build_data['mod-name']} version {get_version(version_data)}\n=================")
 
     build_mod_path = os.path.join(config.BUILD_PATH, build_data['mod-name'])
     deploy_mod_path = os.path.join(config.DEPLOY_PATH, build_data['mod-name'])
+    stash_path = os.path.join(config.CACHE_PATH, "releases", build_data['mod-name'])
     extras_path = "Extras"
     extras_list = []
+    references = []
+    if incremental or config.INCREMENTAL_PACKAGING:
+        references = stash_previous_release(deploy_mod_path, stash_path)
+        logger.info(f"Building incrementally against {len(references)} previous zips")
     # Clean/recreate the build, deploy and temp paths
     clean_path(os.path.join(build_mod_path))
     clean_path(os.path.join(deploy_mod_path))
     clean_path(os.path.join(config.TEMP_PATH))
 
-    # Copy main mod content
+    # Stage main mod content. Nothing is copied, archives are written from the sources
     logger.info(f"Compiling core mod content")
+    manifest = StagingManifest()
 
-    for gamedata_item in build_data['package']['included-gamedata']:
-        shutil.copytree(os.path.join(os.path.dirname(mod_data_file), "GameData"), os.path.join(build_mod_path, "GameData"))
+    if build_data['package']['included-gamedata']:
+        manifest.add_tree(os.path.join(os.path.dirname(mod_data_file), "GameData"), "GameData")
 
     for support_item in build_data['package']['included-support']:
-        shutil.copy(os.path.join(os.path.dirname(mod_data_file), support_item), os.path.join(build_mod_path))
-
-    if core_release:
-        logger.info(f"Packaging BASIC release package")
-        build_nodep_release(version_data, build_data, build_mod_path, deploy_mod_path)
+        manifest.add_file(os.path.join(os.path.dirname(mod_data_file), support_item), os.path.basename(support_item))
 
     if 'extras-path' in build_data['package']:
         extras_path = build_data['package']['extras-path']
+    extras_path = os.path.join(os.path.dirname(mod_data_file), extras_path)
     if 'included-extras:' in build_data['package']:
         extras_list = build_data['package']['included-extras:']
 
     if os.path.exists(extras_path):
-      logger.info(f"Packaging EXTRAS release packages at {extras_path}")
-      build_extras(version_data, build_mod_path, deploy_mod_path, extras_path, extras_list=extras_list, build_packages=extras_release)
+      logger.info(f"Compiling EXTRAS at {extras_path}")
+      extras_list = build_extras(manifest, extras_path, extras_list=extras_list)
+    else:
+      extras_list = []
+
+    core_files = manifest.select(exclude_top=("Extras",))
 
-    logger.info(f"Packaging complete release package")
     logger.info(f"Collecting dependencies")
-    collect_dependencies(build_data, build_mod_path, config)
+    collect_dependencies(build_data, manifest, config)
+
+    archives = {}
+    artifacts = {"core": None, "full": None, "extras": [], "manifest": None}
+    if core_release:
+        logger.info(f"Packaging BASIC release package")
+        artifacts["core"] = core_release_path(version_data, build_data, deploy_mod_path)
+        archives[artifacts["core"]] = core_files
+
+    if extras_release:
+        for name in extras_list:
+            logger.info(f"Packaging EXTRA release package {name}")
+            artifacts["extras"].append(extra_release_path(name, version_data, deploy_mod_path))
+            archives[artifacts["extras"][-1]] = manifest.subtree(os.path.join("Extras", name))
 
     if complete_release:
         logger.info(f"Packaging COMPLETE release package")
-        build_full_release(version_data, build_data, build_mod_path, deploy_mod_path)
+        artifacts["full"] = full_release_path(version_data, build_data, deploy_mod_path)
+        archives[artifacts["full"]] = manifest.select()
+
+    stats = build_release_archives(archives, config, references=references)
+    if stats is not None and config.WRITE_MANIFEST:
+        artifacts["manifest"] = write_manifest(deploy_mod_path, build_data['mod-name'], get_version(version_data), stats["archives"])
+    if config.MATERIALIZE_BUILD_PATH:
+        methods = manifest.materialize(build_mod_path)
+        logger.info(f"Linked release content into {build_mod_path}: {methods}")
+    if incremental or config.INCREMENTAL_PACKAGING:
+        update_release_stash(list(archives), stash_path)
+    return artifacts
 
 if __name__ == "__main__":
     parser = ArgumentParser()
@@ -86,9 +124,12 @@ if __name__ == "__main__":
                         help="write basic no dependency package")
     parser.add_argument("-f", "--file", default="",
                         help="custom package data file path")
+    parser.add_argument("-i", "--incremental",
+                        action="store_true", default=False,
+                        help="reuse unchanged files from the previous release zips")
 
     args = parser.parse_args()
 
     logger = set_logging("packager")
 
-    package(args.basic, args.extras, args.complete, args.file)
+    package(args.basic, args.extras, args.complete, args.file, incremental=args.incremental)
@@ -0,0 +1,73 @@
+# Pipeline entrypoint, running the stage, package and deploy steps in one process
+import sys
+from argparse import ArgumentParser
+
+from ksp_deploy.logging import set_logging
+from ksp_deploy.context import BuildContext
+from ksp_deploy.credentials import get_credential_store
+
+from stage import tag
+from package import package
+from deploy import deploy, deploy_failed
+
+
+def pipeline(core_release, extras_release, complete_release, mod_data_file, incremental=False, tag_release=True, deploy_release=True):
+    """
+    Tags, packages and deploys a mod. The config, build data and version file are
+    parsed once for all the steps, credentials are resolved once and the HTTP
+    session is shared, and deploy uploads the zips packaging just wrote
+
+    Inputs:
+        core_release (bool): whether to build a no-dependency release zip
+        extras_release (bool): whether to build a release zip for each extra file
+        complete_release (bool): whether to build a yes dependency release zip
+        mod_data_file (str): path to mod data yaml (defaults to the one in ksp_deploy.config.py)
+        incremental (bool): whether to reuse unchanged entries from the previous release zips
+        tag_release (bool): whether to tag the repo with the version
+        deploy_release (bool): whether to deploy the zips to the providers
+    Returns:
+        results (dict): provider name -> dictionary of result, duration and bytes/s, empty if not deployed
+    """
+    context = BuildContext(mod_data_file)
+    if tag_release:
+        tag(mod_data_file, context=context)
+    artifacts = package(core_release, extras_release, complete_release, mod_data_file,
+                        incremental=incremental, context=context)
+    if not deploy_release:
+        return {}
+    try:
+        return deploy(mod_data_file, context=context, artifacts=artifacts)
+    finally:
+        get_credential_store(context.config).wipe()
+
+if __name__ == "__main__":
+    parser = ArgumentParser()
+    parser.add_argument("-c", "--complete",
+                        action="store_true",  default=True,
+                        help="write complete package")
+    parser.add_argument("-e", "--extras",
+                        action="store_true", default=False,
+                        help="write extras package")
+    parser.add_argument("-b", "--basic",
+                        action="store_true", default=False,
+                        help="write basic no dependency package")
+    parser.add_argument("-f", "--file", default="",
+                        help="custom package data file path")
+    parser.add_argument("-i", "--incremental",
+                        action="store_true", default=False,
+                        help="reuse unchanged files from the previous release zips")
+    parser.add_argument("--no-tag",
+                        action="store_true", default=False,
+                        help="don't tag the repo")
+    parser.add_argument("--no-deploy",
+                        action="store_true", default=False,
+                        help="package without deploying")
+
+    args = parser.parse_args()
+
+    for log_name in ("staging", "packager", "deployment"):
+        set_logging(log_name)
+    results = pipeline(args.basic, args.extras, args.complete, args.file, incremental=args.incremental,
+                       tag_release=not args.no_tag, deploy_release=not args.no_deploy)
+    if deploy_failed(results):
+        sys.exit(1)
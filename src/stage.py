@@ -1,32 +1,32 @@
 # Takes specific pre-deploy actions after builds have completed, like tagging
 import os
+import logging
 import subprocess
 from argparse import ArgumentParser
 
 from ksp_deploy.credentials import find_credentials
-from ksp_deploy.helpers import get_build_data, get_version_file_info, get_version
-from ksp_deploy.config import KSPConfiguration
+from ksp_deploy.context import BuildContext
 from ksp_deploy.logging import set_logging
 
+logger = logging.getLogger("staging")
 
-def tag(mod_data_file):
+
+def tag(mod_data_file, context=None):
     """
     Tag the repo if needed.
 
     Inputs:
         mod_data_file (str): path to mod data yaml (defaults to the one in ksp_deploy.config.py)
+        context (BuildContext): already parsed build inputs, read from mod_data_file if not given
 
     """
 
-    # Create/load the config
-    config = KSPConfiguration()
-
-    if mod_data_file == "":
-        mod_data_file = config.BUILD_DATA_NAME
-    build_data = get_build_data(mod_data_file)
-    version_data = get_version_file_info(os.path.join(os.path.dirname(mod_data_file), "GameData", build_data['mod-name']), build_data['mod-name'])
+    # Create/load the config and collect build information
+    context = context or BuildContext(mod_data_file)
+    config = context.config
+    build_data = context.build_data
 
-    version = get_version(version_data)
+    version = context.version
 
     logger.info(f"Tagging {build_data['mod-name']} version {version}")
 
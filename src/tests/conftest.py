@@ -1,7 +1,15 @@
+from ksp_deploy.lint import DEFAULT_MAX_PATH_LENGTH
+
 
 def pytest_addoption(parser):
     parser.addoption("--testpath", action="append", default=[],
         help="path to run tests against")
+    parser.addoption("--max-path-length", type=int, nargs="?", default=None, const=DEFAULT_MAX_PATH_LENGTH,
+        help=f"check that no path is longer than this, {DEFAULT_MAX_PATH_LENGTH} characters if no length is given")
+    parser.addoption("--check-case-collisions", action="store_true", default=False,
+        help="check that no two paths only differ by case")
+    parser.addoption("--check-duplicates", action="store_true", default=False,
+        help="check that no entry appears twice")
 
 def pytest_generate_tests(metafunc):
     if 'testpath' in metafunc.fixturenames:
@@ -0,0 +1,124 @@
+# Tests for release zip writing
+import io
+import os
+import zipfile
+
+import pytest
+
+from ksp_deploy import archive
+from ksp_deploy.archive import CompressedEntry, ZipWriter, directory_entry, write_archives
+from ksp_deploy.compression import CompressionPolicy, DEFAULT_RULES
+
+def write_files(folder, files):
+    paths = {}
+    for name, data in files.items():
+        path = os.path.join(folder, name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "wb") as f:
+            f.write(data)
+        paths[name] = path
+    return paths
+
+def read_bytes(path):
+    with open(path, "rb") as f:
+        return f.read()
+
+def test_incremental_matches_full_rebuild(tmp_path):
+    """Test that reusing entries from a previous zip gives the same bytes as writing it from scratch"""
+    policy = CompressionPolicy(rules=DEFAULT_RULES)
+    text = b"PART { name = tank }\n" * 500
+    previous = write_files(str(tmp_path / "v1"), {
+        "GameData/Mod/tank.cfg": text,
+        "GameData/Mod/engine.cfg": b"PART { name = engine }\n" * 300,
+    })
+    write_archives({str(tmp_path / "v1.zip"): previous}, policy=policy)
+
+    # The same content moves to a .png, which the policy stores rather than deflates
+    current = write_files(str(tmp_path / "v2"), {
+        "GameData/Mod/tank.cfg": text,
+        "GameData/Mod/engine.cfg": b"PART { name = engine2 }\n" * 300,
+        "GameData/Mod/tank.png": text,
+    })
+    incremental = write_archives({str(tmp_path / "incremental.zip"): current},
+                                 policy=policy, references=[str(tmp_path / "v1.zip")])
+    write_archives({str(tmp_path / "full.zip"): current}, policy=policy)
+
+    assert incremental["reused"] == 1
+    assert read_bytes(tmp_path / "incremental.zip") == read_bytes(tmp_path / "full.zip")
+
+def test_shared_files_compressed_once(tmp_path):
+    """Test that zips written together are valid, and files they share are compressed once"""
+    files = write_files(str(tmp_path / "src"), {
+        "GameData/Mod/tank.cfg": b"PART { name = tank }\n" * 500,
+        "GameData/Mod/Parts/engine.cfg": b"PART { name = engine }\n" * 300,
+        "GameData/Dep/dep.dll": os.urandom(4096),
+    })
+    core = {name: path for name, path in files.items() if "Mod" in name}
+    stats = write_archives({str(tmp_path / "core.zip"): core, str(tmp_path / "full.zip"): files})
+
+    assert stats["files"] == 3
+    folders = ["GameData/", "GameData/Mod/", "GameData/Mod/Parts/"]
+    for name, expected, expected_folders in (("core.zip", core, folders),
+                                             ("full.zip", files, folders + ["GameData/Dep/"])):
+        with zipfile.ZipFile(tmp_path / name) as z:
+            assert z.testzip() is None
+            assert sorted(z.namelist()) == sorted(list(expected) + expected_folders)
+            for arcname, path in expected.items():
+                assert z.read(arcname) == read_bytes(path)
+
+def test_zip64_entry_count(tmp_path):
+    """Test that zips with more entries than the classic end record holds use zip64 records"""
+    path = str(tmp_path / "many.zip")
+    count = 0x10000 + 10
+    with ZipWriter(path) as writer:
+        for i in range(count):
+            writer.write(f"Folder{i}/", directory_entry())
+    with zipfile.ZipFile(path) as z:
+        assert len(z.infolist()) == count
+        assert z.infolist()[-1].filename == f"Folder{count - 1}/"
+
+def test_copy_to(tmp_path):
+    """Test that an entry copies its compressed data from the middle of a shared file, and checks its length"""
+    data = io.BytesIO(b"header" + b"compressed" + b"trailer")
+    entry = CompressedEntry(zipfile.ZIP_STORED, 0, 10, 10, (1980, 1, 1, 0, 0, 0), 0,
+                            data=data, data_offset=6, shared=True)
+    blocks = []
+    entry.copy_to(blocks.append)
+    assert b"".join(blocks) == b"compressed"
+    entry.close()
+    assert not data.closed
+
+    truncated = CompressedEntry(zipfile.ZIP_STORED, 0, 10, 10, (1980, 1, 1, 0, 0, 0), 0,
+                                data=io.BytesIO(b"short"))
+    with pytest.raises(zipfile.BadZipFile):
+        truncated.copy_to(blocks.append)
+
+def test_same_zip_with_any_worker_count(tmp_path):
+    """Test that compressing in a process pool writes the same bytes as compressing in this process"""
+    files = write_files(str(tmp_path / "src"), {
+        f"GameData/Mod/Parts/part{i}.cfg": f"PART {{ name = part{i} }}\n".encode("ascii") * (50 + i * 20)
+        for i in range(12)
+    })
+    write_archives({str(tmp_path / "serial.zip"): files}, workers=1)
+    write_archives({str(tmp_path / "parallel.zip"): files}, workers=3, parallel_threshold=0)
+    assert read_bytes(tmp_path / "serial.zip") == read_bytes(tmp_path / "parallel.zip")
+
+def test_spools_removed_when_writing_fails(tmp_path, monkeypatch):
+    """Test that compressed data prepared ahead of a failed write doesn't leave temporary files behind"""
+    files = write_files(str(tmp_path / "src"), {
+        f"GameData/Mod/Parts/part{i}.cfg": f"PART {{ name = part{i} }}\n".encode("ascii") * 200 for i in range(24)
+    })
+    spool_dir = tmp_path / "spool"
+    os.makedirs(spool_dir)
+    # Every compressed file is handed back through a temporary file
+    monkeypatch.setattr(archive, "SPOOL_SIZE", 0)
+    write = ZipWriter.write
+    def failing_write(self, arcname, entry):
+        if arcname.endswith("part3.cfg"):
+            raise OSError("No space left on device")
+        return write(self, arcname, entry)
+    monkeypatch.setattr(ZipWriter, "write", failing_write)
+
+    with pytest.raises(OSError):
+        write_archives({str(tmp_path / "release.zip"): files}, spool_dir=str(spool_dir), workers=3, parallel_threshold=0)
+    assert os.listdir(spool_dir) == []
@@ -0,0 +1,112 @@
+# Tests for the dependency cache
+import io
+import os
+import zipfile
+from concurrent.futures import ProcessPoolExecutor
+from types import SimpleNamespace
+
+import pytest
+
+import ksp_deploy.aws.s3 as s3
+from ksp_deploy.cache import DependencyCache
+
+FILES = {"GameData/Dep/dep.cfg": b"PART { name = dep }\n" * 100, "GameData/Dep/dep.dll": b"\x00" * 500}
+
+
+def make_archive(files=FILES):
+    data = io.BytesIO()
+    with zipfile.ZipFile(data, "w", zipfile.ZIP_DEFLATED) as z:
+        for name, contents in files.items():
+            z.writestr(name, contents)
+    data.seek(0)
+    return data
+
+def staged(path):
+    found = {}
+    for root, _, files in os.walk(path):
+        for name in files:
+            with open(os.path.join(root, name), "rb") as f:
+                found[os.path.relpath(os.path.join(root, name), path).replace(os.sep, "/")] = f.read()
+    return found
+
+def test_store_and_fetch(tmp_path):
+    """Test that a stored archive stages the dependency again, and unknown keys miss"""
+    cache = DependencyCache(str(tmp_path / "cache"), 1024 * 1024)
+    assert not cache.fetch("dep", str(tmp_path / "miss"))
+    cache.store("dep", make_archive())
+    assert cache.fetch("dep", str(tmp_path / "hit"))
+    assert staged(str(tmp_path / "hit")) == FILES
+    assert (cache.hits, cache.misses) == (1, 1)
+    assert sorted(os.listdir(cache.path)) == [".lock", "dep.zip"]
+
+def test_lru_eviction(tmp_path):
+    """Test that the least recently used entries are evicted once the cache is over its size"""
+    size = len(make_archive().getvalue())
+    cache = DependencyCache(str(tmp_path / "cache"), size * 2)
+    for age, key in enumerate(["old", "used"]):
+        cache.store(key, make_archive())
+        os.utime(cache.entry_path(key), (1000 + age, 1000 + age))
+    # Using the oldest entry makes the other one the least recently used
+    assert cache.fetch("old", str(tmp_path / "staged"))
+    cache.store("new", make_archive())
+    assert sorted(name for name in os.listdir(cache.path) if name.endswith(".zip")) == ["new.zip", "old.zip"]
+
+@pytest.mark.parametrize("damage", ["truncated", "corrupted"])
+def test_damaged_entries_discarded(tmp_path, damage):
+    """Test that a damaged entry is a miss and is removed, rather than reused by every build"""
+    cache = DependencyCache(str(tmp_path / "cache"), 1024 * 1024)
+    cache.store("dep", make_archive())
+    with open(cache.entry_path("dep"), "r+b") as f:
+        data = f.read()
+        if damage == "truncated":
+            f.truncate(len(data) // 2)
+        else:
+            # Changes the compressed data of the first entry, leaving the zip's structure intact
+            f.seek(60)
+            f.write(bytes(b ^ 0xFF for b in data[60:80]))
+    assert not cache.fetch("dep", str(tmp_path / "staged"))
+    assert not os.path.exists(cache.entry_path("dep"))
+    assert cache.misses == 1
+
+def use_cache(path, worker):
+    # Each process stores and fetches entries in a cache too small to keep them all
+    cache = DependencyCache(path, len(make_archive().getvalue()) * 3)
+    for i in range(20):
+        key = f"dep{(worker + i) % 6}"
+        if not cache.fetch(key, os.path.join(path, "..", f"staged{worker}")):
+            cache.store(key, make_archive())
+    return cache.hits + cache.misses
+
+def test_processes_share_cache(tmp_path):
+    """Test that processes using the same cache at once never see a missing or partial entry"""
+    path = str(tmp_path / "cache")
+    DependencyCache(path, 0)
+    with ProcessPoolExecutor(max_workers=4) as pool:
+        assert list(pool.map(use_cache, [path] * 4, range(4))) == [20] * 4
+    entries = [name for name in os.listdir(path) if name != ".lock"]
+    assert len(entries) <= 3
+    assert all(name.endswith(".zip") for name in entries)
+    for name in entries:
+        with zipfile.ZipFile(os.path.join(path, name)) as z:
+            assert z.testzip() is None
+
+def test_shared_tier(tmp_path, monkeypatch):
+    """Test that an entry pushed to the shared tier is fetched by a cache that doesn't have it"""
+    moto = pytest.importorskip("moto")
+    for name in ("AWS_ACCESS_KEY_ID", "AWS_SECRET_ACCESS_KEY"):
+        monkeypatch.setenv(name, "testing")
+    monkeypatch.setattr(s3, "_clients", {})
+    config = SimpleNamespace(AWS_REGION="us-east-2", S3_ENDPOINT_URL=None, ENABLE_SSL=True,
+                             S3_MULTIPART_THRESHOLD_MB=64, S3_MULTIPART_CHUNK_MB=16, S3_MAX_CONCURRENCY=4,
+                             S3_VERIFY_CHECKSUMS=True, S3_VERIFY_DOWNLOADS=True)
+    with moto.mock_aws():
+        s3.get_client(config).create_bucket(Bucket="dependencies",
+            CreateBucketConfiguration={"LocationConstraint": "us-east-2"})
+        DependencyCache(str(tmp_path / "first"), 1024 * 1024, "s3://dependencies/cache", config).store("dep", make_archive())
+
+        cache = DependencyCache(str(tmp_path / "second"), 1024 * 1024, "s3://dependencies/cache", config)
+        assert cache.fetch("dep", str(tmp_path / "staged"))
+        assert not cache.fetch("other", str(tmp_path / "other"))
+        assert (cache.hits, cache.shared_hits, cache.misses) == (0, 1, 1)
+        assert staged(str(tmp_path / "staged")) == FILES
+        assert os.path.exists(cache.entry_path("dep"))
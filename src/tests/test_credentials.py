@@ -0,0 +1,75 @@
+# Tests for resolving deploy credentials
+from types import SimpleNamespace
+
+import pytest
+
+import ksp_deploy.aws.ssm as ssm
+from ksp_deploy import credentials
+from ksp_deploy.credentials import CredentialStore, get_credential_store
+
+NAMES_TO_KEYS = {"GITHUB_USER": "ksp-github-user", "GITHUB_OAUTH_TOKEN": "ksp-github-token"}
+
+
+def make_config(**settings):
+    config = dict(CREDENTIALS_BACKEND="env", USE_SSM_CREDENTIALS=False, CRED_NAME_TO_KEYS=NAMES_TO_KEYS,
+                  CREDENTIALS_TTL=900, ENABLE_SSL=True, AWS_REGION="us-east-2", CREDENTIALS_FILE=None)
+    config.update(settings)
+    return SimpleNamespace(**config)
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(credentials, "time", SimpleNamespace(monotonic=lambda: now[0]))
+    return now
+
+def test_env_backend_ttl_and_wipe(monkeypatch, clock):
+    """Test that credentials are kept until the TTL runs out or the store is wiped"""
+    monkeypatch.setenv("GITHUB_USER", "first")
+    store = CredentialStore("env", NAMES_TO_KEYS, ttl=60)
+    assert store.get("GITHUB_USER") == "first"
+
+    monkeypatch.setenv("GITHUB_USER", "second")
+    clock[0] += 30
+    assert store.get("GITHUB_USER") == "first"
+    clock[0] += 31
+    assert store.get("GITHUB_USER") == "second"
+
+    monkeypatch.setenv("GITHUB_USER", "third")
+    store.wipe()
+    assert store.values == {}
+    assert store.get("GITHUB_USER") == "third"
+
+    with pytest.raises(KeyError):
+        store.get("GITHUB_OAUTH_TOKEN")
+
+def test_file_backend(tmp_path):
+    """Test that credentials are read from a YAML file, as strings"""
+    path = tmp_path / "credentials.yml"
+    path.write_text("GITHUB_USER: nertea\nSPACEDOCK_PASSWORD: 1234\n")
+    store = CredentialStore.from_config(make_config(CREDENTIALS_BACKEND="file", CREDENTIALS_FILE=str(path)))
+    assert store.get("GITHUB_USER") == "nertea"
+    assert store.get("SPACEDOCK_PASSWORD") == "1234"
+    with pytest.raises(KeyError):
+        store.get("GITHUB_OAUTH_TOKEN")
+
+def test_ssm_backend(monkeypatch):
+    """Test that the configured credentials are fetched from a local stand-in for SSM"""
+    moto = pytest.importorskip("moto")
+    for name in ("AWS_ACCESS_KEY_ID", "AWS_SECRET_ACCESS_KEY"):
+        monkeypatch.setenv(name, "testing")
+    monkeypatch.setattr(ssm, "_clients", {})
+    with moto.mock_aws():
+        client = ssm.get_client(region="us-east-2")
+        client.put_parameter(Name="ksp-github-user", Value="nertea", Type="SecureString")
+        client.put_parameter(Name="ksp-github-token", Value="token", Type="SecureString")
+        store = CredentialStore("ssm", NAMES_TO_KEYS, region="us-east-2")
+        assert store.get("GITHUB_USER") == "nertea"
+        # Fetched in the same request as the first credential
+        assert store.values["GITHUB_OAUTH_TOKEN"] == "token"
+
+def test_stores_shared_by_settings():
+    """Test that configs only share a store when every setting of the store is the same"""
+    store = get_credential_store(make_config())
+    assert get_credential_store(make_config()) is store
+    assert get_credential_store(make_config(CREDENTIALS_TTL=60)) is not store
+    assert get_credential_store(make_config(CRED_NAME_TO_KEYS={"GITHUB_USER": "other-user"})) is not store
@@ -0,0 +1,49 @@
+# Tests for the release linter
+import os
+import zipfile
+import warnings
+
+from ksp_deploy.lint import Linter, default_rules, read_entry_names
+
+NAMES = [
+    "GameData/Mod/",
+    "GameData/Mod/Parts/tank.cfg",
+    "GameData/Mod/Parts/tank.tga",
+    "GameData/Mod/Parts/tank-b.dds",
+    "GameData/Mod/Parts/Tank.cfg",
+    "GameData/Mod/" + "x" * 200 + ".cfg",
+]
+
+def write_zip(path, names):
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore")  # zipfile warns about duplicate names
+        with zipfile.ZipFile(path, "w") as zf:
+            for name in names:
+                zf.writestr(name, b"")
+
+def test_lint_zip(tmp_path):
+    """Test that each rule reports its entry, from a zip's central directory"""
+    path = str(tmp_path / "release.zip")
+    write_zip(path, NAMES + ["GameData/Mod/Parts/tank.cfg"])
+    assert read_entry_names(path) == NAMES + ["GameData/Mod/Parts/tank.cfg"]
+    found = {(issue.rule, issue.entry) for issue in Linter(default_rules(200, True, True)).lint(path)}
+    assert found == {
+        ("tga", "GameData/Mod/Parts/tank.tga"),
+        ("intermediate", "GameData/Mod/Parts/tank-b.dds"),
+        ("case-collision", "GameData/Mod/Parts/Tank.cfg"),
+        ("path-length", NAMES[-1]),
+        ("duplicate-entry", "GameData/Mod/Parts/tank.cfg"),
+    }
+    # Only the checks every release has always passed are made by default
+    assert {issue.rule for issue in Linter().lint(path)} == {"tga", "intermediate"}
+
+def test_lint_many(tmp_path):
+    """Test that zips and folders are linted alike"""
+    folder = tmp_path / "release"
+    os.makedirs(folder / "GameData" / "Mod")
+    (folder / "GameData" / "Mod" / "tank.tga").write_bytes(b"")
+    path = str(tmp_path / "release.zip")
+    write_zip(path, ["GameData/Mod/tank.cfg"])
+    results = Linter().lint_many([str(folder), path])
+    assert [(issue.rule, issue.entry) for issue in results[str(folder)]] == [("tga", "GameData/Mod/tank.tga")]
+    assert results[path] == []
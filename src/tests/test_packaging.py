@@ -1,22 +1,44 @@
-# Tests for packaging items
-import os
+# Tests for packaging items, run against release zips or folders
+from functools import lru_cache
 
-def test_no_tgas(testpath):
+import pytest
+
+from ksp_deploy.lint import Linter, default_rules
+
+@lru_cache(maxsize=None)
+def lint_issues(testpath, max_path_length, case_collisions, duplicates):
+    """Checks a test path against every enabled rule in a single pass, once for all the tests"""
+    return Linter(default_rules(max_path_length, case_collisions, duplicates)).lint(testpath)
+
+def issues_of(testpath, rule, config):
+    options = (config.getoption("max_path_length"), config.getoption("check_case_collisions"),
+               config.getoption("check_duplicates"))
+    issues = [issue.entry for issue in lint_issues(testpath, *options) if issue.rule == rule]
+    print(issues)
+    return issues
+
+def test_no_tgas(testpath, pytestconfig):
     """Test that no tga files are left when packaging"""
-    tgas = []
-    for path, subdirs, files in os.walk(testpath):
-        for name in files:
-            if '.tga' in name:
-                tgas.append(os.path.join(path, name))
-    print(tgas)
-    assert len(tgas) == 0
-
-def test_no_intermediates(testpath):
+    assert len(issues_of(testpath, "tga", pytestconfig)) == 0
+
+def test_no_intermediates(testpath, pytestconfig):
     """Test that no intermediate workflow files are left when packaging"""
-    intermediate_files = []
-    for path, subdirs, files in os.walk(testpath):
-        for name in files:
-            if '-b.dds' in name:
-                intermediate_files.append(os.path.join(path, name))
-    print(intermediate_files)
-    assert len(intermediate_files) == 0
+    assert len(issues_of(testpath, "intermediate", pytestconfig)) == 0
+
+def test_path_lengths(testpath, pytestconfig):
+    """Test that no path is too long to install"""
+    if not pytestconfig.getoption("max_path_length"):
+        pytest.skip("path lengths are only checked with --max-path-length")
+    assert len(issues_of(testpath, "path-length", pytestconfig)) == 0
+
+def test_no_case_collisions(testpath, pytestconfig):
+    """Test that no two paths only differ by case"""
+    if not pytestconfig.getoption("check_case_collisions"):
+        pytest.skip("case collisions are only checked with --check-case-collisions")
+    assert len(issues_of(testpath, "case-collision", pytestconfig)) == 0
+
+def test_no_duplicate_entries(testpath, pytestconfig):
+    """Test that no entry appears twice"""
+    if not pytestconfig.getoption("check_duplicates"):
+        pytest.skip("duplicate entries are only checked with --check-duplicates")
+    assert len(issues_of(testpath, "duplicate-entry", pytestconfig)) == 0
@@ -0,0 +1,93 @@
+# Tests for dependency graph resolution
+import os
+import subprocess
+from types import SimpleNamespace
+
+from ksp_deploy.mirror import GitMirror
+from ksp_deploy.resolver import DependencyNode, DependencyResolver, bundled_package, topological_order
+
+CONFIG = SimpleNamespace(DEPENDENCY_WORKERS=2, BUILD_DATA_NAME=".mod_data.yml")
+
+
+def github(repo, tag):
+    return {"location": "github", "repository": repo, "tag": tag}
+
+
+class DeclaredResolver(DependencyResolver):
+    """Resolver reading the dependencies each package declares from a dictionary"""
+
+    def __init__(self, declared, **kwargs):
+        super().__init__("Mod", CONFIG, **kwargs)
+        self.declared = declared
+
+    def declared_dependencies(self, node):
+        return self.declared.get(node.name, {})
+
+def test_transitive_dependencies_in_order():
+    """Test that dependencies of dependencies are found, each package once and after what it requires"""
+    resolver = DeclaredResolver({
+        "B9PartSwitch": {"ModuleManager": github("sarbian/ModuleManager", "4.2.1")},
+        "CommunityResourcePack": {"ModuleManager": github("sarbian/ModuleManager", "4.2.1")},
+    })
+    nodes = resolver.resolve({
+        "B9PartSwitch": github("blowfishpro/B9PartSwitch", "v2.18.0"),
+        "CommunityResourcePack": github("UmbraSpaceIndustries/CRP", "1.4.2"),
+    })
+    names = [node.name for node in nodes]
+    assert sorted(names) == ["B9PartSwitch", "CommunityResourcePack", "ModuleManager"]
+    assert names.index("ModuleManager") < names.index("B9PartSwitch")
+    assert names.index("ModuleManager") < names.index("CommunityResourcePack")
+
+def test_nearest_declaration_wins():
+    """Test that the mod's own record of a package wins over those of its dependencies"""
+    resolver = DeclaredResolver({"B9PartSwitch": {"ModuleManager": github("sarbian/ModuleManager", "4.1.0")}})
+    nodes = resolver.resolve({
+        "B9PartSwitch": github("blowfishpro/B9PartSwitch", "v2.18.0"),
+        "ModuleManager": github("sarbian/ModuleManager", "4.2.1"),
+    })
+    module_manager = [node for node in nodes if node.name == "ModuleManager"][0]
+    assert module_manager.info["tag"] == "4.2.1"
+    assert module_manager.parent is None
+
+def test_not_transitive_and_self_dependency():
+    """Test that declared dependencies are ignored when not transitive, and the mod never depends on itself"""
+    declared = {"B9PartSwitch": {"ModuleManager": github("sarbian/ModuleManager", "4.2.1")}}
+    dependencies = {"B9PartSwitch": github("blowfishpro/B9PartSwitch", "v2.18.0"), "Mod": github("me/Mod", "1.0")}
+    assert [n.name for n in DeclaredResolver(declared, transitive=False).resolve(dependencies)] == ["B9PartSwitch"]
+
+def test_cycles():
+    """Test that a dependency cycle still orders every package once"""
+    nodes = {name: DependencyNode(name, {}) for name in ("A", "B", "C")}
+    nodes["A"].requires = ["B"]
+    nodes["B"].requires = ["C"]
+    nodes["C"].requires = ["A"]
+    assert [node.name for node in topological_order(nodes)] == ["C", "B", "A"]
+
+def test_bundled_package():
+    """Test that copies of a resolved package bundled inside another are recognized"""
+    packages = ["ModuleManager", "B9PartSwitch"]
+    assert bundled_package(os.path.join("GameData", "ModuleManager.4.2.1.dll"), packages, "B9PartSwitch") == "ModuleManager"
+    assert bundled_package(os.path.join("GameData", "ModuleManager.4.2.1.dll"), packages, "ModuleManager") is None
+    assert bundled_package(os.path.join("GameData", "B9PartSwitch", "Plugins"), packages, "Other") == "B9PartSwitch"
+    assert bundled_package(os.path.join("GameData", "ModuleManagerWatchdog.dll"), packages, "B9PartSwitch") is None
+    assert bundled_package("ModuleManager.dll", packages, "B9PartSwitch") is None
+
+def test_declared_dependencies_from_mirror(tmp_path):
+    """Test that a GitHub dependency's own .mod_data.yml is read from the tag in the local mirror"""
+    repo = str(tmp_path / "repo")
+    git = ["git", "-c", "user.name=test", "-c", "user.email=test@example.com", "-C", repo]
+    subprocess.run(["git", "init", "--quiet", repo], check=True)
+    with open(os.path.join(repo, ".mod_data.yml"), "w") as f:
+        f.write("dependencies:\n  ModuleManager:\n    location: s3\n    version: 4.2.1\n")
+    subprocess.run(git + ["add", ".mod_data.yml"], check=True)
+    subprocess.run(git + ["commit", "--quiet", "-m", "Release"], check=True)
+    subprocess.run(git + ["tag", "v1.0"], check=True)
+
+    config = SimpleNamespace(**vars(CONFIG), CACHE_PATH=str(tmp_path / "cache"))
+    # Warm the mirror from the local repository, so resolving doesn't touch the network
+    mirror = GitMirror.from_config("owner/Dep", config)
+    mirror.url = repo
+    mirror.ensure_tag("v1.0")
+
+    nodes = DependencyResolver("Mod", config).resolve({"Dep": github("owner/Dep", "v1.0")})
+    assert [(node.name, node.parent) for node in nodes] == [("ModuleManager", "Dep"), ("Dep", None)]
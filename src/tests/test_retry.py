@@ -0,0 +1,98 @@
+# Tests for retrying provider API requests
+import time
+
+import pytest
+import requests
+
+from ksp_deploy.retry import RetryPolicy, retry_counters
+
+
+def response(status, headers=None):
+    resp = requests.Response()
+    resp.status_code = status
+    resp.headers.update(headers or {})
+    resp._content = b""
+    return resp
+
+def responses(*items):
+    """Returns a send function answering with each response in turn, and the list of calls"""
+    calls = []
+    def send():
+        calls.append(None)
+        item = items[len(calls) - 1]
+        if isinstance(item, Exception):
+            raise item
+        return item
+    return send, calls
+
+@pytest.fixture
+def sleeps(monkeypatch):
+    waited = []
+    monkeypatch.setattr(time, "sleep", waited.append)
+    return waited
+
+def test_retries_transient_errors_with_backoff(sleeps):
+    """Test that server errors are retried with exponentially growing delays"""
+    send, calls = responses(response(502), response(503), response(500), response(200))
+    policy = RetryPolicy("test-backoff", attempts=5, backoff=1.0)
+    assert policy.call(send).status_code == 200
+    assert len(calls) == 4
+    assert all(0 <= delay <= 2 ** i for i, delay in enumerate(sleeps))
+    assert retry_counters()["test-backoff"]["retries"] == 3
+
+def test_gives_up_after_attempts(sleeps):
+    """Test that the last response is returned once the attempts run out"""
+    send, calls = responses(*[response(500)] * 3)
+    assert RetryPolicy("test-attempts", attempts=3).call(send).status_code == 500
+    assert len(calls) == 3
+    assert retry_counters()["test-attempts"]["failures"] == 1
+
+def test_follows_retry_after(sleeps):
+    """Test that the delay the server asks for is used, and too long a delay isn't waited"""
+    send, calls = responses(response(429, {"Retry-After": "7"}), response(200))
+    assert RetryPolicy("test-retry-after").call(send).status_code == 200
+    assert sleeps == [7.0]
+
+    send, calls = responses(response(429, {"Retry-After": "3600"}), response(200))
+    assert RetryPolicy("test-retry-after", max_delay=60).call(send).status_code == 429
+    assert len(calls) == 1
+
+def test_github_rate_limit(sleeps):
+    """Test that a 403 from an exhausted rate limit is retried, and other 403s aren't"""
+    reset = str(int(time.time()) + 5)
+    send, calls = responses(response(403, {"X-RateLimit-Remaining": "0", "X-RateLimit-Reset": reset}), response(200))
+    assert RetryPolicy("test-rate-limit").call(send).status_code == 200
+    assert 0 < sleeps[0] <= 7
+
+    send, calls = responses(response(403), response(200))
+    assert RetryPolicy("test-rate-limit").call(send).status_code == 403
+    assert len(calls) == 1
+
+def test_non_idempotent_requests(sleeps):
+    """Test that uploads are only retried when the server rejected them or a recheck shows they didn't land"""
+    # A 502 may have been applied, and nothing can tell
+    send, calls = responses(response(502), response(200))
+    assert RetryPolicy("test-upload").call(send, idempotent=False).status_code == 502
+    assert len(calls) == 1
+
+    # A 503 was turned away without being applied
+    send, calls = responses(response(503), response(200))
+    assert RetryPolicy("test-upload").call(send, idempotent=False).status_code == 200
+    assert len(calls) == 2
+
+    # The recheck finds the upload didn't land, then that it did
+    rechecks = [None, "already uploaded"]
+    send, calls = responses(response(502), response(504), response(200))
+    result = RetryPolicy("test-upload").call(send, idempotent=False, recheck=lambda: rechecks.pop(0))
+    assert result == "already uploaded"
+    assert len(calls) == 2
+
+def test_connection_errors(sleeps):
+    """Test that connection errors are retried, and raised once the attempts run out"""
+    error = requests.exceptions.ConnectionError("connection reset")
+    send, calls = responses(error, response(200))
+    assert RetryPolicy("test-connection").call(send).status_code == 200
+
+    send, calls = responses(error, error)
+    with pytest.raises(requests.exceptions.ConnectionError):
+        RetryPolicy("test-connection", attempts=2).call(send)
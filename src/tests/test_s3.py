@@ -0,0 +1,76 @@
+# Tests for S3 transfers, against moto's local stand-in for S3
+from types import SimpleNamespace
+
+import pytest
+
+moto = pytest.importorskip("moto")
+
+import ksp_deploy.aws.s3 as s3
+
+CONFIG = SimpleNamespace(AWS_REGION="us-east-2", S3_ENDPOINT_URL=None, ENABLE_SSL=True,
+                         S3_MULTIPART_THRESHOLD_MB=64, S3_MULTIPART_CHUNK_MB=16, S3_MAX_CONCURRENCY=4,
+                         S3_BATCH_WORKERS=2, S3_VERIFY_CHECKSUMS=True, S3_VERIFY_DOWNLOADS=False)
+
+
+@pytest.fixture
+def bucket(monkeypatch):
+    for name in ("AWS_ACCESS_KEY_ID", "AWS_SECRET_ACCESS_KEY"):
+        monkeypatch.setenv(name, "testing")
+    # Clients made by other tests would outlive their mock
+    monkeypatch.setattr(s3, "_clients", {})
+    with moto.mock_aws():
+        s3.get_client(CONFIG).create_bucket(Bucket="releases",
+            CreateBucketConfiguration={"LocationConstraint": CONFIG.AWS_REGION})
+        yield "releases"
+
+def write(path, data):
+    with open(path, "wb") as f:
+        f.write(data)
+    return str(path)
+
+def test_copy_records_checksum(tmp_path, bucket):
+    """Test that uploads record the file's SHA-256 under the key without a leading slash, and download back"""
+    src = write(tmp_path / "Mod.zip", b"release" * 1000)
+    s3.copy(src, f"s3://{bucket}/Mod/Mod.zip", CONFIG)
+
+    keys = [item["Key"] for item in s3.get_client(CONFIG).list_objects_v2(Bucket=bucket)["Contents"]]
+    assert keys == ["Mod/Mod.zip"]
+    assert s3.object_checksum(f"s3://{bucket}/Mod/Mod.zip", CONFIG) == s3.file_checksum(src)
+    assert s3.object_checksum(f"s3://{bucket}/Mod/Missing.zip", CONFIG) is None
+
+    s3.copy(f"s3://{bucket}/Mod/Mod.zip", str(tmp_path / "download.zip"), CONFIG)
+    assert s3.file_checksum(str(tmp_path / "download.zip")) == s3.file_checksum(src)
+
+def test_download_verification(tmp_path, bucket):
+    """Test that downloads are only checked when asked to, and only against a recorded checksum"""
+    client = s3.get_client(CONFIG)
+    client.put_object(Bucket=bucket, Key="wrong.zip", Body=b"data", Metadata={s3.CHECKSUM_METADATA: "0" * 64})
+    client.put_object(Bucket=bucket, Key="unrecorded.zip", Body=b"data")
+
+    s3.copy(f"s3://{bucket}/wrong.zip", str(tmp_path / "unchecked.zip"), CONFIG)
+    verify = SimpleNamespace(**dict(vars(CONFIG), S3_VERIFY_DOWNLOADS=True))
+    s3.copy(f"s3://{bucket}/unrecorded.zip", str(tmp_path / "unrecorded.zip"), verify)
+    with pytest.raises(s3.ChecksumMismatch):
+        s3.copy(f"s3://{bucket}/wrong.zip", str(tmp_path / "checked.zip"), verify)
+
+def test_upload_changed_skips_unchanged(tmp_path, bucket):
+    """Test that only files whose checksum differs from the object's are uploaded"""
+    core = write(tmp_path / "Mod_Core.zip", b"core")
+    full = write(tmp_path / "Mod.zip", b"full")
+    pairs = [(core, f"s3://{bucket}/Mod_Core.zip"), (full, f"s3://{bucket}/Mod.zip")]
+    assert sorted(s3.upload_changed(pairs, CONFIG)) == sorted(dest for _, dest in pairs)
+    assert s3.upload_changed(pairs, CONFIG) == []
+
+    write(tmp_path / "Mod.zip", b"full, rebuilt")
+    assert s3.upload_changed(pairs, CONFIG) == [f"s3://{bucket}/Mod.zip"]
+    # A checksum known from the manifest is trusted without hashing the file
+    assert s3.upload_changed(pairs, CONFIG, checksums={core: "0" * 64}) == [f"s3://{bucket}/Mod_Core.zip"]
+
+def test_clients_reused_per_region(bucket):
+    """Test that one client is kept for each region"""
+    client = s3.get_client(CONFIG)
+    assert s3.get_client(CONFIG) is client
+    other = s3.get_client(CONFIG, "eu-west-1")
+    assert other is not client
+    assert other.meta.region_name == "eu-west-1"
+    assert s3.get_client(CONFIG, "eu-west-1") is other
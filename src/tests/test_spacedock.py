@@ -0,0 +1,40 @@
+# Tests for querying SpaceDock
+import json
+
+import pytest
+import requests
+
+from ksp_deploy.apicache import APICache
+from ksp_deploy.retry import RetryPolicy
+from ksp_deploy.spacedock import SpaceDockAPI
+
+
+def response(status, body):
+    resp = requests.Response()
+    resp.status_code = status
+    resp._content = body.encode("utf-8")
+    return resp
+
+def client(tmp_path, monkeypatch, resp):
+    session = requests.Session()
+    monkeypatch.setattr(session, "get", lambda url, headers=None: resp)
+    cache = APICache(str(tmp_path / "api"))
+    return SpaceDockAPI("user", "password", session=session, retry=RetryPolicy("test-spacedock", attempts=1), cache=cache), cache
+
+def test_versions_found_and_cached(tmp_path, monkeypatch):
+    """Test that the versions of a mod are found, and the query kept for later runs"""
+    api, cache = client(tmp_path, monkeypatch, response(200, json.dumps({"versions": [{"friendly_version": "1.0", "id": 7}]})))
+    assert api.check_version_exists("123", "1.0")
+    assert not api.check_version_exists("123", "1.1")
+    assert cache.get("https://spacedock.info/api/mod/123")["versions"] == {"1.0": 7}
+
+@pytest.mark.parametrize("resp, error", [
+    (response(404, '{"error": true, "reason": "Mod not found"}'), requests.exceptions.HTTPError),
+    (response(200, "<html>Maintenance</html>"), ValueError),
+])
+def test_errors_raised_and_not_cached(tmp_path, monkeypatch, resp, error):
+    """Test that an error response isn't taken for a mod without versions"""
+    api, cache = client(tmp_path, monkeypatch, resp)
+    with pytest.raises(error):
+        api.check_version_exists("123", "1.0")
+    assert cache.get("https://spacedock.info/api/mod/123") is None
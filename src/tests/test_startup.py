@@ -0,0 +1,38 @@
+# Tests for the startup cost of the entry points
+import os
+import sys
+import subprocess
+
+import pytest
+
+IMPORT_BUDGET = 0.5  # seconds allowed for importing an entry point
+HEAVY_MODULES = ["boto3", "botocore", "requests"]
+
+SRC_PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def import_entry_point(name):
+    """Imports an entry point in a fresh interpreter, returning its import time and the heavy modules it loaded"""
+    script = (
+        "import sys, time\n"
+        "start = time.perf_counter()\n"
+        f"import {name}\n"
+        "print(time.perf_counter() - start)\n"
+        f"print(','.join(m for m in {HEAVY_MODULES!r} if m in sys.modules))\n"
+    )
+    out = subprocess.run([sys.executable, "-c", script], cwd=SRC_PATH,
+                         capture_output=True, text=True, check=True).stdout.splitlines()
+    return float(out[0]), [m for m in out[1].split(",") if m]
+
+@pytest.mark.parametrize("entry_point", ["package", "stage", "deploy", "pipeline", "batch"])
+def test_no_heavy_imports(entry_point):
+    """Test that the entry points don't import AWS or HTTP libraries until they are used"""
+    _, heavy = import_entry_point(entry_point)
+    assert heavy == []
+
+@pytest.mark.parametrize("entry_point", ["package", "stage", "deploy", "pipeline", "batch"])
+def test_import_budget(entry_point):
+    """Test that importing the entry points stays within the startup budget"""
+    # The best of a few runs, so a busy machine doesn't fail the test
+    elapsed = min(import_entry_point(entry_point)[0] for _ in range(3))
+    assert elapsed < IMPORT_BUDGET
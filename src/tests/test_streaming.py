@@ -0,0 +1,103 @@
+# Tests for extracting zips while they download
+import io
+import os
+import zipfile
+
+import pytest
+
+from ksp_deploy.streaming import StreamingZipExtractor, stream_extract
+
+FILES = {
+    "GameData/Dep/dep.cfg": b"PART { name = dep }\n" * 400,
+    "GameData/Dep/Plugins/dep.dll": os.urandom(3000),
+}
+
+
+class UnseekableStream(io.RawIOBase):
+    """Makes zipfile write data descriptors, as it does when streaming an archive out"""
+
+    def __init__(self):
+        self.data = bytearray()
+
+    def writable(self):
+        return True
+
+    def write(self, b):
+        self.data += b
+        return len(b)
+
+
+def make_zip(files, compression=zipfile.ZIP_DEFLATED, streamed=False):
+    target = UnseekableStream() if streamed else io.BytesIO()
+    with zipfile.ZipFile(target, "w", compression) as z:
+        for name, data in files.items():
+            z.writestr(name, data)
+    return bytes(target.data) if streamed else target.getvalue()
+
+def chunks(data, size=777):
+    return [data[i:i + size] for i in range(0, len(data), size)]
+
+def assert_extracted(dest, files):
+    for name, data in files.items():
+        with open(os.path.join(dest, *name.split("/")), "rb") as f:
+            assert f.read() == data
+
+@pytest.mark.parametrize("compression", [zipfile.ZIP_STORED, zipfile.ZIP_DEFLATED])
+def test_extracts_from_chunks(tmp_path, compression):
+    """Test that entries are extracted from small chunks, before the central directory arrives"""
+    extractor = StreamingZipExtractor(str(tmp_path))
+    for chunk in chunks(make_zip(FILES, compression)):
+        extractor.feed(chunk)
+    extractor.close()
+    assert set(extractor.extracted) == set(FILES)
+    assert_extracted(str(tmp_path), FILES)
+
+def test_data_descriptors(tmp_path):
+    """Test that deflated entries followed by a data descriptor are extracted"""
+    data = make_zip(FILES, streamed=True)
+    with zipfile.ZipFile(io.BytesIO(data)) as z:
+        assert all(info.flag_bits & 0x08 for info in z.infolist())
+    extractor = StreamingZipExtractor(str(tmp_path))
+    for chunk in chunks(data, 100):
+        extractor.feed(chunk)
+    extractor.close()
+    assert_extracted(str(tmp_path), FILES)
+
+def test_truncated_archive(tmp_path):
+    """Test that an archive ending in the middle of an entry is reported"""
+    extractor = StreamingZipExtractor(str(tmp_path))
+    extractor.feed(make_zip(FILES)[:1000])
+    with pytest.raises(zipfile.BadZipFile):
+        extractor.close()
+
+def test_entries_outside_dest(tmp_path):
+    """Test that entries are kept inside the destination folder"""
+    extractor = StreamingZipExtractor(str(tmp_path / "dest"))
+    extractor.feed(make_zip({"../../evil.cfg": b"x"}))
+    extractor.close()
+    assert os.path.exists(tmp_path / "dest" / "evil.cfg")
+    assert not os.path.exists(tmp_path / "evil.cfg")
+
+def test_falls_back_for_unsupported_methods(tmp_path):
+    """Test that archives the stream can't handle are extracted once downloaded"""
+    spool = stream_extract(chunks(make_zip(FILES, zipfile.ZIP_BZIP2)), str(tmp_path), 1024 * 1024)
+    spool.close()
+    assert_extracted(str(tmp_path), FILES)
+
+def test_abort_removes_partial_entry(tmp_path):
+    """Test that aborting closes and removes the entry being written"""
+    extractor = StreamingZipExtractor(str(tmp_path))
+    extractor.feed(make_zip(FILES, zipfile.ZIP_STORED)[:2000])
+    handle = extractor._entry["handle"]
+    extractor.abort()
+    assert handle.closed
+    assert not os.path.exists(tmp_path / "GameData" / "Dep" / "dep.cfg")
+
+def test_falls_back_for_corrupt_entries(tmp_path):
+    """Test that an entry failing its check mid-stream is extracted again from the central directory"""
+    data = bytearray(make_zip(FILES))
+    # The local header's CRC-32 disagrees with the data and the central directory
+    data[14:18] = b"\x00\x00\x00\x00"
+    spool = stream_extract(chunks(bytes(data)), str(tmp_path), 1024 * 1024)
+    spool.close()
+    assert_extracted(str(tmp_path), FILES)